@@ -0,0 +1,58 @@
+import random
+from netaddr import IPNetwork
+from db import EphemDB
+from config import Env
+from state import State
+from balance import Balance
+from utils import sha3
+
+# Positional lookups through the address count tree must match a sorted list of
+# all the addresses, on the head state index and on the trie fallback
+random.seed(1)
+addrs = [sha3(str(i))[-20:] for i in range(3000)]
+err = False
+
+s = State(env=Env(EphemDB()), executing_on_head=True)
+for i, addr in enumerate(addrs):
+    s.set_balance(addr, Balance(IPNetwork((i << 8, 24), version=4)))
+    if i % 500 == 0:
+        s.commit()
+s.commit()
+removed = addrs[::7]
+for addr in removed:
+    acct = s.get_and_cache_account(addr)
+    acct.deleted = True
+    acct.touched = False
+s.commit()
+expected = sorted(set(addrs) - set(removed))
+
+print("CHECKING COUNT...")
+if s.address_count() != len(expected) or s.list_all_addresses() != expected:
+    print("TEST FAILED: wrong address count or order")
+    err = True
+
+print("CHECKING POSITIONS...")
+positions = [0, len(expected) - 1] + random.sample(range(len(expected)), 200)
+if s.addresses_at(positions) != [expected[i] for i in positions]:
+    print("TEST FAILED: index lookups differ from the sorted list")
+    err = True
+fallback = State(root=s.trie.root_hash, env=s.env)
+if fallback.address_count() != len(expected) or \
+        fallback.addresses_at(positions) != [expected[i] for i in positions]:
+    print("TEST FAILED: trie lookups differ from the sorted list")
+    err = True
+try:
+    s.addresses_at([len(expected)])
+    print("TEST FAILED: position out of range accepted")
+    err = True
+except IndexError:
+    pass
+
+print("CHECKING REBUILT COUNTS...")
+s.rebuild_address_index()
+if s.verify_address_index()[3] is not True or s.addresses_at(positions) != [expected[i] for i in positions]:
+    print("TEST FAILED: rebuilt counts differ")
+    err = True
+
+if not err:
+    print("TEST PASSED")
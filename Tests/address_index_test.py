@@ -0,0 +1,97 @@
+from netaddr import IPNetwork
+from db import EphemDB
+from config import Env
+from state import State, ADDRESS_INDEX_PREFIX, ADDRESS_COUNT_PREFIX, ADDRESS_INDEX_ROOT
+from balance import Balance
+from utils import sha3
+from verify_address_index import verify
+
+# The flat 'address:' index of the head state must follow the trie through
+# commits, reverts and restarts
+addrs = [sha3(str(i))[-20:] for i in range(4)]
+err = False
+
+
+def check(state, msg):
+    global err
+    if state.verify_address_index() != ([], [], [], True) or not state.address_index_valid():
+        print("TEST FAILED: %s" % msg)
+        err = True
+
+
+env = Env(EphemDB())
+s = State(env=env, executing_on_head=True)
+print("CHECKING COMMITS...")
+s.set_balance(addrs[0], Balance(IPNetwork('10.0.0.0/8')))
+s.set_balance(addrs[1], Balance(IPNetwork('11.0.0.0/8')))
+s.commit()
+s.increment_nonce(addrs[1])
+s.set_balance(addrs[2], Balance(IPNetwork('12.0.0.0/8')))
+s.commit()
+check(s, "index differs after commit")
+if s.get_nonce(addrs[1]) != 1 or not s.get_balance(addrs[2]).in_own_ips(IPNetwork('12.1.0.0/16')):
+    print("TEST FAILED: wrong read through the index")
+    err = True
+
+print("CHECKING DELETES...")
+acct = s.get_and_cache_account(addrs[2])
+acct.deleted = True
+acct.touched = False
+s.commit()
+check(s, "index differs after delete")
+
+print("CHECKING REVERTS...")
+snap = s.snapshot()
+s.set_balance(addrs[3], Balance(IPNetwork('13.0.0.0/8')))
+s.increment_nonce(addrs[0])
+s.commit()
+s.revert(snap)
+check(s, "index differs after revert")
+if s.get_nonce(addrs[0]) != 0 or len(s.get_balance(addrs[3]).own_ips) != 0:
+    print("TEST FAILED: reverted changes visible through the index")
+    err = True
+
+print("CHECKING RESTARTS...")
+root = s.trie.root_hash
+restarted = State(root=root, env=env, executing_on_head=True)
+check(restarted, "index not valid after restart")
+old = State(root=b'', env=env, executing_on_head=True)
+if old.address_index_valid():
+    print("TEST FAILED: index accepted for another root")
+    err = True
+
+print("CHECKING REBUILD...")
+env.db.put(ADDRESS_INDEX_PREFIX + addrs[3], b'junk')
+env.db.delete(ADDRESS_INDEX_PREFIX + addrs[0])
+missing, mismatched, extra, counts_ok = restarted.verify_address_index()
+if missing != [addrs[0]] or extra != [addrs[3]]:
+    print("TEST FAILED: verification missed corrupted entries")
+    err = True
+restarted.rebuild_address_index()
+check(restarted, "index differs after rebuild")
+
+print("CHECKING GENESIS REPAIR...")
+# The tool opens the genesis state at its stored root and repairs only the index
+db = EphemDB()
+genesis = State(env=Env(db))
+for i, addr in enumerate(addrs):
+    genesis.set_balance(addr, Balance(IPNetwork((i << 24, 8), version=4)))
+genesis.commit()
+db.put('head_hash', b'\x01' * 32)
+db.put(b'\x01' * 32, 'GENESIS')
+db.put(b'state:' + b'\x01' * 32, genesis.trie.root_hash)
+before = dict(db.kv)
+if verify(db) != 1 or dict(db.kv) != before:
+    print("TEST FAILED: check without repair wrote to the database")
+    err = True
+if verify(db, repair=True) != 0 or verify(db) != 0:
+    print("TEST FAILED: genesis index not repaired")
+    err = True
+written = [k for k in set(db.kv) | set(before) if db.kv.get(k) != before.get(k)]
+if not written or [k for k in written if not (k.startswith(ADDRESS_INDEX_PREFIX) or
+                                              k.startswith(ADDRESS_COUNT_PREFIX) or k == ADDRESS_INDEX_ROOT)]:
+    print("TEST FAILED: repair wrote outside the address index")
+    err = True
+
+if not err:
+    print("TEST PASSED")
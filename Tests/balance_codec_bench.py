@@ -0,0 +1,48 @@
+import timeit
+import random
+from netaddr import IPNetwork, IPSet
+from balance import Balance, encode_balance, decode_balance
+from utils import object_to_bin, bin_to_object, sha3
+
+# Compares the legacy hex encoded pickle of a Balance with the binary codec
+N = 200
+SIZES = [1, 10, 100, 1000]
+
+
+def random_v4(plen):
+    return IPNetwork((random.getrandbits(32) >> (32 - plen) << (32 - plen), plen), version=4)
+
+
+def random_v6(plen):
+    return IPNetwork((random.getrandbits(128) >> (128 - plen) << (128 - plen), plen), version=6)
+
+
+def mk_balance(n):
+    b = Balance(IPSet([random_v4(24) for _ in range(n)] + [random_v6(48) for _ in range(n)]))
+    for i in range(max(1, n / 10)):
+        addr = sha3(str(i))[-20:]
+        b.add_delegated_ips(addr, random_v4(26))
+        b.add_received_ips(addr, random_v6(56))
+    b.set_map_server(['\x01', IPNetwork('1.1.1.1').ip.packed, sha3('ms')[-20:]])
+    return b
+
+
+print("BALANCE CODEC BENCHMARK")
+print("%8s %12s %12s %12s %12s %10s %10s" % ("prefixes", "pickle enc", "codec enc", "pickle dec",
+                                            "codec dec", "pickle B", "codec B"))
+for size in SIZES:
+    b = mk_balance(size)
+    legacy = object_to_bin(b)
+    new = encode_balance(b)
+    if encode_balance(decode_balance(new)) != new:
+        print("TEST FAILED: codec round trip mismatch")
+    if encode_balance(decode_balance(legacy)) != new:
+        print("TEST FAILED: legacy balance decodes differently")
+    runs = max(1, N / size)
+    t_pe = timeit.timeit(lambda: object_to_bin(b), number=runs) / runs
+    t_ce = timeit.timeit(lambda: encode_balance(b), number=runs) / runs
+    t_pd = timeit.timeit(lambda: bin_to_object(legacy), number=runs) / runs
+    t_cd = timeit.timeit(lambda: decode_balance(new), number=runs) / runs
+    print("%8d %10.1fus %10.1fus %10.1fus %10.1fus %10d %10d" % (2 * size, t_pe * 1e6, t_ce * 1e6,
+                                                             t_pd * 1e6, t_cd * 1e6, len(legacy), len(new)))
+print("BENCHMARK FINISHED")
@@ -0,0 +1,59 @@
+from netaddr import IPNetwork
+from db import EphemDB
+from config import Env
+from state import State
+from balance import Balance
+from transactions import Transaction
+from apply import apply_transaction
+from own_exceptions import InsufficientBalance
+from utils import sha3, privtoaddr
+
+# Applying a list of transactions with a single commit must give the same
+# state root as committing after every transaction
+keys = [sha3('key%d' % i) for i in range(3)]
+addrs = [privtoaddr(k) for k in keys]
+
+
+def mk_state():
+    s = State(env=Env(EphemDB()))
+    s.set_balance(addrs[0], Balance(IPNetwork('10.0.0.0/8')))
+    s.set_balance(addrs[1], Balance(IPNetwork('11.0.0.0/8')))
+    s.commit()
+    return s
+
+
+def mk_tx(i, nonce, category, to, value):
+    tx = Transaction(nonce, category, addrs[to], 1, value)
+    tx.sign(keys[i])
+    return tx
+
+
+txs = [mk_tx(0, 0, 0, 1, '10.1.0.0/16'),
+       mk_tx(1, 0, 1, 2, '10.1.0.0/24'),
+       mk_tx(1, 1, 0, 2, '12.0.0.0/16'),  # not owned, rolled back
+       mk_tx(0, 1, 1, 2, '10.2.0.0/16'),
+       mk_tx(1, 1, 0, 0, '11.0.0.0/9')]
+err = False
+
+per_tx = mk_state()
+per_block = mk_state()
+for tx in txs:
+    for s, commit in ((per_tx, True), (per_block, False)):
+        try:
+            apply_transaction(s, tx, {}, commit=commit)
+        except InsufficientBalance:
+            pass
+
+print("CHECKING UNCOMMITTED READS...")
+if per_block.get_nonce(addrs[1]) != 2 or not per_block.get_balance(addrs[0]).in_own_ips(IPNetwork('11.0.0.0/9')):
+    print("TEST FAILED: block state does not see its own changes")
+    err = True
+
+print("CHECKING STATE ROOT...")
+per_block.commit()
+if per_tx.trie.root_hash != per_block.trie.root_hash:
+    print("TEST FAILED: roots differ")
+    err = True
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,66 @@
+import sys
+import time
+import rlp
+from db import open_db
+from config import Env
+from chain import Chain
+from block import Block
+
+# Reads the head block the way the main loop does and walks the blocks by number,
+# with the decoded block cache (copies and shared instances) and with the former
+# behaviour of decoding on every call. The node must not be running with the
+# leveldb backend, which is locked
+# Usage: python chain_block_cache_bench.py [chain_db_dir] [iterations]
+PATH = sys.argv[1] if len(sys.argv) > 1 else './chain'
+ITERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+
+class UncachedChain(Chain):
+
+    def _cached_block(self, blockhash):
+        self.head_block = None
+        block_rlp = self.db.get(blockhash)
+        if block_rlp in ('GENESIS', b'GENESIS'):
+            return None
+        return rlp.decode(block_rlp, Block)
+
+
+def timed(chain):
+    start = time.time()
+    for i in range(ITERATIONS):
+        head = chain.get_head_block()
+        head.header.number, head.header.timestamp
+    head_time = time.time() - start
+    number = chain.get_head_block().header.number
+    start = time.time()
+    walked = 0
+    while walked < ITERATIONS:
+        for n in range(1, number + 1):
+            chain.get_block_by_number(n)
+            walked += 1
+    return head_time, time.time() - start, walked
+
+
+env = Env(open_db(PATH))
+err = False
+print("DECODED BLOCK CACHE BENCHMARK (%s)" % PATH)
+print("%-10s %14s %18s" % ("blocks", "head reads/s", "reads by number/s"))
+hashes = None
+for name, chain_class, shared in (("decoded", UncachedChain, False), ("copies", Chain, False),
+                                  ("shared", Chain, True)):
+    env.config['SHARED_BLOCKS'] = shared
+    chain = chain_class(env=env)
+    head_time, walk_time, walked = timed(chain)
+    print("%-10s %14d %18d" % (name, ITERATIONS / head_time, walked / walk_time))
+    number = chain.get_head_block().header.number
+    blocks = [chain.get_block_by_number(n) for n in range(1, number + 1)]
+    if hashes is None:
+        hashes = [b.hash for b in blocks]
+    if [b.hash for b in blocks] != hashes:
+        print("TEST FAILED: %s blocks differ" % name)
+        err = True
+    again = chain.get_block_by_number(number)
+    if (again is chain.get_head_block()) != shared:
+        print("TEST FAILED: %s blocks %s shared" % (name, "not" if shared else "wrongly"))
+        err = True
+print("BENCHMARK FINISHED")
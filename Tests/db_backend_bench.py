@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+from netaddr import IPNetwork
+from db import LevelDB, LMDBDB, SQLiteDB, lmdb
+from config import Env
+from state import State
+from balance import Balance
+from utils import sha3
+
+# Replays the same blocks into every backend and times batch puts (commits),
+# random gets on a cold cache, a prefix scan of the address index and a cold
+# start, then reads the database from several processes while it stays open
+# Usage: python db_backend_bench.py [accounts] [blocks] [changes per block] [readers]
+BACKENDS = {'leveldb': LevelDB, 'sqlite': SQLiteDB, 'lmdb': LMDBDB}
+READS = 20000
+
+
+# Reader process: random gets of the keys listed in path/keys
+def read(backend, path):
+    try:
+        db = LMDBDB(path, readonly=True) if backend == 'lmdb' else BACKENDS[backend](path)
+    except Exception as e:
+        print("open failed (%s)" % ('locked' if 'lock' in str(e) else e))
+        return
+    keys = open(os.path.join(path, '..', 'keys')).read().split('\n')
+    start = time.time()
+    for k in keys:
+        db.get(k.decode('hex'))
+    print("%d gets/s" % (len(keys) / (time.time() - start)))
+
+
+def replay(db, accounts, blocks, changes):
+    random.seed(1)
+    addrs = [sha3(str(i))[-20:] for i in range(accounts)]
+    state = State(env=Env(db), executing_on_head=True)
+    for i, addr in enumerate(addrs):
+        state.set_balance(addr, Balance(IPNetwork('10.%d.%d.0/24' % (i >> 8 & 255, i & 255))))
+    state.commit()
+    db.commit()
+    commit_time = 0
+    for number in range(blocks):
+        for addr in random.sample(addrs, changes):
+            state.increment_nonce(addr)
+        state.commit()
+        start = time.time()
+        db.commit()
+        commit_time += time.time() - start
+    return addrs, state.trie.root_hash, commit_time
+
+
+def bench(name, accounts, blocks, changes, readers):
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'db')
+    os.mkdir(path)
+    try:
+        db = BACKENDS[name](path)
+        addrs, root, commit_time = replay(db, accounts, blocks, changes)
+        keys = [k for k, v in db.iter_prefix(b'')]
+        del db
+
+        start = time.time()
+        db = BACKENDS[name](path)
+        state = State(root=root, env=Env(db))
+        for addr in addrs[:1000]:
+            state.get_nonce(addr)
+        cold = time.time() - start
+
+        sample = [random.choice(keys) for i in range(READS)]
+        start = time.time()
+        for k in sample:
+            db.get(k)
+        gets = READS / (time.time() - start)
+
+        start = time.time()
+        scanned = len(list(db.iter_prefix(b'address:')))
+        scan = time.time() - start
+
+        print("%-8s batch put %6.2f ms/block, get %7d/s, scan %6d entries/s, cold start %5.0f ms" %
+              (name, 1000 * commit_time / blocks, gets, scanned / scan, 1000 * cold))
+
+        with open(os.path.join(workdir, 'keys'), 'w') as f:
+            f.write('\n'.join(k.encode('hex') for k in sample))
+        procs = [subprocess.Popen([sys.executable, __file__, '--read', name, path], stdout=subprocess.PIPE)
+                 for i in range(readers)]
+        outputs = [p.communicate()[0].strip() for p in procs]
+        print("%-8s %d readers while open: %s" % (name, readers, ', '.join(outputs)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--read']:
+        read(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    blocks = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    changes = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    readers = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    print("%d accounts, %d blocks of %d changes" % (accounts, blocks, changes))
+    for name in ('leveldb', 'lmdb', 'sqlite'):
+        if name == 'lmdb' and lmdb is None:
+            print("lmdb     skipped, the lmdb package is not installed")
+            continue
+        bench(name, accounts, blocks, changes, readers)
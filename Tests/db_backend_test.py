@@ -0,0 +1,63 @@
+import shutil
+import tempfile
+from db import LevelDB, LMDBDB, SQLiteDB, lmdb
+from config import Env
+from state import State
+from netaddr import IPNetwork
+from balance import Balance
+from utils import sha3
+
+# Every backend must behave the same: reads, batched writes and deletes, prefix
+# iteration in byte order merged with the pending writes, reopening, and the
+# state roots written through it
+backends = [LevelDB, SQLiteDB] + ([LMDBDB] if lmdb is not None else [])
+keys = sorted(set([sha3(str(i))[:i % 5 + 1] for i in range(300)] + [b'\x00', b'\xff' * 3, b'p\x00', b'p\xff']))
+err = False
+roots = set()
+
+for backend in backends:
+    print("CHECKING %s..." % backend.__name__)
+    path = tempfile.mkdtemp()
+    try:
+        db = backend(path)
+        for k in keys:
+            db.put(k, b'v' + k)
+        db.commit()
+        db.delete(keys[0])
+        db.put(keys[1], b'new')
+        db.put(b'p\x01', b'pending')
+        if keys[0] in db or db.get(keys[1]) != b'new' or db.get(keys[2]) != b'v' + keys[2]:
+            print("TEST FAILED: %s reads do not see the pending writes" % backend.__name__)
+            err = True
+        expected = sorted((k, v) for k, v in [(b'p\x00', b'vp\x00'), (b'p\x01', b'pending'), (b'p\xff', b'vp\xff')] +
+                          [(k, b'v' + k) for k in keys[2:] if k.startswith(b'p') and k not in (b'p\x00', b'p\xff')])
+        if list(db.iter_prefix(b'p')) != expected:
+            print("TEST FAILED: %s prefix iteration %s" % (backend.__name__, list(db.iter_prefix(b'p'))))
+            err = True
+        db.commit()
+        db.compact()
+        del db
+        db = backend(path)
+        if keys[0] in db or db.get(keys[1]) != b'new' or db.get(b'p\x01') != b'pending' or \
+                [k for k, v in db.iter_prefix(b'')] != sorted(set(keys[1:] + [b'p\x01'])):
+            print("TEST FAILED: %s lost writes on reopen" % backend.__name__)
+            err = True
+
+        state = State(env=Env(db), executing_on_head=True)
+        for i in range(200):
+            state.set_balance(sha3(str(i))[-20:], Balance(IPNetwork('10.%d.0.0/16' % i)))
+        state.commit()
+        db.commit()
+        roots.add(state.trie.root_hash)
+        if len(list(db.iter_prefix(b'address:'))) != 200:
+            print("TEST FAILED: %s address index incomplete" % backend.__name__)
+            err = True
+    finally:
+        shutil.rmtree(path)
+
+if len(roots) != 1:
+    print("TEST FAILED: backends give different state roots")
+    err = True
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,69 @@
+import json
+import shutil
+import tempfile
+import rlp
+from db import LevelDB, SQLiteDB, namespace_of, COMPRESSED
+from utils import sha3
+
+# Values must be stored compressed only in the namespaces that ask for it, read
+# back unchanged, also when written raw by an older version, and each namespace
+# must have its own read cache and iteration
+err = False
+node = b'\x00\x00\x00\x01' + rlp.encode([sha3(str(i)) for i in range(16)] + [b''])
+body = rlp.encode([[b'header' * 20], [b'tx' * 50] * 10])
+records = {
+    sha3(node[4:]): node,
+    sha3(body): body,
+    b'block:7': b'\xff' + sha3(b'7')[1:],
+    b'address:' + b'\x01' * 20: rlp.encode([b'\x01', b'balance' * 30]),
+    b'address_index:root': b'\xff' * 32,
+    b'GENESIS_STATE': json.dumps({'alloc': dict((str(i), 'x' * 20) for i in range(20))}),
+    b'GENESIS_HASH': b'\xff' * 32,
+}
+expected = {sha3(node[4:]): 'trie', sha3(body): 'block', b'block:7': 'block_number', b'address:' + b'\x01' * 20: 'address',
+            b'address_index:root': 'address_count', b'GENESIS_STATE': 'genesis', b'GENESIS_HASH': 'other'}
+
+print("CHECKING NAMESPACES...")
+for k, v in records.items():
+    if namespace_of(k, v).name != expected[k]:
+        print("TEST FAILED: %r in namespace %s" % (k, namespace_of(k, v).name))
+        err = True
+
+for backend in (LevelDB, SQLiteDB):
+    print("CHECKING %s..." % backend.__name__)
+    path = tempfile.mkdtemp()
+    try:
+        db = backend(path)
+        for k, v in records.items():
+            db.put(k, v)
+        db.commit()
+        stored = dict(db._iter_stored(b''))
+        for k, v in records.items():
+            compressed = stored[k][:1] == COMPRESSED and len(stored[k]) < len(v)
+            if compressed != (expected[k] in ('block', 'address', 'genesis')):
+                print("TEST FAILED: %s stored %s" % (expected[k], 'compressed' if compressed else 'raw'))
+                err = True
+            if db.get(k) != v or db.get(k) != v:
+                print("TEST FAILED: %s read back wrong" % expected[k])
+                err = True
+        if dict(db.iter_prefix(b'')) != records or list(db.iter_namespace('address')) != \
+                [(b'address:' + b'\x01' * 20, records[b'address:' + b'\x01' * 20])] or \
+                [k for k, v in db.iter_namespace('block')] != [sha3(body)]:
+            print("TEST FAILED: wrong iteration")
+            err = True
+        stats = db.namespace_stats()
+        if stats['block']['hits'] != 1 or stats['block']['misses'] != 1 or stats['trie']['misses'] != 1 or \
+                stats['address']['size'] == 0:
+            print("TEST FAILED: wrong namespace stats %s" % stats)
+            err = True
+
+        # Raw values of an older version
+        db._write([(b'GENESIS_RLP', body), (sha3(b'old'), body)])
+        if db.get(b'GENESIS_RLP') != body or db.get(sha3(b'old')) != body:
+            print("TEST FAILED: raw values not readable")
+            err = True
+    finally:
+        shutil.rmtree(path)
+
+if not err:
+    print("TEST PASSED")
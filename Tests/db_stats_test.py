@@ -0,0 +1,61 @@
+import os
+import json
+import tempfile
+from netaddr import IPNetwork
+from db import EphemDB, InstrumentedDB, DBStats
+from config import Env
+from state import State
+from balance import Balance
+from utils import sha3
+
+# The instrumented database must count the accesses of every layer built on it by
+# call site and namespace, without changing the results, and dump the changes of
+# each block
+err = False
+path = tempfile.mktemp()
+stats = DBStats(path)
+db = InstrumentedDB(EphemDB(), stats, 'ephem')
+plain = State(env=Env(EphemDB()), executing_on_head=True)
+state = State(env=Env(db), executing_on_head=True)
+addrs = [sha3(str(i))[-20:] for i in range(100)]
+
+print("CHECKING COUNTERS...")
+for s in (plain, state):
+    for i, addr in enumerate(addrs):
+        s.set_balance(addr, Balance(IPNetwork('10.%d.0.0/16' % i)))
+    s.commit()
+if plain.trie.root_hash != state.trie.root_hash:
+    print("TEST FAILED: instrumentation changes the state root")
+    err = True
+stats.dump(1)
+snapshot = stats.snapshot()
+try:
+    refcount_puts = snapshot['refcount']['Trie']['hash']['put']
+    node_puts = snapshot['ephem']['State']['hash']['put']
+    index_puts = snapshot['ephem']['State']['address']['put']
+except KeyError:
+    print("TEST FAILED: missing counters %s" % snapshot)
+    err = True
+else:
+    if index_puts['count'] != 100 or refcount_puts['count'] < 200 or node_puts['count'] < 200 or \
+            sum(index_puts['latency_us'].values()) != 100 or index_puts['bytes'] <= 100 * 28:
+        print("TEST FAILED: wrong counters %s %s %s" % (refcount_puts, node_puts, index_puts))
+        err = True
+
+print("CHECKING DUMPS...")
+State(root=state.trie.root_hash, env=Env(db)).get_nonce(addrs[0])
+try:
+    db.get(b'missing')
+except KeyError:
+    pass
+stats.dump(2)
+lines = [json.loads(line) for line in open(path)]
+os.remove(path)
+if [line['block'] for line in lines] != [1, 2] or 'put' in json.dumps(lines[1]) or \
+        lines[1]['stats']['ephem']['other']['other']['get_missing']['count'] != 1 or \
+        'get' not in lines[1]['stats']['refcount']['Trie']['hash']:
+    print("TEST FAILED: wrong dumps %s" % lines)
+    err = True
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,73 @@
+import sys
+import time
+import random
+import shutil
+import tempfile
+from netaddr import IPNetwork
+from db import LevelDB, LMDBDB, SQLiteDB, lmdb
+from config import Env
+from state import State
+from balance import Balance
+from utils import sha3
+
+# Replays blocks into every backend, committing them directly and through the
+# background writer. Times the state commit of each block, how long the database
+# commit keeps the caller waiting, and the final sync
+# Usage: python db_write_behind_bench.py [accounts] [blocks] [changes per block] [queue size]
+ACCOUNTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+BLOCKS = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+CHANGES = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+QUEUE_SIZE = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+BACKENDS = [('leveldb', LevelDB), ('sqlite', SQLiteDB)] + ([('lmdb', LMDBDB)] if lmdb is not None else [])
+
+
+def replay(backend, write_behind):
+    random.seed(1)
+    path = tempfile.mkdtemp()
+    try:
+        db = backend(path)
+        addrs = [sha3(str(i))[-20:] for i in range(ACCOUNTS)]
+        state = State(env=Env(db), executing_on_head=True)
+        for i, addr in enumerate(addrs):
+            state.set_balance(addr, Balance(IPNetwork('10.%d.%d.0/24' % (i >> 8 & 255, i & 255))))
+        state.commit()
+        db.commit()
+        if write_behind:
+            db.start_writer(QUEUE_SIZE)
+        state_time = 0
+        waited = []
+        for number in range(BLOCKS):
+            for addr in random.sample(addrs, CHANGES):
+                state.increment_nonce(addr)
+            start = time.time()
+            state.commit()
+            state_time += time.time() - start
+            start = time.time()
+            db.commit()
+            waited.append(time.time() - start)
+        start = time.time()
+        if write_behind:
+            db.stop_writer()
+        else:
+            db.sync()
+        return state_time, sorted(waited), time.time() - start, state.trie.root_hash
+    finally:
+        shutil.rmtree(path)
+
+
+print("WRITE-BEHIND BENCHMARK (%d accounts, %d blocks of %d changes, queue of %d batches)" %
+      (ACCOUNTS, BLOCKS, CHANGES, QUEUE_SIZE))
+print("%-8s %-12s %10s %12s %10s %10s %10s" % ("backend", "commits", "state ms", "db commit ms", "p50 ms", "max ms",
+                                                "sync ms"))
+for name, backend in BACKENDS:
+    roots = set()
+    for mode, write_behind in (("direct", False), ("write-behind", True)):
+        state_time, waited, sync, root = replay(backend, write_behind)
+        roots.add(root)
+        print("%-8s %-12s %10.2f %12.2f %10.2f %10.2f %10.2f" % (name, mode, 1000 * state_time / BLOCKS,
+                                                                 1000 * sum(waited) / BLOCKS,
+                                                                 1000 * waited[len(waited) // 2], 1000 * waited[-1],
+                                                                 1000 * sync))
+    if len(roots) != 1:
+        print("TEST FAILED: %s roots differ" % name)
+print("BENCHMARK FINISHED")
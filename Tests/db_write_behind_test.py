@@ -0,0 +1,108 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import subprocess
+from db import LevelDB, LMDBDB, SQLiteDB, lmdb
+
+# With a background writer, commit must return before the batch is written, reads
+# and prefix iteration must see the batches in flight, sync must wait until they
+# are on disk, and a failed write must surface on the next commit. A node stopped
+# with SIGTERM must write its committed batches and drop the uncommitted writes
+backends = [LevelDB, SQLiteDB] + ([LMDBDB] if lmdb is not None else [])
+err = False
+
+for backend in backends:
+    print("CHECKING %s..." % backend.__name__)
+    path = tempfile.mkdtemp()
+    try:
+        db = backend(path)
+        db.put(b'p:old', b'old')
+        db.put(b'p:gone', b'gone')
+        db.commit()
+        release = threading.Event()
+        write = db._write
+
+        def blocked_write(items):
+            release.wait()
+            write(items)
+        db._write = blocked_write
+        db.start_writer(4)
+
+        for i in range(3):
+            db.put(b'p:%d' % i, b'v%d' % i)
+            db.put(b'p:old', b'new%d' % i)
+            db.commit()
+        db.delete(b'p:gone')
+        db.commit()
+        if len(db.in_flight) != 4 or db.get(b'p:old') != b'new2' or db.get(b'p:1') != b'v1' or b'p:gone' in db:
+            print("TEST FAILED: %s reads do not see the batches in flight" % backend.__name__)
+            err = True
+        expected = [(b'p:0', b'v0'), (b'p:1', b'v1'), (b'p:2', b'v2'), (b'p:old', b'new2')]
+        if list(db.iter_prefix(b'p:')) != expected:
+            print("TEST FAILED: %s prefix iteration %s" % (backend.__name__, list(db.iter_prefix(b'p:'))))
+            err = True
+
+        release.set()
+        db.sync()
+        if db.in_flight or db.get(b'p:old') != b'new2' or dict(db._iter_stored(b'p:')).get(b'p:old') != b'new2' or \
+                b'p:gone' in dict(db._iter_stored(b'p:')):
+            print("TEST FAILED: %s batches not written after sync" % backend.__name__)
+            err = True
+
+        def failed_write(items):
+            raise IOError("disk full")
+        db._write = failed_write
+        db.put(b'p:lost', b'x')
+        db.commit()
+        try:
+            db.sync()
+            print("TEST FAILED: %s write error not raised" % backend.__name__)
+            err = True
+        except IOError:
+            pass
+        if db.get(b'p:lost') != b'x':
+            print("TEST FAILED: %s failed batch not readable" % backend.__name__)
+            err = True
+        try:
+            db.stop_writer()
+        except IOError:
+            pass
+        if db.writer is not None:
+            print("TEST FAILED: %s writer not stopped" % backend.__name__)
+            err = True
+    finally:
+        shutil.rmtree(path)
+
+print("CHECKING SIGTERM...")
+CHILD = """
+import os, sys, time, signal
+sys.path.insert(0, %r)
+from db import LevelDB
+db = LevelDB(sys.argv[1])
+write = db._write
+def slow_write(items):
+    time.sleep(0.2)
+    write(items)
+db._write = slow_write
+db.start_writer(4)
+for i in range(3):
+    db.put(b'p:%%d' %% i, b'v')
+    db.commit()
+db.put(b'p:uncommitted', b'v')
+os.kill(os.getpid(), signal.SIGTERM)
+time.sleep(10)
+""" % os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+path = tempfile.mkdtemp()
+try:
+    code = subprocess.call([sys.executable, '-c', CHILD, path])
+    db = LevelDB(path)
+    if code != 128 + 15 or [k for k, v in db.iter_prefix(b'p:')] != [b'p:0', b'p:1', b'p:2']:
+        print("TEST FAILED: wrong batches after SIGTERM (exit code %d): %s" % (code, list(db.iter_prefix(b'p:'))))
+        err = True
+finally:
+    shutil.rmtree(path)
+
+if not err:
+    print("TEST PASSED")
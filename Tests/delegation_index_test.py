@@ -0,0 +1,74 @@
+import time
+import random
+from netaddr import IPNetwork
+from balance import Balance
+from prefixset import PrefixSet
+from utils import sha3
+
+# Checks the reverse delegation index of Balance against a scan of delegated_ips
+random.seed(1)
+N = 2000
+DELEGATEES = [sha3(str(i))[-20:] for i in range(50)]
+
+
+def random_net():
+    if random.random() < 0.5:
+        return IPNetwork((random.getrandbits(8) << 16, random.randint(8, 20)), version=4).cidr
+    return IPNetwork((random.getrandbits(16) << 96, random.randint(16, 40)), version=6).cidr
+
+
+def scan(balance, ips):
+    addresses = {}
+    ips = PrefixSet(ips)
+    for addr, set in balance.delegated_ips.iteritems():
+        joint = ips & set
+        if joint:
+            addresses[addr.encode('HEX')] = joint
+    return addresses
+
+
+err = False
+b = Balance()
+print("CHECKING RANDOM DELEGATIONS...")
+for i in range(N):
+    value = random_net()
+    # Same steps as a category 1 transaction in apply_transaction
+    for add, ips in b.affected_delegated_ips(value).iteritems():
+        b.remove_delegated_ips(add, ips)
+    if random.random() < 0.8:
+        b.add_delegated_ips(random.choice(DELEGATEES), value)
+    if i % 50 == 0:
+        b = b.copy()
+    probe = random_net()
+    if b.affected_delegated_ips(probe) != scan(b, probe):
+        print("TEST FAILED: index and scan differ for %s" % probe)
+        err = True
+        break
+
+print("CHECKING OVERLAPPING DELEGATIONS...")
+b2 = Balance()
+b2.add_delegated_ips(DELEGATEES[0], IPNetwork('10.0.0.0/8'))
+b2.affected_delegated_ips(IPNetwork('10.0.0.0/8'))
+b2.add_delegated_ips(DELEGATEES[1], IPNetwork('10.1.0.0/16'))
+if b2.affected_delegated_ips(IPNetwork('10.1.2.0/24')) != scan(b2, IPNetwork('10.1.2.0/24')):
+    print("TEST FAILED: overlapping delegations")
+    err = True
+
+print("TIMING...")
+big = Balance()
+for i in range(5000):
+    big.add_delegated_ips(sha3(str(i))[-20:], IPNetwork((i << 8, 24), version=4))
+probes = [IPNetwork((random.getrandbits(13) << 8, 24), version=4) for i in range(200)]
+t = time.time()
+for p in probes:
+    scan(big, p)
+t_scan = (time.time() - t) / len(probes)
+big.affected_delegated_ips(probes[0])
+t = time.time()
+for p in probes:
+    big.affected_delegated_ips(p)
+t_index = (time.time() - t) / len(probes)
+print("5000 delegatees: scan %.1fus, index %.1fus per query" % (t_scan * 1e6, t_index * 1e6))
+
+if not err:
+    print("TEST PASSED")
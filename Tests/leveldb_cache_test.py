@@ -0,0 +1,42 @@
+import shutil
+import tempfile
+from db import LevelDB
+from lru import LRUCache
+
+# Reads must go to the bounded read cache, not to the write set, so that commit
+# only writes the keys that were put or deleted
+err = False
+path = tempfile.mkdtemp()
+try:
+    db = LevelDB(path)
+    for i in range(100):
+        db.put('key%d' % i, 'x' * 100)
+    db.commit()
+    db.read_caches['other'] = LRUCache(1000, weigh=db.read_caches['other'].weigh)
+
+    print("CHECKING READS...")
+    for i in range(100):
+        if db.get('key%d' % i) != 'x' * 100:
+            print("TEST FAILED: wrong value read")
+            err = True
+    db.get('key99')
+    stats = db.cache_stats()
+    if db.uncommitted or stats['size'] > 1000 or stats['hits'] != 1 or stats['misses'] != 100:
+        print("TEST FAILED: reads reached the write set or the cache is unbounded %s" % stats)
+        err = True
+
+    print("CHECKING WRITES...")
+    db.put('key99', 'y')
+    db.delete('key98')
+    if db.get('key99') != 'y' or 'key98' in db or sorted(db.uncommitted) != ['key98', 'key99']:
+        print("TEST FAILED: wrong write set %s" % db.uncommitted.keys())
+        err = True
+    db.commit()
+    if db.uncommitted or db.get('key99') != 'y' or 'key98' in db or db.get('key97') != 'x' * 100:
+        print("TEST FAILED: wrong values after commit")
+        err = True
+finally:
+    shutil.rmtree(path)
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,53 @@
+from lru import LRUCache
+
+# The cache must keep the most recently used entries and count hits and misses
+err = False
+c = LRUCache(3)
+for i in range(3):
+    c.put(i, str(i))
+c.get(0)
+c.put(3, '3')
+
+print("CHECKING EVICTION...")
+if 1 in c or len(c) != 3 or c.get(0) != '0' or c.get(3) != '3':
+    print("TEST FAILED: wrong entry evicted")
+    err = True
+
+print("CHECKING STATS...")
+c.get(1)
+if c.stats() != {'size': 3, 'max_size': 3, 'hits': 3, 'misses': 1}:
+    print("TEST FAILED: wrong stats %s" % c.stats())
+    err = True
+
+print("CHECKING WEIGHT BUDGET...")
+w = LRUCache(8, weigh=lambda k, v: len(v))
+w.put('a', 'xxxx')
+w.put('b', 'xxxx')
+w.put('a', 'xx')
+w.put('c', 'xxxx')
+w.put('d', 'x' * 9)
+if 'b' in w or 'd' in w or w.get('a') != 'xx' or w.stats()['size'] != 6:
+    print("TEST FAILED: wrong entries for the budget %s" % w.data)
+    err = True
+w.pop('a')
+if w.stats()['size'] != 4:
+    print("TEST FAILED: wrong weight after pop")
+    err = True
+
+print("CHECKING GROWN VALUES...")
+g = LRUCache(10, weigh=lambda k, v: len(v), max_entries=2)
+grown = ['x']
+g.put('a', grown)
+grown.extend('xxx')
+g.put('a', grown)
+g.put('b', ['x'] * 5)
+if g.stats()['size'] != 9:
+    print("TEST FAILED: wrong weight of a grown value %s" % g.stats())
+    err = True
+g.put('c', ['x'])
+if 'a' in g or len(g) != 2 or g.stats()['size'] != 6:
+    print("TEST FAILED: wrong entries for max_entries %s" % g.data)
+    err = True
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,69 @@
+import sys
+import time
+import random
+from netaddr import IPNetwork, IPSet
+from prefixset import PrefixSet
+from balance import Balance, encode_balance, decode_balance
+
+# Allocation heavy accounts: one balance holding n disjoint /48 IPv6 and /28 IPv4 prefixes
+SIZES = [10000, 100000, 1000000]
+# netaddr's IPSet is only measured up to this size, it gets too slow above it
+IPSET_MAX = 10000
+LOOKUPS = 10000
+CHANGES = 1000
+
+random.seed(1)
+
+
+def mk_prefixes(n):
+    v4 = random.sample(xrange(1 << 28), n / 2)
+    v6 = random.sample(xrange(1 << 40), n - n / 2)
+    return ([IPNetwork((p << 4, 28), version=4) for p in v4] +
+            [IPNetwork(((0x2001 << 112) | (p << 80), 48), version=6) for p in v6])
+
+
+def timed(f):
+    t = time.time()
+    r = f()
+    return time.time() - t, r
+
+
+def memory(ps):
+    total = sys.getsizeof(ps)
+    for v in (4, 6):
+        total += sys.getsizeof(ps._starts[v]) + sys.getsizeof(ps._ends[v])
+        if v == 6:
+            total += sum(sys.getsizeof(x) for x in ps._starts[v]) + sum(sys.getsizeof(x) for x in ps._ends[v])
+    return total
+
+
+def run(name, cls, prefixes, probes, changes):
+    t_build, s = timed(lambda: cls(prefixes))
+    t_lookup, _ = timed(lambda: [p in s for p in probes])
+    t_add, _ = timed(lambda: [s.add(p) for p in changes])
+    t_remove, _ = timed(lambda: [s.remove(p) for p in changes])
+    t_and, _ = timed(lambda: [s & cls([p]) for p in changes])
+    print("%8d %-9s %9.3fs %9.2fus %9.2fus %9.2fus %9.2fus" % (
+        len(prefixes), name, t_build, t_lookup / len(probes) * 1e6, t_add / len(changes) * 1e6,
+        t_remove / len(changes) * 1e6, t_and / len(changes) * 1e6))
+    return s
+
+
+print("PREFIX SET BENCHMARK")
+print("%8s %-9s %10s %11s %11s %11s %11s" % ("prefixes", "set", "build", "contains", "add", "remove",
+                                            "intersect"))
+for size in SIZES:
+    prefixes = mk_prefixes(size)
+    probes = [random.choice(prefixes) for _ in range(LOOKUPS)]
+    changes = mk_prefixes(CHANGES)
+    if size <= IPSET_MAX:
+        run("IPSet", IPSet, prefixes, probes, changes)
+    ps = run("PrefixSet", PrefixSet, prefixes, probes, changes)
+    b = Balance(ps)
+    t_enc, data = timed(lambda: encode_balance(b))
+    t_dec, b2 = timed(lambda: decode_balance(data))
+    if b2.own_ips != ps:
+        print("TEST FAILED: codec round trip mismatch")
+    print("%8d codec encode %.3fs decode %.3fs, %d bytes, ~%d bytes in memory" % (
+        size, t_enc, t_dec, len(data), memory(ps)))
+print("BENCHMARK FINISHED")
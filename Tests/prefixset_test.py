@@ -0,0 +1,82 @@
+import random
+from netaddr import IPNetwork, IPAddress, IPSet
+from prefixset import PrefixSet
+
+# Compares PrefixSet with netaddr's IPSet on random operations
+random.seed(1)
+N = 300
+
+
+def random_net():
+    if random.random() < 0.5:
+        plen = random.randint(8, 28)
+        return IPNetwork((random.getrandbits(12) << 20, plen), version=4).cidr
+    plen = random.randint(16, 64)
+    return IPNetwork((random.getrandbits(20) << 108, plen), version=6).cidr
+
+
+def same(ps, ipset):
+    return ps.iter_cidrs() == ipset.iter_cidrs()
+
+
+err = False
+ps = PrefixSet()
+ipset = IPSet()
+
+print("CHECKING ADD AND REMOVE...")
+for i in range(N):
+    net = random_net()
+    if random.random() < 0.6:
+        ps.add(net)
+        ipset.add(net)
+    else:
+        ps.remove(net)
+        ipset.remove(net)
+    if not same(ps, ipset):
+        print("TEST FAILED: %s after %s" % (ps, net))
+        err = True
+        break
+
+print("CHECKING CONTAINMENT...")
+for i in range(N):
+    net = random_net()
+    if (net in ps) != (net in ipset) or (net.ip in ps) != (net.ip in ipset):
+        print("TEST FAILED: containment of %s" % net)
+        err = True
+        break
+
+print("CHECKING SET OPERATIONS...")
+other_nets = [random_net() for i in range(100)]
+other_ps = PrefixSet(other_nets)
+other_ipset = IPSet(other_nets)
+if not same(other_ps, other_ipset):
+    print("TEST FAILED: constructor")
+    err = True
+if not same(ps & other_ps, ipset & other_ipset):
+    print("TEST FAILED: intersection")
+    err = True
+if not same(ps | other_ps, ipset | other_ipset):
+    print("TEST FAILED: union")
+    err = True
+if not same(ps - other_ps, ipset - other_ipset):
+    print("TEST FAILED: difference")
+    err = True
+if ps.isdisjoint(other_ps) != ipset.isdisjoint(other_ipset):
+    print("TEST FAILED: isdisjoint")
+    err = True
+c = ps.copy()
+c.remove(other_ps)
+if not same(c, ipset - other_ipset) or not same(ps, ipset):
+    print("TEST FAILED: copy or bulk remove")
+    err = True
+
+print("CHECKING FIRST AND EMPTINESS...")
+if PrefixSet(['10.0.0.0/8', '2001::/16', '9.0.0.0/8']).first() != IPAddress('9.0.0.0'):
+    print("TEST FAILED: first")
+    err = True
+if PrefixSet() or not PrefixSet(['::/0']) or PrefixSet().first() is not None:
+    print("TEST FAILED: truth value")
+    err = True
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,36 @@
+import sys
+import time
+import random
+import rlp
+from db import EphemDB, RefcountDB
+from trie import Trie
+from securetrie import SecureTrie
+from proof import verify_account_proof
+from utils import sha3
+
+# Account proof generation and verification on large account tries.
+# Usage: python proof_bench.py [accounts ...]
+SIZES = [int(x) for x in sys.argv[1:]] or [100000, 1000000]
+PROOFS = 10000
+
+random.seed(1)
+print("PROOF BENCHMARK")
+print("%8s %12s %12s %10s" % ("accounts", "generate/s", "verify/s", "nodes"))
+for size in SIZES:
+    t = SecureTrie(Trie(RefcountDB(EphemDB())))
+    addrs = [sha3(str(i))[-20:] for i in range(size)]
+    t.build((addr, rlp.encode([i, b'\x00' * 40])) for i, addr in enumerate(addrs))
+    t = SecureTrie(Trie(t.trie.db, t.root_hash))
+    sample = [random.choice(addrs) for _ in range(PROOFS)]
+
+    start = time.time()
+    proofs = [t.get_proof(addr) for addr in sample]
+    t_gen = time.time() - start
+    start = time.time()
+    for addr, proof in zip(sample, proofs):
+        if not verify_account_proof(t.root_hash, addr, proof):
+            print("TEST FAILED: proof rejected")
+    t_verify = time.time() - start
+    print("%8d %12.0f %12.0f %10.1f" % (size, PROOFS / t_gen, PROOFS / t_verify,
+                                        sum(len(p) for p in proofs) / float(PROOFS)))
+print("BENCHMARK FINISHED")
@@ -0,0 +1,75 @@
+import random
+import rlp
+from netaddr import IPNetwork
+from db import EphemDB
+from config import Env
+from state import State
+from balance import Balance
+from trie import Trie
+from proof import verify_proof, verify_balance_proof, InvalidProof
+from utils import sha3
+
+# Proofs from Trie.get_proof must verify for present and absent keys and be
+# rejected once tampered with
+random.seed(1)
+err = False
+t = Trie(EphemDB())
+expected = {}
+for i in range(3000):
+    key = sha3(str(i))[:random.choice([1, 2, 3, 32])]
+    expected[key] = sha3(key)[:random.randint(1, 40)]
+    t.update(key, expected[key])
+root = t.root_hash
+
+print("CHECKING INCLUSION...")
+for key in random.sample(expected.keys(), 300):
+    if verify_proof(root, key, t.get_proof(key)) != expected[key]:
+        print("TEST FAILED: wrong value for %s" % key.encode('hex'))
+        err = True
+        break
+
+print("CHECKING EXCLUSION...")
+for i in range(300):
+    key = sha3('absent%d' % i)[:random.choice([1, 2, 3, 32])]
+    if verify_proof(root, key, t.get_proof(key)) != expected.get(key, b''):
+        print("TEST FAILED: wrong absence proof")
+        err = True
+        break
+
+print("CHECKING TAMPERED PROOFS...")
+key = sorted(expected)[0]
+proof = t.get_proof(key)
+for bad in (proof[:-1], proof[:-1] + [proof[-1][:-1] + b'\x00'], [], [b'\x80'] + proof[1:]):
+    try:
+        if bad != proof and verify_proof(root, key, bad) == expected[key]:
+            print("TEST FAILED: tampered proof accepted")
+            err = True
+    except InvalidProof:
+        pass
+
+print("CHECKING MALFORMED NODES...")
+# Nodes that hash to the root but can not be part of a trie
+for node in (rlp.encode([b'', b'v']), rlp.encode([b'\x40', b'v']), rlp.encode([b'\x01', b'v']),
+             rlp.encode([[b'', b''], b'v']), rlp.encode([b'\x20', [b'v']]), rlp.encode(b'ab'),
+             rlp.encode([b''] * 16 + [[b'v']]), rlp.encode([b'\x20\x01', b'v'])[:-1]):
+    try:
+        verify_proof(sha3(node), b'', [node])
+        print("TEST FAILED: malformed node %s accepted" % node.encode('hex'))
+        err = True
+    except InvalidProof:
+        pass
+
+print("CHECKING BALANCE PROOFS...")
+s = State(env=Env(EphemDB()))
+addr = sha3('owner')[-20:]
+s.set_balance(addr, Balance(IPNetwork('10.0.0.0/8')))
+s.set_balance(sha3('other')[-20:], Balance(IPNetwork('11.0.0.0/8')))
+s.commit()
+b = verify_balance_proof(s.trie.root_hash, addr, s.trie.get_proof(addr))
+if b is None or not b.in_own_ips(IPNetwork('10.1.0.0/16')) or \
+        verify_balance_proof(s.trie.root_hash, sha3('nobody')[-20:], s.trie.get_proof(sha3('nobody')[-20:])) is not None:
+    print("TEST FAILED: wrong balance proof")
+    err = True
+
+if not err:
+    print("TEST PASSED")
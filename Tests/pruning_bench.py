@@ -0,0 +1,66 @@
+import sys
+import time
+import random
+import shutil
+import tempfile
+from netaddr import IPNetwork
+from db import LevelDB
+from config import Env
+from state import State
+from balance import Balance
+from pruning import Pruner
+from compact_db import dir_size
+from utils import sha3
+
+# Replays the same blocks into an archive database and a pruned one, then
+# compacts the archive with a sweep, and reports the database sizes
+# Usage: python pruning_bench.py [accounts] [blocks] [changes per block] [keep]
+ACCOUNTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+BLOCKS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+CHANGES = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+KEEP = int(sys.argv[4]) if len(sys.argv) > 4 else 16
+addrs = [sha3(str(i))[-20:] for i in range(ACCOUNTS)]
+
+
+def replay(path, keep):
+    random.seed(1)
+    db = LevelDB(path)
+    state = State(env=Env(db))
+    for i, addr in enumerate(addrs):
+        state.set_balance(addr, Balance(IPNetwork('10.%d.%d.0/24' % (i >> 8 & 255, i & 255))))
+    state.commit()
+    db.commit()
+    pruner = Pruner(db, keep, 20000) if keep else None
+    start = time.time()
+    roots = []
+    for number in range(1, BLOCKS + 1):
+        parent_root = state.trie.root_hash
+        for addr in random.sample(addrs, CHANGES):
+            state.increment_nonce(addr)
+        state.commit()
+        if pruner:
+            pruner.on_block(number, parent_root, state.trie.root_hash)
+        db.commit()
+        roots.append(state.trie.root_hash)
+    return db, roots, time.time() - start
+
+
+archive_path = tempfile.mkdtemp()
+pruned_path = tempfile.mkdtemp()
+try:
+    print("%d accounts, %d blocks of %d changes, keeping %d blocks" % (ACCOUNTS, BLOCKS, CHANGES, KEEP))
+    archive_db, roots, archive_time = replay(archive_path, 0)
+    archive_db.compact()
+    print("archive: %.1f ms per block, %d bytes" % (1000 * archive_time / BLOCKS, dir_size(archive_path)))
+    pruned_db, _, pruned_time = replay(pruned_path, KEEP)
+    pruned_db.compact()
+    print("pruned:  %.1f ms per block, %d bytes" % (1000 * pruned_time / BLOCKS, dir_size(pruned_path)))
+
+    before = dir_size(archive_path)
+    start = time.time()
+    result = Pruner(archive_db, KEEP).compact(BLOCKS, roots[-KEEP - 1:])
+    print("archive compacted with sweep in %.1f s: %d nodes swept, %d bytes before, %d bytes after" %
+          (time.time() - start, result['swept'], before, dir_size(archive_path)))
+finally:
+    shutil.rmtree(archive_path)
+    shutil.rmtree(pruned_path)
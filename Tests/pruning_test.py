@@ -0,0 +1,131 @@
+import random
+import trie
+from netaddr import IPNetwork
+from db import EphemDB, RefcountDB
+from config import Env
+from state import State
+from balance import Balance
+from pruning import Pruner, removed_nodes, kept_floor
+from utils import sha3
+
+# With pruning, the states of the last KEEP blocks must stay complete while the
+# nodes only used by older states are deleted, and a sweep must keep every node
+# of the given roots. Nodes are read from the database only
+trie.NODE_CACHE_SIZE = 0
+KEEP = 3
+random.seed(3)
+addrs = [sha3(str(i))[-20:] for i in range(400)]
+err = False
+
+
+def node_count(db):
+    return len([k for k in db.db if len(k) == 32])
+
+
+def replay(db, pruner, blocks=40):
+    state = State(env=Env(db))
+    for addr in addrs[:200]:
+        state.set_balance(addr, Balance(IPNetwork('10.0.0.0/24')))
+    state.commit()
+    roots = [state.trie.root_hash]
+    snapshots = [state.to_dict()]
+    for number in range(1, blocks + 1):
+        parent_root = state.trie.root_hash
+        for addr in random.sample(addrs, 30):
+            state.increment_nonce(addr)
+        state.commit()
+        if pruner:
+            pruner.on_block(number, parent_root, state.trie.root_hash)
+        roots.append(state.trie.root_hash)
+        snapshots.append(state.to_dict())
+    return roots, snapshots
+
+
+print("CHECKING KEPT STATES...")
+archive_db = EphemDB()
+random.seed(3)
+replay(archive_db, None)
+pruned_db = EphemDB()
+pruner = Pruner(pruned_db, KEEP, batch_size=100000)
+random.seed(3)
+roots, snapshots = replay(pruned_db, pruner)
+for number in range(len(roots) - KEEP - 1, len(roots)):
+    try:
+        if State(root=roots[number], env=Env(pruned_db)).to_dict() != snapshots[number]:
+            print("TEST FAILED: state of block %d differs" % number)
+            err = True
+    except KeyError:
+        print("TEST FAILED: state of block %d is missing nodes" % number)
+        err = True
+if kept_floor(pruned_db) != len(roots) - KEEP - 1 or kept_floor(archive_db) != 0:
+    print("TEST FAILED: wrong kept floor %d" % kept_floor(pruned_db))
+    err = True
+print("nodes stored: archive %d, pruned %d" % (node_count(archive_db), node_count(pruned_db)))
+if node_count(pruned_db) * 2 > node_count(archive_db):
+    print("TEST FAILED: pruning did not delete the old nodes")
+    err = True
+
+print("CHECKING UNCHANGED VALUES...")
+noop_db = EphemDB()
+noop_pruner = Pruner(noop_db, KEEP, batch_size=100000)
+state = State(env=Env(noop_db))
+for addr in addrs[:200]:
+    state.set_balance(addr, Balance(IPNetwork('10.0.0.0/24')))
+state.commit()
+root = state.trie.root_hash
+refcounts = dict((k, RefcountDB(noop_db).get_refcount(k)) for k in noop_db.db if len(k) == 32)
+for number in range(1, 3 * KEEP):
+    for addr in random.sample(addrs[:200], 20):
+        state.set_balance(addr, state.get_balance(addr, writable=True))
+    state.commit()
+    noop_pruner.on_block(number, root, state.trie.root_hash)
+if state.trie.root_hash != root or \
+        dict((k, RefcountDB(noop_db).get_refcount(k)) for k in noop_db.db if len(k) == 32) != refcounts:
+    print("TEST FAILED: rewriting unchanged values changed the stored nodes")
+    err = True
+
+print("CHECKING REMOVED NODES...")
+if removed_nodes(pruned_db, roots[-1], roots[-1]) != []:
+    print("TEST FAILED: nodes removed between equal roots")
+    err = True
+removed = set(removed_nodes(pruned_db, roots[-2], roots[-1]))
+if not removed or roots[-2] not in removed or roots[-1] in removed:
+    print("TEST FAILED: wrong removed nodes between the last two blocks")
+    err = True
+
+print("CHECKING BATCHES...")
+batch_db = EphemDB()
+batched = Pruner(batch_db, KEEP, batch_size=10)
+random.seed(3)
+roots, snapshots = replay(batch_db, batched)
+if batched.pending() == 0:
+    print("TEST FAILED: small batches released every node")
+    err = True
+if kept_floor(batch_db) >= len(roots) - KEEP - 1:
+    print("TEST FAILED: kept floor above the unreleased death rows")
+    err = True
+result = batched.compact(len(roots) - 1)
+if result['released'] == 0 or batched.pending() > 3 * 200:
+    print("TEST FAILED: compact did not release the due nodes")
+    err = True
+
+print("CHECKING SWEEP...")
+random.seed(3)
+roots, snapshots = replay(archive_db, None)
+sweeper = Pruner(archive_db, KEEP)
+swept = sweeper.sweep(roots[-KEEP - 1:])
+for number in range(len(roots) - KEEP - 1, len(roots)):
+    if State(root=roots[number], env=Env(archive_db)).to_dict() != snapshots[number]:
+        print("TEST FAILED: sweep broke the state of block %d" % number)
+        err = True
+sweeper.compact(len(roots) - 1, roots[-KEEP - 1:])
+if kept_floor(archive_db) != len(roots) - KEEP - 1:
+    print("TEST FAILED: compact with sweep left the kept floor at %d" % kept_floor(archive_db))
+    err = True
+if not swept or node_count(archive_db) > node_count(pruned_db) + 50:
+    print("TEST FAILED: sweep left %d nodes" % node_count(archive_db))
+    err = True
+print("swept %d nodes" % swept)
+
+if not err:
+    print("TEST PASSED")
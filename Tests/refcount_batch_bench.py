@@ -0,0 +1,96 @@
+import sys
+import time
+import random
+from netaddr import IPNetwork
+from db import EphemDB, RefcountDB
+from config import Env
+from state import State
+from balance import Balance
+from trie import Trie
+from securetrie import SecureTrie
+from utils import sha3
+
+# Replays blocks into the head state and into a plain (not deferred) trie, like an
+# account storage trie, where every block writes a few hot keys several times. Counts
+# the reads and writes reaching the database under RefcountDB, with refcount deltas
+# folded at commit and with the former read-modify-write on every put
+# Usage: python refcount_batch_bench.py [accounts] [blocks] [changes per block] [hot keys]
+ACCOUNTS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+BLOCKS = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+CHANGES = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+HOT = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+addrs = [sha3(str(i))[-20:] for i in range(ACCOUNTS)]
+
+
+class CountingDB(EphemDB):
+
+    def __init__(self):
+        super(CountingDB, self).__init__()
+        self.gets = self.puts = self.bytes = 0
+
+    def get(self, key):
+        self.gets += 1
+        return super(CountingDB, self).get(key)
+
+    def put(self, key, value):
+        self.puts += 1
+        self.bytes += len(key) + len(value)
+        super(CountingDB, self).put(key, value)
+
+
+class ImmediateRefcountDB(RefcountDB):
+
+    def put(self, key, value):
+        super(ImmediateRefcountDB, self).put(key, value)
+        self.commit()
+
+    def delete(self, key):
+        super(ImmediateRefcountDB, self).delete(key)
+        self.commit()
+
+
+def replay_state(refcount_class):
+    random.seed(1)
+    db = CountingDB()
+    state = State(env=Env(db))
+    state.trie.db = state.trie.trie.db = refcount_class(db)
+    for i, addr in enumerate(addrs):
+        state.set_balance(addr, Balance(IPNetwork('10.%d.%d.0/24' % (i >> 8 & 255, i & 255))))
+    state.commit()
+    db.gets = db.puts = db.bytes = 0
+    start = time.time()
+    for number in range(BLOCKS):
+        for addr in random.sample(addrs, CHANGES):
+            state.increment_nonce(addr)
+        state.commit()
+    return db, state.trie.root_hash, time.time() - start
+
+
+def replay_plain(refcount_class):
+    random.seed(1)
+    db = CountingDB()
+    t = SecureTrie(Trie(refcount_class(db)))
+    for i in range(ACCOUNTS):
+        t.update(sha3(str(i)), b'x')
+    t.db.commit()
+    db.gets = db.puts = db.bytes = 0
+    start = time.time()
+    for number in range(BLOCKS):
+        for i in range(CHANGES):
+            t.update(sha3(str(random.randrange(HOT))), str(number))
+        t.db.commit()
+    return db, t.root_hash, time.time() - start
+
+
+print("REFCOUNT BATCHING BENCHMARK (%d accounts, %d blocks of %d changes, %d hot keys)" % (ACCOUNTS, BLOCKS, CHANGES, HOT))
+print("%-6s %-10s %12s %12s %14s %10s" % ("trie", "refcounts", "gets/block", "puts/block", "bytes/block", "ms/block"))
+for name, replay in (("state", replay_state), ("plain", replay_plain)):
+    roots = set()
+    for mode, refcount_class in (("immediate", ImmediateRefcountDB), ("batched", RefcountDB)):
+        db, root, elapsed = replay(refcount_class)
+        roots.add(root)
+        print("%-6s %-10s %12.1f %12.1f %14.0f %10.2f" % (name, mode, db.gets / float(BLOCKS), db.puts / float(BLOCKS),
+                                                          db.bytes / float(BLOCKS), 1000 * elapsed / BLOCKS))
+    if len(roots) != 1:
+        print("TEST FAILED: %s roots differ" % name)
+print("BENCHMARK FINISHED")
@@ -0,0 +1,45 @@
+from db import EphemDB, RefcountDB
+
+# Puts and deletes must only reach the database at commit, as one write per key
+# with the summed refcount, while reads before the commit already see them
+err = False
+db = EphemDB()
+r = RefcountDB(db)
+
+print("CHECKING PENDING READS...")
+r.put(b'a', b'va')
+r.put(b'a', b'va')
+r.put(b'b', b'vb')
+r.delete(b'b')
+if db.db or r.get(b'a') != b'va' or r.get_refcount(b'a') != 2 or b'b' in r or r.get_refcount(b'b') != 0:
+    print("TEST FAILED: wrong reads of pending keys")
+    err = True
+try:
+    r.get(b'b')
+    print("TEST FAILED: read of a key put and deleted")
+    err = True
+except KeyError:
+    pass
+
+print("CHECKING COMMIT...")
+r.commit()
+if db.db != {b'a': b'\x00\x00\x00\x02va'}:
+    print("TEST FAILED: wrong stored values %s" % db.db)
+    err = True
+r.delete(b'a')
+r.put(b'a', b'va')
+r.delete(b'a')
+if r.get(b'a') != b'va' or r.get_refcount(b'a') != 1:
+    print("TEST FAILED: wrong read of a released key")
+    err = True
+r.delete(b'a')
+if b'a' in r or db.db[b'a'] != b'\x00\x00\x00\x02va':
+    print("TEST FAILED: delete not pending")
+    err = True
+r.commit()
+if db.db:
+    print("TEST FAILED: key not deleted at zero refcount")
+    err = True
+
+if not err:
+    print("TEST PASSED")
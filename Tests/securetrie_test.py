@@ -0,0 +1,67 @@
+from db import EphemDB, RefcountDB, OverlayDB
+from trie import Trie
+from securetrie import SecureTrie, hash_key
+from utils import sha3
+
+# A preimage must be written once per database, when its key is first inserted, a
+# delete must release the extra references of older preimages without dropping
+# the last one, and tries on databases without refcounts must still delete keys
+err = False
+db = RefcountDB(EphemDB())
+key = b'\x11' * 20
+h = sha3(key)
+
+print("CHECKING HASHED KEYS...")
+if hash_key(key) != h or hash_key(key) != h:
+    print("TEST FAILED: wrong hashed key")
+    err = True
+
+print("CHECKING PREIMAGE WRITES...")
+t1 = SecureTrie(Trie(db))
+for i in range(5):
+    t1.update(key, b'v%d' % i)
+if db.get_refcount(h) != 1 or db.get(h) != key:
+    print("TEST FAILED: preimage refcount %d after updates" % db.get_refcount(h))
+    err = True
+t2 = SecureTrie(Trie(db))
+t2.update(key, b'w')
+if db.get_refcount(h) != 1:
+    print("TEST FAILED: preimage written again by a second trie")
+    err = True
+
+print("CHECKING DELETES...")
+old_root = t1.root_hash
+# Written on every update before
+db.put(h, key)
+db.put(h, key)
+t1.delete(key)
+t1.delete(key)
+if db.get_refcount(h) != 2:
+    print("TEST FAILED: preimage refcount %d after delete" % db.get_refcount(h))
+    err = True
+t2.delete(key)
+t2.delete(key)
+if db.get_refcount(h) != 1:
+    print("TEST FAILED: last preimage reference dropped")
+    err = True
+old = SecureTrie(Trie(db, old_root))
+if old.to_dict() != {key: b'v4'}:
+    print("TEST FAILED: older trie can not be iterated")
+    err = True
+t1.update(key, b'x')
+if db.get_refcount(h) != 1 or t1.get(key) != b'x':
+    print("TEST FAILED: wrong refcount after inserting the key again")
+    err = True
+
+print("CHECKING PLAIN DATABASES...")
+for plain_db in (EphemDB(), OverlayDB(EphemDB())):
+    t = SecureTrie(Trie(plain_db))
+    t.update(key, b'v')
+    t.update(b'\x22' * 20, b'w')
+    t.delete(key)
+    if t.get(key) != b'' or t.to_dict() != {b'\x22' * 20: b'w'}:
+        print("TEST FAILED: delete on %s" % type(plain_db).__name__)
+        err = True
+
+if not err:
+    print("TEST PASSED")
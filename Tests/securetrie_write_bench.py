@@ -0,0 +1,70 @@
+import sys
+import time
+import random
+from netaddr import IPNetwork
+from db import EphemDB
+from config import Env
+from state import State
+from balance import Balance
+from securetrie import SecureTrie
+from utils import sha3
+
+# Replays blocks that keep touching the same hot accounts and counts the database
+# writes, with preimages written once per key and with the former behaviour of
+# writing the preimage on every update
+# Usage: python securetrie_write_bench.py [accounts] [blocks] [hot accounts]
+ACCOUNTS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+BLOCKS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+HOT = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+addrs = [sha3(str(i))[-20:] for i in range(ACCOUNTS)]
+
+
+class CountingDB(EphemDB):
+
+    def __init__(self):
+        super(CountingDB, self).__init__()
+        self.preimage_writes = 0
+        self.node_writes = 0
+
+    def put(self, key, value):
+        if len(value) == 24:
+            self.preimage_writes += 1
+        else:
+            self.node_writes += 1
+        super(CountingDB, self).put(key, value)
+
+
+class EveryUpdateSecureTrie(SecureTrie):
+
+    def update(self, k, v):
+        h = sha3(k)
+        self.db.put(h, k)
+        self.trie.update(h, v)
+
+
+def replay(trie_class):
+    random.seed(1)
+    db = CountingDB()
+    state = State(env=Env(db))
+    state.trie = trie_class(state.trie.trie)
+    for i, addr in enumerate(addrs):
+        state.set_balance(addr, Balance(IPNetwork('10.%d.%d.0/24' % (i >> 8 & 255, i & 255))))
+    state.commit()
+    db.preimage_writes = db.node_writes = 0
+    start = time.time()
+    for number in range(BLOCKS):
+        for addr in addrs[:HOT] + random.sample(addrs, HOT // 10):
+            state.increment_nonce(addr)
+        state.commit()
+    return db, state.trie.root_hash, time.time() - start
+
+
+print("%d accounts, %d blocks touching %d hot accounts" % (ACCOUNTS, BLOCKS, HOT))
+results = []
+for name, trie_class in (("every update", EveryUpdateSecureTrie), ("once per key", SecureTrie)):
+    db, root, elapsed = replay(trie_class)
+    results.append(root)
+    print("%-12s  %6.1f preimage writes, %6.1f node writes per block, %.2f ms per block" %
+          (name, float(db.preimage_writes) / BLOCKS, float(db.node_writes) / BLOCKS, 1000 * elapsed / BLOCKS))
+if results[0] != results[1]:
+    print("roots differ!")
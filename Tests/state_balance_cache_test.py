@@ -0,0 +1,89 @@
+from netaddr import IPNetwork
+from db import EphemDB
+from config import Env
+from state import State
+from balance import Balance, is_legacy_balance
+from utils import object_to_bin
+import state as state_module
+
+add1 = '54450450e24286143a35686ad77a7c851ada01a0'.decode('hex')
+add2 = '00000450e24286143a35686ad77a7c851ada0000'.decode('hex')
+
+# Count how many times balances are decoded
+decodes = [0]
+decode_balance = state_module.decode_balance
+
+
+def counting_decode(data):
+    decodes[0] += 1
+    return decode_balance(data)
+
+
+state_module.decode_balance = counting_decode
+
+s = State(env=Env(EphemDB()))
+s.set_balance(add1, Balance(IPNetwork('10.0.0.0/8')))
+s.commit()
+root = s.trie.root_hash
+err = False
+
+print("CHECKING SHARED READS...")
+decodes[0] = 0
+for i in range(10):
+    s.get_balance(add1)
+    s.get_balance(add2)
+if decodes[0] != 1:  # add1 is still cached from set_balance
+    print("TEST FAILED: %d decodes" % decodes[0])
+    err = True
+
+print("CHECKING COPY ON WRITE...")
+b = s.get_balance(add1, writable=True)
+b.add_own_ips(IPNetwork('11.0.0.0/8'))
+if s.get_balance(add1).in_own_ips(IPNetwork('11.0.0.0/8')):
+    print("TEST FAILED: writable balance is shared")
+    err = True
+
+print("CHECKING REVERT...")
+snapshot = s.snapshot()
+s.set_balance(add1, b)
+s.set_balance(add2, Balance(IPNetwork('12.0.0.0/8')))
+s.revert(snapshot)
+if s.get_balance(add1).in_own_ips(IPNetwork('11.0.0.0/8')) or len(s.get_balance(add2).own_ips) != 0:
+    print("TEST FAILED: revert did not restore the balances")
+    err = True
+s.commit()
+if s.trie.root_hash != root:
+    print("TEST FAILED: reverted balances were committed")
+    err = True
+
+print("CHECKING COMMIT...")
+s.set_balance(add1, b)
+s.commit()
+s2 = State(root=s.trie.root_hash, env=s.env)
+if not s2.get_balance(add1).in_own_ips(IPNetwork('11.0.0.0/8')):
+    print("TEST FAILED: balance not committed")
+    err = True
+
+print("CHECKING LEGACY BALANCES...")
+# Legacy balances are read as they are and only re-encoded when changed
+legacy = State(env=Env(EphemDB()))
+acct = legacy.get_and_cache_account(add1)
+legacy.set_and_journal(acct, 'balance', object_to_bin(Balance(IPNetwork('13.0.0.0/8'))))
+legacy.set_and_journal(acct, 'touched', True)
+legacy.commit()
+s3 = State(root=legacy.trie.root_hash, env=legacy.env)
+if not s3.get_balance(add1).in_own_ips(IPNetwork('13.1.0.0/16')):
+    print("TEST FAILED: legacy balance not readable")
+    err = True
+s3.commit()
+if s3.trie.root_hash != legacy.trie.root_hash:
+    print("TEST FAILED: reading a legacy balance changed the state root")
+    err = True
+s3.set_balance(add1, s3.get_balance(add1, writable=True))
+s3.commit()
+if is_legacy_balance(State(root=s3.trie.root_hash, env=s3.env).get_and_cache_account(add1).balance):
+    print("TEST FAILED: changed balance kept the legacy encoding")
+    err = True
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,68 @@
+from netaddr import IPNetwork
+from db import EphemDB
+from config import Env
+from state import State
+from balance import Balance
+from utils import sha3
+
+# A cloned state must see its parent, including uncommitted changes, and
+# must not leak its own changes back into the parent until it is adopted
+addrs = [sha3(str(i))[-20:] for i in range(3)]
+err = False
+
+parent = State(env=Env(EphemDB()))
+parent.set_balance(addrs[0], Balance(IPNetwork('10.0.0.0/8')))
+parent.commit()
+root = parent.trie.root_hash
+parent.set_balance(addrs[1], Balance(IPNetwork('11.0.0.0/8')))
+parent.increment_nonce(addrs[1])
+
+print("CHECKING READS FROM THE PARENT...")
+child = parent.clone()
+if not child.get_balance(addrs[0]).in_own_ips(IPNetwork('10.1.0.0/16')) or \
+        not child.get_balance(addrs[1]).in_own_ips(IPNetwork('11.1.0.0/16')) or child.get_nonce(addrs[1]) != 1:
+    print("TEST FAILED: child does not see the parent state")
+    err = True
+
+print("CHECKING ISOLATION...")
+b = child.get_balance(addrs[0], writable=True)
+b.remove_own_ips(IPNetwork('10.1.0.0/16'))
+child.set_balance(addrs[0], b)
+child.set_balance(addrs[2], Balance(IPNetwork('10.1.0.0/16')))
+child.increment_nonce(addrs[1])
+child.commit()
+if not parent.get_balance(addrs[0]).in_own_ips(IPNetwork('10.1.0.0/16')) or parent.get_nonce(addrs[1]) != 1 or \
+        len(parent.get_balance(addrs[2]).own_ips) != 0 or parent.trie.root_hash != root:
+    print("TEST FAILED: child changes reached the parent")
+    err = True
+
+print("CHECKING CHILD ROOT...")
+parent.set_balance(addrs[0], b.copy())
+parent.set_balance(addrs[2], Balance(IPNetwork('10.1.0.0/16')))
+parent.increment_nonce(addrs[1])
+parent.commit()
+if parent.trie.root_hash != child.trie.root_hash:
+    print("TEST FAILED: child and parent roots differ")
+    err = True
+
+print("CHECKING ADOPTION...")
+child = parent.clone()
+child.set_balance(addrs[1], Balance(IPNetwork('11.0.0.0/9')))
+child.increment_nonce(addrs[2])
+child.commit()
+if not parent.can_adopt(child):
+    print("TEST FAILED: committed child cannot be adopted")
+    err = True
+parent.adopt(child)
+fresh = State(root=child.trie.root_hash, env=parent.env)
+if parent.trie.root_hash != child.trie.root_hash or parent.get_nonce(addrs[2]) != 1 or \
+        parent.get_balance(addrs[1]).in_own_ips(IPNetwork('11.128.0.0/9')) or \
+        fresh.get_balance(addrs[1]) != parent.get_balance(addrs[1]):
+    print("TEST FAILED: adopted state differs from the child")
+    err = True
+if not parent.can_adopt(parent.clone()) or parent.can_adopt(child):
+    print("TEST FAILED: stale child accepted")
+    err = True
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,56 @@
+import random
+from db import EphemDB, RefcountDB
+from trie import Trie, BLANK_NODE
+from utils import sha3
+
+# A deferred trie must give the same roots as a plain one for any mix of updates
+# and deletes, and only write the nodes that end up in the trie
+random.seed(1)
+keys = [sha3(str(i))[:random.choice([1, 2, 20, 32])] for i in range(3000)]
+err = False
+
+plain_db = EphemDB()
+deferred_db = EphemDB()
+plain = Trie(RefcountDB(plain_db))
+deferred = Trie(RefcountDB(deferred_db), deferred=True)
+expected = {}
+
+print("CHECKING ROOTS...")
+for block in range(30):
+    for i in range(200):
+        key = random.choice(keys)
+        if random.random() < 0.3:
+            plain.delete(key)
+            deferred.delete(key)
+            expected.pop(key, None)
+        else:
+            value = sha3(str(random.random()))[:random.randint(1, 40)]
+            plain.update(key, value)
+            deferred.update(key, value)
+            expected[key] = value
+    probe = random.choice(keys)
+    if deferred.get(probe) != expected.get(probe, BLANK_NODE):
+        print("TEST FAILED: wrong read before commit")
+        err = True
+    deferred.commit()
+    if plain.root_hash != deferred.root_hash:
+        print("TEST FAILED: roots differ after block %d" % block)
+        err = True
+        break
+
+print("CHECKING STORED NODES...")
+plain.db.commit()
+deferred.db.commit()
+reopened = Trie(RefcountDB(deferred_db))
+reopened.node_cache = None
+reopened.root_hash = deferred.root_hash
+if reopened.to_dict() != expected:
+    print("TEST FAILED: committed trie differs from the expected contents")
+    err = True
+if len(deferred_db.db) >= len(plain_db.db):
+    print("TEST FAILED: deferred trie wrote %d nodes, plain one %d" % (len(deferred_db.db), len(plain_db.db)))
+    err = True
+print("nodes written: plain %d, deferred %d" % (len(plain_db.db), len(deferred_db.db)))
+
+if not err:
+    print("TEST PASSED")
@@ -0,0 +1,60 @@
+import random
+from db import EphemDB
+from trie import Trie, TrieCursor
+from securetrie import SecureTrie
+from utils import sha3
+
+# Bounded iteration and cursors must return the same items as sorting the whole trie
+random.seed(1)
+err = False
+db = EphemDB()
+t = Trie(db)
+expected = {}
+for i in range(2000):
+    key = sha3(str(i))[:random.choice([1, 2, 3, 8])]
+    expected[key] = sha3(key)[:random.randint(1, 40)]
+    t.update(key, expected[key])
+items = sorted(expected.items())
+
+print("CHECKING FULL ITERATION...")
+if list(t.iter_items()) != items or t.to_dict() != expected or sorted(t) != sorted(expected):
+    print("TEST FAILED: full iteration differs")
+    err = True
+
+print("CHECKING BOUNDS...")
+for _ in range(200):
+    start, end = sorted(sha3(str(random.random()))[:random.randint(1, 3)] for _ in range(2))
+    prefix = random.choice([None, start[:1], start[:2]])
+    want = [(k, v) for k, v in items if start <= k < end and (prefix is None or k.startswith(prefix))]
+    if list(t.iter_items(start, end, prefix)) != want:
+        print("TEST FAILED: wrong items for %r %r %r" % (start, end, prefix))
+        err = True
+        break
+
+print("CHECKING CURSOR...")
+cursor = TrieCursor(t, start=items[10][0])
+got = cursor.next_batch(100)
+position = cursor.position
+# Resume on another trie object from the saved position
+cursor = TrieCursor(Trie(db, t.root_hash), start=position)
+while not cursor.done:
+    got += cursor.next_batch(333)
+if got != items[10:]:
+    print("TEST FAILED: cursor skipped or repeated items")
+    err = True
+
+print("CHECKING SECURE TRIE CURSOR...")
+st = SecureTrie(Trie(EphemDB()))
+addrs = dict((sha3(str(i))[-20:], str(i)) for i in range(500))
+for k, v in addrs.items():
+    st.update(k, v)
+cursor = st.cursor()
+got = []
+while not cursor.done:
+    got += cursor.next_batch(64)
+if dict(got) != addrs or len(got) != len(addrs):
+    print("TEST FAILED: secure trie cursor differs")
+    err = True
+
+if not err:
+    print("TEST PASSED")
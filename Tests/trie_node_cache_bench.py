@@ -0,0 +1,49 @@
+import sys
+import time
+import random
+import rlp
+from db import EphemDB, RefcountDB
+from trie import Trie, NODE_CACHE_SIZE
+from securetrie import SecureTrie
+from lru import LRUCache
+from utils import sha3
+
+# Random account reads on the account trie, with and without the decoded node cache.
+# Usage: python trie_node_cache_bench.py [accounts ...]
+SIZES = [int(x) for x in sys.argv[1:]] or [100000, 1000000]
+READS = 20000
+
+random.seed(1)
+
+
+def timed_reads(t, addrs):
+    start = time.time()
+    for addr in addrs:
+        t.get(addr)
+    return (time.time() - start) / len(addrs) * 1e6
+
+
+print("TRIE NODE CACHE BENCHMARK (cache size %d nodes)" % NODE_CACHE_SIZE)
+print("%8s %-12s %10s %10s %8s" % ("accounts", "cache", "read", "hits", "misses"))
+for size in SIZES:
+    db = EphemDB()
+    t = SecureTrie(Trie(RefcountDB(db)))
+    addrs = [sha3(str(i))[-20:] for i in range(size)]
+    for i, addr in enumerate(addrs):
+        t.update(addr, rlp.encode([i, b'\x00' * 40]))
+    root = t.root_hash
+    t.db.commit()
+    reads = [random.choice(addrs) for _ in range(READS)]
+
+    t = SecureTrie(Trie(RefcountDB(db), root))
+    t.trie.node_cache = None
+    print("%8d %-12s %8.2fus %10s %8s" % (size, "none", timed_reads(t, reads), "-", "-"))
+    for name in ("cold", "warm"):
+        if name == "cold":
+            db.node_cache = LRUCache(NODE_CACHE_SIZE)
+        t = SecureTrie(Trie(RefcountDB(db), root))
+        cache = t.trie.node_cache
+        hits, misses = cache.hits, cache.misses
+        us = timed_reads(t, reads)
+        print("%8d %-12s %8.2fus %10d %8d" % (size, name, us, cache.hits - hits, cache.misses - misses))
+print("BENCHMARK FINISHED")
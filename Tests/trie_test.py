@@ -1,37 +1,70 @@
-import leveldb
-from trie import Trie
-from Crypto.Hash import keccak
+import sys
+import time
 import random
 import string
 import utils
+from trie import Trie, build_root
 from db import _EphemDB
 
-N = 50000
+# Checks the values and root of a trie after many updates and deletes, timing
+# each kind of operation. The printed root only depends on N, so runs of
+# different trie versions can be compared
+# Usage: python trie_test.py [N]
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+random.seed(1)
 print("TEST STARTING")
 DataBase = _EphemDB()
 t = Trie(DataBase)
 tempDB = {}
+fail = 0
+values = [''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(20)) for i in range(N)]
+# Short keys too, so that extension nodes and branch values get exercised
+keys = [utils.sha3(value)[:random.choice([1, 2, 3, 8, 32, 32, 32, 32])] for value in values]
 
 
-print("ADDING SOME NODES...")
-for i in range(N):
-    value = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(20))
-    key = utils.sha3(value);
-    tempDB[key] = value
-    t.update(str(key), str(value))
-    if(i%10000 == 0):
-        print("...")
-fail = 0
-print("ADDITION FINISHED")
+def timed(name, count, f):
+    start = time.time()
+    f()
+    elapsed = time.time() - start
+    print("%-8s %8d ops/s" % (name, count / elapsed))
 
-print("CHECKING VALUES...")
-cont = 0
-for i in tempDB.keys():
-    if (t.get(i) != tempDB[i]):
+
+def add():
+    for key, value in zip(keys, values):
+        tempDB[key] = value
+        t.update(key, value)
+
+
+def check():
+    global fail
+    for key in tempDB:
+        if t.get(key) != tempDB[key]:
+            fail = 1
+
+
+def remove():
+    for key in keys[::2]:
+        tempDB.pop(key, None)
+        t.delete(key)
+
+
+def iterate():
+    global fail
+    if t.to_dict() != tempDB:
         fail = 1
-    cont += 1
-    if(cont%10000 == 0):
-        print("...")
+
+
+print("ADDING SOME NODES...")
+timed("update", N, add)
+print("CHECKING VALUES...")
+timed("get", len(tempDB), check)
+print("DELETING HALF OF THEM...")
+timed("delete", len(keys[::2]), remove)
+timed("get", len(tempDB), check)
+timed("iterate", len(tempDB), iterate)
+print("root %s" % utils.encode_hex(t.root_hash))
+if t.root_hash != build_root(sorted(tempDB.items())):
+    fail = 1
 if fail:
     print ("TEST FAILED")
 else:
@@ -2,10 +2,9 @@ import rlp
 from rlp.sedes import big_endian_int, binary
 from securetrie import SecureTrie
 from trie import Trie
-from db import RefcountDB, BaseDB
-from balance import Balance
-from netaddr import IPSet
-from utils import object_to_bin
+from db import RefcountDB, BaseDB, instrument_layer
+from balance import Balance, encode_balance
+from rlp.utils import encode_hex
 import utils
 
 
@@ -13,6 +12,7 @@ import utils
 
 BLANK_HASH = utils.sha3(b'')
 BLANK_ROOT = utils.sha3rlp(b'')
+BLANK_BALANCE = encode_balance(Balance())
 
 class Account(rlp.Serializable):
     fields = [
@@ -26,7 +26,7 @@ class Account(rlp.Serializable):
         self.address = address
         super(Account, self).__init__(nonce, balance)
         self.storage_cache = {}
-        self.storage_trie = SecureTrie(Trie(RefcountDB(self.env.db)))
+        self.storage_trie = SecureTrie(Trie(instrument_layer(RefcountDB(self.env.db), self.env.db, 'refcount')))
         self.touched = False
         self.existent_at_start = True
         self._mutable = True
@@ -41,6 +41,14 @@ class Account(rlp.Serializable):
                 self.storage_trie.delete(utils.encode_int32(k))
         self.storage_cache = {}
         self.storage = self.storage_trie.root_hash
+        self.storage_trie.db.commit()
+
+    def copy(self, env):
+        o = Account(self.nonce, self.balance, env, self.address)
+        o.touched = self.touched
+        o.existent_at_start = self.existent_at_start
+        o.deleted = self.deleted
+        return o
 
     @property
     def code(self):
@@ -49,8 +57,7 @@ class Account(rlp.Serializable):
     @classmethod
     def blank_account(cls, env, address, initial_nonce=0):
         env.db.put(BLANK_HASH, b'')
-        balance = Balance(IPSet())
-        o = cls(initial_nonce, object_to_bin(balance), env, address)
+        o = cls(initial_nonce, BLANK_BALANCE, env, address)
         o.existent_at_start = False
         return o
 
@@ -68,4 +75,4 @@ class Account(rlp.Serializable):
         odict = self.storage_trie.to_dict()
         for k, v in self.storage_cache.items():
             odict[utils.encode_int(k)] = rlp.encode(utils.encode_int(v))
-        return {'balance': str(self.balance), 'nonce': str(self.nonce)}
\ No newline at end of file
+        return {'balance': '0x' + encode_hex(self.balance), 'nonce': str(self.nonce)}
\ No newline at end of file
@@ -2,7 +2,6 @@ from own_exceptions import UnsignedTransaction, InvalidNonce, InsufficientBalanc
     InvalidCategory, InvalidBlockSigner, UnsignedBlock
 import trie
 from rlp.utils import encode_hex
-from db import EphemDB
 import rlp
 from netaddr import IPAddress
 from utils import normalize_address
@@ -101,8 +100,21 @@ def validate_transaction(state, tx):
     return True
 
 
-# Applies the transaction to the state
-def apply_transaction(state, tx, cached):
+# Applies the transaction to the state. A failed transaction is rolled back. With
+# commit=False the changes stay in the state cache until the caller commits the state
+def apply_transaction(state, tx, cached, commit=True):
+    snapshot = state.snapshot()
+    try:
+        _apply_transaction(state, tx, cached)
+    except Exception:
+        state.revert(snapshot)
+        raise
+    if commit:
+        state.commit()
+    return True
+
+
+def _apply_transaction(state, tx, cached):
     validate_transaction(state, tx)
     category = tx.category
     if category == 0:  # allocate
@@ -111,16 +123,16 @@ def apply_transaction(state, tx, cached):
         value = tx.ip_network
         cached[str(value)] = normalize_address(to)
 
-        sender_balance = state.get_balance(sender)
+        sender_balance = state.get_balance(sender, writable=True)
 
         affected = sender_balance.affected_delegated_ips(value)
         for add, ips in affected.iteritems():
             sender_balance.remove_delegated_ips(add, ips)
-            received_balance = state.get_balance(add)
+            received_balance = state.get_balance(add, writable=True)
             received_balance.remove_received_ips(sender, ips)
             state.set_balance(add, received_balance)
 
-        to_balance = state.get_balance(to)
+        to_balance = state.get_balance(to, writable=True)
         sender_balance.remove_own_ips(value)
         to_balance.add_own_ips(value)
 
@@ -134,16 +146,16 @@ def apply_transaction(state, tx, cached):
         to = tx.to
         value = tx.ip_network
         cached[str(value)] = normalize_address(to)
-        sender_balance = state.get_balance(sender)
+        sender_balance = state.get_balance(sender, writable=True)
 
         affected = sender_balance.affected_delegated_ips(value)
         for add, ips in affected.iteritems():
             sender_balance.remove_delegated_ips(add, ips)
-            received_balance = state.get_balance(add)
+            received_balance = state.get_balance(add, writable=True)
             received_balance.remove_received_ips(sender, ips)
             state.set_balance(add, received_balance)
 
-        to_balance = state.get_balance(to)
+        to_balance = state.get_balance(to, writable=True)
         to_balance.add_received_ips(sender, value)
         sender_balance.add_delegated_ips(to, value)
 
@@ -155,7 +167,7 @@ def apply_transaction(state, tx, cached):
         sender = tx.sender
         value = tx.metadata
 
-        sender_balance = state.get_balance(sender)
+        sender_balance = state.get_balance(sender, writable=True)
         sender_balance.set_map_server(value)
         state.set_balance(sender, sender_balance)
         state.increment_nonce(sender)
@@ -163,12 +175,10 @@ def apply_transaction(state, tx, cached):
     elif category == 3:  # Locator
         sender = tx.sender
         value = tx.metadata
-        sender_balance = state.get_balance(sender)
+        sender_balance = state.get_balance(sender, writable=True)
         sender_balance.set_locator(value)
         state.set_balance(sender, sender_balance)
         state.increment_nonce(sender)
-    state.commit()
-    return True
 
 
 # Update block variables into the state
@@ -180,19 +190,17 @@ def update_block_env_variables(state, block):
 
 # Make the root of a receipt tree
 def mk_transaction_sha(receipts):
-    t = trie.Trie(EphemDB())
-    for i, receipt in enumerate(receipts):
-        t.update(rlp.encode(i), rlp.encode(receipt))
-    return t.root_hash
+    return trie.build_root(sorted((rlp.encode(i), rlp.encode(receipt)) for i, receipt in enumerate(receipts)))
 
 
 # Validate that the transaction list root is correct
 def validate_transaction_tree(state, block):
-    if block.header.tx_root != mk_transaction_sha(block.transactions):
-        databaseLog.debug("Transaction root mismatch: header %s computed %s, %d transactions",(encode_hex(str(block.header.tx_root)), encode_hex(str(mk_transaction_sha(block.transactions))),len(block.transactions)))
+    tx_root = mk_transaction_sha(block.transactions)
+    if block.header.tx_root != tx_root:
+        databaseLog.debug("Transaction root mismatch: header %s computed %s, %d transactions",(encode_hex(str(block.header.tx_root)), encode_hex(str(tx_root)),len(block.transactions)))
         raise ValueError("Transaction root mismatch: header %s computed %s, %d transactions" %
                          (
-                         encode_hex(str(block.header.tx_root)), encode_hex(str(mk_transaction_sha(block.transactions))),
+                         encode_hex(str(block.header.tx_root)), encode_hex(str(tx_root)),
                          len(block.transactions)))
     return True
 
@@ -246,7 +254,7 @@ def apply_block(state, block, patricia):
         count = 0
         cached = {}  # cached = cached changes in balances, to be added later in the patricia
         for tx in block.transactions:
-            apply_transaction(state, tx, cached)
+            apply_transaction(state, tx, cached, commit=False)
             #if normalize_address(tx.sender) in addresses:
                 #tx_time = datetime.datetime.fromtimestamp(tx.time)
                 #block_time = datetime.datetime.fromtimestamp(block.header.timestamp)
@@ -255,6 +263,8 @@ def apply_block(state, block, patricia):
             tx.hash.encode("HEX"), block.header.timestamp - tx.time)
             count = count + 1
         databaseLog.debug("Total TX processed: %s", count)
+        # The trie is only updated once per block
+        state.commit()
 
         # Post-finalize (ie. add the block header to the state for now)
         state.add_block_header(block.header)
@@ -267,3 +277,17 @@ def apply_block(state, block, patricia):
         state.revert(snapshot)
         raise e
     return state
+
+
+# Makes poststate, a committed clone of state with the block's transactions applied,
+# the new state instead of applying the block again
+def adopt_block(state, block, patricia, poststate, cached):
+    assert validate_header(state, block.header)
+    assert validate_transaction_tree(state, block)
+    if poststate.trie.root_hash != block.header.state_root:
+        raise ValueError("Post-state root does not match block state root")
+    state.adopt(poststate)
+    state.add_block_header(block.header)
+    for key in cached:
+        patricia.set_value(key, cached[key])
+    return state
@@ -1,27 +1,124 @@
 import rlp
-from netaddr import IPNetwork, IPSet
+from rlp.sedes import big_endian_int, raw
+from netaddr import IPNetwork
+from prefixset import PrefixSet, PrefixMap
 from utils import address, normalize_address
-from utils import bytes_to_int, ipaddr_to_netaddr
+from utils import bytes_to_int, ipaddr_to_netaddr, prefix_to_bin, bin_to_prefix, big_endian_to_int
+from utils import pack_prefix, unpack_interval
+import utils
+
+# Version of the binary encoding stored in Account.balance
+BALANCE_CODEC_VERSION = 1
+
+
+def _prefix_sort_key(packed):
+    # IPv4 prefixes (5 bytes) before IPv6 ones (17 bytes), then by address and length
+    return (len(packed), packed)
+
+
+class PrefixSetSedes(object):
+    """PrefixSet <-> sorted list of packed CIDRs"""
+
+    def serialize(self, obj):
+        if type(obj) is not PrefixSet:
+            obj = PrefixSet(obj)
+        # cidr_tuples() is already sorted by version and address
+        return [pack_prefix(version, network, prefixlen) for version, network, prefixlen in obj.cidr_tuples()]
+
+    def deserialize(self, serial):
+        return PrefixSet.from_intervals(unpack_interval(p) for p in serial)
+
+
+class PrefixSetMapSedes(object):
+    """{address: PrefixSet} <-> list of [address, prefixes] sorted by address"""
+
+    def serialize(self, obj):
+        return [[addr, prefix_set.serialize(obj[addr])] for addr in sorted(obj.keys())]
+
+    def deserialize(self, serial):
+        return {addr: prefix_set.deserialize(prefixes) for addr, prefixes in serial}
+
+
+class MapServerSedes(object):
+    """{IPNetwork: address} <-> list of [prefix, address] sorted by prefix"""
+
+    def serialize(self, obj):
+        items = [(prefix_to_bin(ip), addr) for ip, addr in obj.items()]
+        return [[ip, addr] for ip, addr in sorted(items, key=lambda x: _prefix_sort_key(x[0]))]
+
+    def deserialize(self, serial):
+        return {bin_to_prefix(ip): addr for ip, addr in serial}
+
+
+class LocatorSedes(object):
+    """{IPNetwork: [priority, weight]} <-> list of [prefix, priority, weight] sorted by prefix"""
+
+    def serialize(self, obj):
+        items = [(prefix_to_bin(ip), l) for ip, l in obj.items()]
+        return [[ip, big_endian_int.serialize(l[0]), big_endian_int.serialize(l[1])]
+                for ip, l in sorted(items, key=lambda x: _prefix_sort_key(x[0]))]
+
+    def deserialize(self, serial):
+        return {bin_to_prefix(ip): [big_endian_int.deserialize(priority), big_endian_int.deserialize(weight)]
+                for ip, priority, weight in serial}
+
+
+def _prefix_set_map(m):
+    if m is None:
+        return {}
+    return {addr: ips if type(ips) is PrefixSet else PrefixSet(ips) for addr, ips in m.items()}
+
+
+prefix_set = PrefixSetSedes()
+prefix_set_map = PrefixSetMapSedes()
+map_server_map = MapServerSedes()
+locator_map = LocatorSedes()
 
 
 class Balance(rlp.Serializable):
     fields = [
-        ('own_ips', IPSet),
-        ('delegated_ips', {address, IPSet}),
-        ('received_ips', {address, IPSet}),
-        ('map_server', {IPNetwork, address}),
-        ('locator', {IPNetwork, list})
+        ('own_ips', prefix_set),
+        ('delegated_ips', prefix_set_map),
+        ('received_ips', prefix_set_map),
+        ('map_server', map_server_map),
+        ('locator', locator_map)
     ]
 
-    def __init__(self, own_ips=IPSet(), delegated_ips={}, received_ips={}, map_server={}, locator={}):
-        if (type(own_ips) is not IPSet):
-            own_ips = IPSet(own_ips)
+    def __init__(self, own_ips=None, delegated_ips=None, received_ips=None, map_server=None, locator=None):
+        if own_ips is None:
+            own_ips = PrefixSet()
+        elif (type(own_ips) is not PrefixSet):
+            own_ips = PrefixSet(own_ips)
         self.own_ips = own_ips
-        self.delegated_ips = delegated_ips
-        self.received_ips = received_ips
-        self.map_server = map_server
-        self.locator = locator
-        super(Balance, self).__init__(own_ips, delegated_ips, received_ips, map_server, locator)
+        self.delegated_ips = _prefix_set_map(delegated_ips)
+        self.received_ips = _prefix_set_map(received_ips)
+        self.map_server = map_server if map_server is not None else {}
+        self.locator = locator if locator is not None else {}
+        super(Balance, self).__init__(self.own_ips, self.delegated_ips, self.received_ips,
+                                      self.map_server, self.locator)
+        # Reverse index of delegated_ips (prefix -> delegatee), built on first use.
+        # False when the delegations overlap and it cannot be kept
+        self._delegation_index = None
+
+    def copy(self):
+        # IP sets are copied, map server and locator dicts are always replaced as a whole
+        o = Balance(self.own_ips.copy(),
+                    {addr: ips.copy() for addr, ips in self.delegated_ips.items()},
+                    {addr: ips.copy() for addr, ips in self.received_ips.items()},
+                    dict(self.map_server), dict(self.locator))
+        if isinstance(self._delegation_index, PrefixMap):
+            o._delegation_index = self._delegation_index.copy()
+        else:
+            o._delegation_index = self._delegation_index
+        return o
+
+    def delegation_index(self):
+        if self._delegation_index is None:
+            index = PrefixMap.from_intervals((version, first, last, addr)
+                                             for addr, ips in self.delegated_ips.items()
+                                             for version, first, last in ips.iter_intervals())
+            self._delegation_index = index if index is not None else False
+        return self._delegation_index
 
     def add_own_ips(self, ips):
         self.own_ips.add(ips)
@@ -34,12 +131,21 @@ class Balance(rlp.Serializable):
         if n_address in self.delegated_ips.keys():
             self.delegated_ips[n_address].add(ips)
         else:
-            self.delegated_ips[n_address] = IPSet(ips)
+            self.delegated_ips[n_address] = PrefixSet(ips)
+        index = self._delegation_index
+        if isinstance(index, PrefixMap):
+            if any(addr != n_address for _, _, _, addr in index.overlapping(ips)):
+                # Delegated to two addresses at once, rebuilt (and given up) on next use
+                self._delegation_index = None
+            else:
+                index.set(ips, n_address)
 
     def remove_delegated_ips(self, address, ips):
         n_address = normalize_address(address)
-        self.delegated_ips[n_address] = self.delegated_ips[n_address] - ips
-        if len(self.delegated_ips[n_address]) == 0:
+        self.delegated_ips[n_address].remove(ips)
+        if isinstance(self._delegation_index, PrefixMap):
+            self._delegation_index.remove(ips, n_address)
+        if not self.delegated_ips[n_address]:
             self.delegated_ips.pop(n_address)
 
     def add_received_ips(self, address, ips):
@@ -47,29 +153,37 @@ class Balance(rlp.Serializable):
         if n_address in self.received_ips.keys():
             self.received_ips[n_address].add(ips)
         else:
-            self.received_ips[n_address] = IPSet(ips)
+            self.received_ips[n_address] = PrefixSet(ips)
 
     def remove_received_ips(self, address, ips):
         n_address = normalize_address(address)
-        self.received_ips[n_address] = self.received_ips[n_address] - ips
-        if len(self.received_ips[n_address]) == 0:
+        self.received_ips[n_address].remove(ips)
+        if not self.received_ips[n_address]:
             self.received_ips.pop(n_address)
 
     def in_own_ips(self, ips):
-        return self.own_ips.__contains__(ips)
+        return ips in self.own_ips
 
     def affected_delegated_ips(self, ips):
-        ips = IPSet(ips)
+        index = self.delegation_index()
         addresses = {}
-        for addr, set in self.delegated_ips.iteritems():
-            joint = ips & set
-            if len(joint) > 0:
-                addresses[addr.encode('HEX')] = joint
+        if index is False:
+            ips = PrefixSet(ips)
+            for addr, set in self.delegated_ips.iteritems():
+                joint = ips & set
+                if joint:
+                    addresses[addr.encode('HEX')] = joint
+            return addresses
+        intervals = {}
+        for version, first, last, addr in index.overlapping(ips):
+            intervals.setdefault(addr, []).append((version, first, last))
+        for addr, joint in intervals.items():
+            addresses[addr.encode('HEX')] = PrefixSet.from_intervals(joint)
         return addresses
 
     def in_received_ips(self, ips):
         for set in self.received_ips.itervalues():
-            if set.__contains__(ips):
+            if ips in set:
                 return True
         return False
 
@@ -100,3 +214,26 @@ class Balance(rlp.Serializable):
 
     def get_locator(self):
         return self.locator
+
+
+# Balances are stored in Account.balance as rlp([version, own, delegated, received, map_server, locator]).
+# Older databases hold a hex encoded pickle instead, which is still accepted on read.
+def encode_balance(balance):
+    return rlp.encode([utils.encode_int(BALANCE_CODEC_VERSION)] + Balance.serialize(balance), sedes=raw)
+
+
+def decode_balance(data):
+    if is_legacy_balance(data):
+        legacy = utils.bin_to_object(data)
+        return Balance(legacy.own_ips, legacy.delegated_ips, legacy.received_ips,
+                       legacy.map_server, legacy.locator)
+    serial = rlp.decode(data)
+    version = big_endian_to_int(serial[0])
+    if version != BALANCE_CODEC_VERSION:
+        raise ValueError("Unknown balance encoding version %d" % version)
+    return Balance.deserialize(serial[1:], mutable=True)
+
+
+def is_legacy_balance(data):
+    # hex(pickle protocol 2) always starts with '8002', RLP lists start with a byte >= 0xc0
+    return data[:4] == b'8002'
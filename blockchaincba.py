@@ -3,10 +3,10 @@
 import sys
 import ConfigParser
 import time, os, glob, errno, hashlib, psutil
-from netaddr import IPSet
+from prefixset import PrefixSet
 
 from config import Env
-from db import LevelDB
+from db import open_db
 from chain_service import ChainService
 from keystore import Keystore
 import consensus as cons
@@ -56,7 +56,7 @@ def check_old_processes_running():
         sys.exit(0)
 
 def init_chain():
-    db = LevelDB("./chain")
+    db = open_db("./chain", write_behind=True, instrument=True)
     env = Env(db)
     return ChainService(env)
 
@@ -168,9 +168,9 @@ def run():
     
     my_dkgIDs = []
     
-    myIPs = IPSet()
+    myIPs = PrefixSet()
     for i in range(len(keys)):
-        myIPs.update(chain.get_own_ips(keys[i].address))
+        myIPs.add(chain.get_own_ips(keys[i].address))
     mainLog.info("Own IPs at startup are: %s", myIPs)
     
     dkg_group = chain.get_current_dkg_group()
@@ -1,15 +1,22 @@
 import json
 import time
 import itertools
-from utils import big_endian_to_int
+from utils import big_endian_to_int, normalize_address
 import rlp
 from rlp.utils import encode_hex
 from config import Env
 from state import State, dict_to_prev_header
 from block import Block, BlockHeader, FakeHeader, UnsignedBlock
 from genesis_helpers import state_from_genesis_declaration, initialize, initialize_genesis_keys
-from apply import apply_block, update_block_env_variables, validate_block, validate_transaction, verify_block_signature
+from apply import apply_block, adopt_block, update_block_env_variables, validate_block, validate_transaction, verify_block_signature
 from patricia_state import PatriciaState
+from lru import LRUCache
+from prefixset import PrefixMap
+from balance import decode_balance
+from pruning import Pruner, kept_floor
+from trie import Trie
+from db import EphemDB, InstrumentedDB
+from netaddr import IPNetwork
 import logging
 
 databaseLog = logging.getLogger('Database')
@@ -20,8 +27,25 @@ class Chain(object):
     def __init__(self, genesis=None, env=None,
                  new_head_cb=None, reset_genesis=False, localtime=None, max_history=1000, **kwargs):
         self.env = env or Env()
+        # Read only post-states and prev_headers lists, by block hash. The post-states are
+        # weighed by their decoded accounts
+        self.state_cache = LRUCache(self.env.config['POSTSTATE_CACHE_ACCOUNTS'],
+                                    weigh=lambda blockhash, state: 1 + len(state.cache),
+                                    max_entries=self.env.config['POSTSTATE_CACHE_SIZE'])
+        self.prev_headers_cache = LRUCache(self.env.config['PREV_HEADERS_CACHE_SIZE'])
+        # Own ips of every account of a post-state as a PrefixMap, by block hash, weighed
+        # by their intervals
+        self.owner_index_cache = LRUCache(self.env.config['POSTSTATE_CACHE_ACCOUNTS'],
+                                          weigh=lambda blockhash, index: 1 + len(index),
+                                          max_entries=self.env.config['POSTSTATE_CACHE_SIZE'])
+        # Decoded blocks by hash, immutable. The head one is pinned as (hash, block)
+        self.block_cache = LRUCache(self.env.config['BLOCK_CACHE_SIZE'])
+        self.shared_blocks = self.env.config['SHARED_BLOCKS']
+        self.head_block = None
+        keep_blocks = self.env.config['PRUNE_KEEP_BLOCKS']
+        self.pruner = Pruner(self.env.db, keep_blocks, self.env.config['PRUNE_BATCH_SIZE']) if keep_blocks else None
         self.patricia = PatriciaState()
-        self.patricia.from_db()  # TODO: test
+        self.patricia.from_db(self.env.db)
         # Initialize the state
         if 'head_hash' in self.db:  # new head tag
             self.state = self.mk_poststate_of_blockhash(self.db.get('head_hash'))
@@ -42,9 +66,14 @@ class Chain(object):
 
             for key in diction:
                 self.patricia.set_value(str(key), str(diction[key]))
-            self.patricia.to_db()
+            self.patricia.to_db(self.env.db)
             reset_genesis = True
         assert self.env.db == self.state.db
+        self.state.executing_on_head = True
+        if not self.state.address_index_valid():
+            databaseLog.info('Address index out of date, rebuilding it from the head state')
+            databaseLog.info('Address index rebuilt, %d accounts', self.state.rebuild_address_index())
+            self.db.commit()
 
         initialize(self.state)
         self.new_head_cb = new_head_cb
@@ -75,49 +104,162 @@ class Chain(object):
     # Head (tip) of the chain
     @property
     def head(self):
-        try:
-            block_rlp = self.db.get(self.head_hash)
-            if block_rlp == 'GENESIS':
-                return self.genesis
-            else:
-                return rlp.decode(block_rlp, Block)
-        except Exception:
-            return None
+        return self.get_head_block()
+
+    # Returns the decoded block stored under blockhash, None for the genesis marker.
+    # The block is shared, it must not be changed
+    def _cached_block(self, blockhash):
+        block = self.block_cache.get(blockhash)
+        if block is None:
+            block_rlp = self.db.get(blockhash)
+            if block_rlp in ('GENESIS', b'GENESIS'):
+                return None
+            block = rlp.decode(block_rlp, Block)
+            self.block_cache.put(blockhash, block)
+        return block
+
+    # Copy of a cached block for a caller. Its fields can be set, the header and the
+    # transactions are still the shared immutable ones
+    def _block_for_caller(self, block):
+        if self.shared_blocks:
+            return block
+        o = Block(block.header, list(block.transactions), block.v, block.r, block.s)
+        o._signer = block._signer
+        return o
 
     # Returns the post-state of the block
     def mk_poststate_of_blockhash(self, blockhash):
         if blockhash not in self.db:
             raise Exception("Block hash %s not found" % encode_hex(blockhash))
 
-        block_rlp = self.db.get(blockhash)
+        block = self._cached_block(blockhash)
 
-        if block_rlp in ('GENESIS', b'GENESIS'):
+        if block is None:
             return State.from_snapshot(json.loads(
                 self.db.get('GENESIS_STATE')), self.env)
-        block = rlp.decode(block_rlp, Block)
-        state = State(env=self.env)
-        state.trie.root_hash = block.header.state_root
+        state = State(root=self.get_state_root(block), env=self.env)
         update_block_env_variables(state, block)
         state.txindex = len(block.transactions)
-        state.prev_headers = []
-        b = block
-        header_depth = state.config['PREV_HEADER_DEPTH']
-        for i in range(header_depth + 1):
-            state.prev_headers.append(b.header)
-            try:
-                b = rlp.decode(state.db.get(b.header.prevhash), Block)
-            except Exception:
-                break
-        if i < header_depth:
-            if state.db.get(b.header.prevhash) == 'GENESIS':
-                jsondata = json.loads(state.db.get('GENESIS_STATE'))
-                for h in jsondata["prev_headers"][:header_depth - i]:
-                    state.prev_headers.append(dict_to_prev_header(h))
-            else:
-                raise Exception("Dangling prevhash")
+        state.prev_headers = self.get_prev_headers(block)
         assert len(state.journal) == 0, state.journal
         return state
 
+    # Returns the post-state root of the block
+    def get_state_root(self, block):
+        return block.header.state_root
+
+    # Returns the prev_headers of the post-state of the block, built from the list of
+    # its parent when that one is cached
+    def get_prev_headers(self, block):
+        header_depth = self.env.config['PREV_HEADER_DEPTH']
+        headers = self.prev_headers_cache.get(block.header.hash)
+        if headers is None:
+            parent_headers = self.prev_headers_cache.get(block.header.prevhash)
+            if parent_headers is not None:
+                headers = [block.header] + parent_headers[:header_depth]
+            else:
+                headers = []
+                b = block
+                for i in range(header_depth + 1):
+                    headers.append(b.header)
+                    try:
+                        parent = self._cached_block(b.header.prevhash)
+                    except Exception:
+                        break
+                    if parent is None:
+                        break
+                    b = parent
+                if i < header_depth:
+                    if self.db.get(b.header.prevhash) == 'GENESIS':
+                        jsondata = json.loads(self.db.get('GENESIS_STATE'))
+                        for h in jsondata["prev_headers"][:header_depth - i]:
+                            headers.append(dict_to_prev_header(h))
+                    else:
+                        raise Exception("Dangling prevhash")
+            self.prev_headers_cache.put(block.header.hash, headers)
+        return list(headers)
+
+    # Returns the post-state of the block with the given number, for reading only. The
+    # state is shared with other callers through state_cache and has no block env
+    def get_state_at(self, number):
+        return self._state_at(number)[1]
+
+    # Returns the hash and the post-state of the block with the given number. Once read,
+    # the state is put again in state_cache with _reweigh for its decoded accounts
+    def _state_at(self, number):
+        blockhash = self.get_blockhash_by_number(number)
+        if blockhash is None:
+            raise KeyError("Block number %d not found" % number)
+        if number < kept_floor(self.db) or \
+                self.pruner and number < self.state.block_number - self.pruner.keep_blocks:
+            raise KeyError("State of block number %d has been pruned" % number)
+        state = self.state_cache.get(blockhash)
+        if state is None:
+            block = self._cached_block(blockhash)
+            if block is None:
+                # Genesis, its root is stored by initialize_genesis_keys
+                state = State(root=self.db.get(b'state:' + blockhash), env=self.env)
+            else:
+                state = State(root=self.get_state_root(block), env=self.env)
+            self.state_cache.put(blockhash, state)
+        return blockhash, state
+
+    def _reweigh(self, blockhash, state):
+        weight = self.state_cache.weights.get(blockhash)
+        if weight is not None and weight != self.state_cache.weigh(blockhash, state):
+            self.state_cache.put(blockhash, state)
+
+    # Returns a copy of the balance of the address after the block with the given number
+    def get_balance_at(self, address, number):
+        blockhash, state = self._state_at(number)
+        balance = state.get_balance(address, writable=True)
+        self._reweigh(blockhash, state)
+        return balance
+
+    # Returns the address whose own ips held ip after the block with the given number,
+    # None if nobody did
+    def get_owner_at(self, ip, number):
+        ip = IPNetwork(ip)
+        blockhash, state = self._state_at(number)
+        try:
+            return self._owner_in_state(ip, blockhash, state)
+        finally:
+            self._reweigh(blockhash, state)
+
+    def _owner_in_state(self, ip, blockhash, state):
+        # The current holder of ip, or whoever delegated it, if the owner has not changed
+        holder = self.patricia.find_value(str(ip.ip))
+        if holder is not None:
+            holder = normalize_address(holder)
+            if state.get_balance(holder).in_own_ips(ip):
+                return holder
+            for sender, ips in self.state.get_balance(holder).received_ips.items():
+                if ip in ips and state.get_balance(sender).in_own_ips(ip):
+                    return sender
+        # Otherwise look ip up in the own ips of every account of the state. They are
+        # disjoint, so only the account holding the first part of ip can own all of it
+        for version, first, last, address in self._owner_index(blockhash, state).overlapping(ip):
+            if state.get_balance(address).in_own_ips(ip):
+                return address
+            break
+        return None
+
+    # Maps the own ips of every account of the post-state of the block to the account.
+    # Built on first use by streaming the trie, so that the accounts are not decoded into
+    # the caches of the shared state, and kept in owner_index_cache
+    def _owner_index(self, blockhash, state):
+        index = self.owner_index_cache.get(blockhash)
+        if index is None:
+            index = PrefixMap.from_intervals((version, first, last, address)
+                                             for address, rlpdata in state.trie.iter_branch()
+                                             for version, first, last in
+                                             decode_balance(rlp.decode(rlpdata)[1])
+                                             .own_ips.iter_intervals())
+            if index is None:
+                raise Exception("Overlapping own ips in the state of block %s" % encode_hex(blockhash))
+            self.owner_index_cache.put(blockhash, index)
+        return index
+
     # Gets the parent block of a given block
     def get_parent(self, block):
         if block.header.number == int(self.db.get('GENESIS_NUMBER')):
@@ -127,21 +269,24 @@ class Chain(object):
     # Gets the block with a given blockhash
     def get_block(self, blockhash):
         #try:
-        block_rlp = self.db.get(blockhash)
-        if block_rlp == 'GENESIS':
+        block = self._cached_block(blockhash)
+        if block is None:
             if not hasattr(self, 'genesis'):
                 self.genesis = rlp.decode(self.db.get('GENESIS_RLP'), sedes=Block.exclude(['v', 'r', 's']))
             return self.genesis
         else:
-            return rlp.decode(block_rlp, Block)
+            return self._block_for_caller(block)
 
+    # The decoded head is pinned until the head changes
     def get_head_block(self):
         try:
-            block_rlp = self.db.get(self.head_hash)
-            if block_rlp == 'GENESIS':
+            if self.head_block is None or self.head_block[0] != self.head_hash:
+                self.head_block = (self.head_hash, self._cached_block(self.head_hash))
+            block = self.head_block[1]
+            if block is None:
                 return self.genesis
             else:
-                return rlp.decode(block_rlp, Block)
+                return self._block_for_caller(block)
         except Exception:
             return None
 
@@ -214,8 +359,9 @@ class Chain(object):
     def verify_block_signature(self,block,ip):
         return verify_block_signature(self.state,block,ip)
 
-    # Call upon receiving a block
-    def add_block(self, block):
+    # Call upon receiving a block. built is the (post-state, patricia changes) pair of a
+    # block created by this node, adopted instead of applying the block again
+    def add_block(self, block, built=None):
         # Are we receiving the block too early?
         try:
             databaseLog.debug('Validating block: number %d hash %s', block.header.number, block.header.hash.encode('HEX'))
@@ -240,13 +386,20 @@ class Chain(object):
         if block.header.prevhash == self.head_hash:
             self.state.deletes = []
             self.state.changed = {}
+            parent_root = self.state.trie.root_hash
 
-            apply_block(self.state, block, self.patricia)
+            if built is not None and self.state.can_adopt(built[0]):
+                adopt_block(self.state, block, self.patricia, built[0], built[1])
+            else:
+                apply_block(self.state, block, self.patricia)
 
-            self.patricia.to_db()
+            self.patricia.to_db(self.db)
+            if self.pruner:
+                self.pruner.on_block(block.header.number, parent_root, self.state.trie.root_hash)
 
             self.db.put(b'block:%d' % block.header.number, block.header.hash)
             self.head_hash = block.header.hash
+            self.head_block = None
             for i, tx in enumerate(block.transactions):
                 self.db.put(b'txindex:' +
                             tx.hash, rlp.encode([block.number, i]))
@@ -282,7 +435,11 @@ class Chain(object):
         block.header.timestamp, block.transaction_count, int(time.time()))
         databaseLog.debug('Saved %d address change logs', len(changed.keys()))
 
+        # With write-behind the batch is written after the ones of the previous blocks,
+        # so the stored head never points to missing data. db.sync() waits for it
         self.db.commit()
+        if isinstance(self.db, InstrumentedDB):
+            self.db.stats.dump(block.header.number)
 
         if self.new_head_cb and block.header.number != 0:
             self.new_head_cb(block)
@@ -295,12 +452,27 @@ class Chain(object):
             del self.parent_queue[block.header.hash]
         return True
 
+    # Maintenance entry point of pruning: releases at once the state nodes that left the
+    # kept window and, with sweep, deletes every stored node the kept states do not use
+    def compact_state(self, sweep=False):
+        if not self.pruner:
+            raise Exception("Pruning is disabled (PRUNE_KEEP_BLOCKS is 0)")
+        head = self.state.block_number
+        roots = None
+        if sweep:
+            roots = set([self.state.trie.root_hash])
+            for number in range(max(0, head - self.pruner.keep_blocks), head + 1):
+                roots.add(self.get_state_root(self.get_block_by_number(number)))
+        return self.pruner.compact(head, roots)
+
     def __contains__(self, blk):
         if isinstance(blk, (str, bytes)):
             try:
-                blk = rlp.decode(self.db.get(blk), Block)
+                blk = self._cached_block(blk)
             except Exception:
                 return False
+            if blk is None:
+                return False
         try:
             o = self.get_block(self.get_blockhash_by_number(blk.number)).hash
             assert o == blk.hash
@@ -341,6 +513,21 @@ class Chain(object):
         blk = self.get_block_by_number(blknum)
         return blk.transactions[index], blk, index
 
+    # Returns the tx_root of the block holding tx, the index of tx in it and the Merkle
+    # proof of the transaction against that root (see proof.py)
+    def get_transaction_proof(self, tx):
+        blknum, index = self.get_tx_position(tx)
+        blk = self.get_block_by_number(blknum)
+        t = Trie(EphemDB())
+        t.build((rlp.encode(i), rlp.encode(_tx)) for i, _tx in enumerate(blk.transactions))
+        return blk.header.tx_root, index, t.get_proof(rlp.encode(index))
+
+    # Returns the state root after the block with the given number (the head if None)
+    # and the Merkle proof of the account at address against it
+    def get_account_proof(self, address, number=None):
+        state = self.state if number is None else self.get_state_at(number)
+        return state.trie.root_hash, state.trie.get_proof(address)
+
     # Get descendants of a block
     def get_descendants(self, block):
         output = []
@@ -379,4 +566,11 @@ class Chain(object):
         return self.env.config
         
     def get_all_current_addresses(self):
-        return self.state.list_all_addresses()
\ No newline at end of file
+        return self.state.list_all_addresses()
+
+    def get_current_address_count(self):
+        return self.state.address_count()
+
+    # Addresses at the given positions of the sorted list of current addresses
+    def get_current_addresses_at(self, positions):
+        return self.state.addresses_at(positions)
\ No newline at end of file
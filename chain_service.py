@@ -7,10 +7,9 @@ import time
 from genesis_helpers import mk_genesis_data
 from db import _EphemDB
 from apply import validate_transaction
-import trie
 import state
 import rlp
-from apply import apply_transaction
+from apply import apply_transaction, mk_transaction_sha
 from utils import normalize_address, compress_random_no_to_int
 from own_exceptions import UnsignedTransaction, DkgBlockRequiresGroupKey
 #from state import State
@@ -40,6 +39,7 @@ class ChainService():
         self.db = self.env.db
         self.chain = chain.Chain(genesis=mk_genesis_data(self.env), env=self.env)
         self.transactions = []
+        self.built_block = None
 
     def add_pending_transaction(self, tx):
         assert isinstance(tx, Transaction)
@@ -67,7 +67,15 @@ class ChainService():
 
     # creates a block with the list of pending transactions, creates its tries and returns it
     def create_block(self, coinbase, random_no, group_key, group_sig, count):
-        
+        block, poststate, cached = self.build_block(coinbase, random_no, group_key, group_sig, count)
+        # Kept so that add_block can adopt the post-state instead of applying the block again
+        self.built_block = (block.header.hash, poststate, cached)
+        return block
+
+    # Selects and applies the pending transactions in a single pass.
+    # Returns the block, its post-state and the patricia changes of its transactions
+    def build_block(self, coinbase, random_no, group_key, group_sig, count):
+
         self.chain.process_time_queue()
         prevhash = self.chain.head_hash
         prevnumber = self.chain.state.block_number
@@ -86,26 +94,29 @@ class ChainService():
                                group_pubkey = group_key, 
                                   group_sig = group_sig, 
                                       count = count))
-        snapshot = self.chain.state.to_snapshot()
-        s = state.State().from_snapshot(snapshot, Env(_EphemDB()))
+        s = self.chain.state.clone()
+        cached = {}
         databaseLog.info("Creating block with block number %s", str(prevnumber+1))
         for tx in self.transactions:
             if sys.getsizeof(block) < 1048576:
                 try:
                     dictionary = {}
                     if (prevnumber+1) % 2 == 0 and int(tx.afi) == 1:  # the next block has to be an IPv4 one
-                        apply_transaction(s, tx, dictionary)
-                        block.transactions.append(tx)
+                        apply_transaction(s, tx, dictionary, commit=False)
                     elif (prevnumber+1) % 2 != 0 and int(tx.afi) == 2:  # the next block has to be an IPv6 one
-                        apply_transaction(s, tx, dictionary)
-                        block.transactions.append(tx)
+                        apply_transaction(s, tx, dictionary, commit=False)
+                    else:
+                        continue
+                    block.transactions.append(tx)
+                    cached.update(dictionary)
                 except Exception as e:
                     databaseLog.info(e.message)
             else:
                 databaseLog.info("Block number %s filled to max. size", str(prevnumber+1))
-
-        self._create_tries(block)
-        return block
+        s.commit()
+        block.header.tx_root = mk_transaction_sha(block.transactions)
+        block.header.state_root = s.trie.root_hash
+        return block, s, cached
 
     def validate_transaction(self, tx):
         return self.chain.validate_transaction(tx)
@@ -117,20 +128,6 @@ class ChainService():
     def verify_block_signature(self,block,ip):
         return self.chain.verify_block_signature(block,ip)
 
-    # creates the tx_trie and state trie of a block
-    def _create_tries(self, block):
-        t = trie.Trie(_EphemDB())
-        snapshot = self.chain.state.to_snapshot()
-
-        temp_state = self.chain.state.clone()
-
-        dictionary = {}
-        for index, tx in enumerate(block.transactions):
-            t.update(rlp.encode(index), rlp.encode(tx))
-            apply_transaction(temp_state, tx, dictionary)
-        block.header.tx_root = t.root_hash
-        block.header.state_root = temp_state.trie.root_hash
-
     # adds the block to the chain and eliminates from the pending transactions those transactions present in the block
     def add_block(self, block):
         assert isinstance(block, Block)
@@ -143,7 +140,11 @@ class ChainService():
             for tx in block.transactions:
                 if tx.afi != 2:
                     raise Exception("IPv4 block with an IPv6 transaction, afi detected: " + str(tx.afi))
-        self.chain.add_block(block)
+        built = None
+        if self.built_block is not None and self.built_block[0] == block.header.hash:
+            built = self.built_block[1:]
+        self.built_block = None
+        self.chain.add_block(block, built)
         databaseLog.debug("TX management: deleting transactions added to the chain from the pool")
         for tx in block.transactions:
             if tx in self.transactions:
@@ -181,30 +182,50 @@ class ChainService():
     def get_block_by_number(self, block):
         return self.chain.get_block_by_number(block)
 
+    # The getters below return a copy of the requested part of the balance, the cached
+    # one of the head state must not be changed by the callers
+
     # returns the own ips of the address
     def get_own_ips(self, address):
         normalize_address(address)
-        return self.chain.state.get_balance(address).own_ips
+        return self.chain.state.get_balance(address).own_ips.copy()
 
     # returns the delegated ips of the address
     def get_delegated_ips(self, address):
         normalize_address(address)
-        return self.chain.state.get_balance(address).delegated_ips
+        return {addr: ips.copy() for addr, ips in self.chain.state.get_balance(address).delegated_ips.items()}
 
     # returns the received ips of the address
     def get_received_ips(self, address):
         normalize_address(address)
-        return self.chain.state.get_balance(address).received_ips
+        return {addr: ips.copy() for addr, ips in self.chain.state.get_balance(address).received_ips.items()}
 
     # returns the map_server of the address
     def get_map_server(self, address):
         normalize_address(address)
-        return self.chain.state.get_balance(address).map_server
+        return self.chain.state.get_balance(address).map_server.copy()
 
     # returns the locator of the address
     def get_locator(self, address):
         normalize_address(address)
-        return self.chain.state.get_balance(address).locator
+        return self.chain.state.get_balance(address).locator.copy()
+
+    # returns the balance of the address after block number 'block'
+    def get_balance_at(self, address, block):
+        return self.chain.get_balance_at(normalize_address(address), block)
+
+    # returns the address that owned the ip after block number 'block', None if nobody did
+    def get_owner_at(self, ip, block):
+        return self.chain.get_owner_at(ip, block)
+
+    # returns the state root after block number 'block' (the head if None) and the proof
+    # of the account of address, which holds its balance, against it
+    def get_account_proof(self, address, block=None):
+        return self.chain.get_account_proof(normalize_address(address), block)
+
+    # returns the tx_root of the block holding tx, the index of tx and its proof
+    def get_transaction_proof(self, tx):
+        return self.chain.get_transaction_proof(tx)
 
     # returns the state of the chain
     def get_state(self):
@@ -269,24 +290,27 @@ class ChainService():
         last_old_dkg_block = last_block_no - (last_block_no % DKG_RENEWAL_INTERVAL)
         random_no = compress_random_no_to_int(self.get_block_by_number(last_old_dkg_block).header.random_number.encode("hex"), 16)
                 
-        #List all addresses at the moment in the chain
-        all_addresses = self.chain.get_all_current_addresses()
-        databaseLog.debug("Recovered the list of current addresses, lenght: %s", len(all_addresses))
-        #databaseLog.debug("Addresses in the list: %s", [addr.encode('hex') for addr in all_addresses] )
-        
-        #Randomly select participants from all the addresses
-        dkg_group = []
+        #Number of addresses at the moment in the chain
+        count = self.chain.get_current_address_count()
+        databaseLog.debug("Recovered the number of current addresses: %s", count)
+
+        #Randomly select participants from the sorted addresses, without repetition.
+        #Each pick is a position in the list of the addresses not selected yet, which
+        #is mapped back to a position in the full list
+        positions = []
         for i in range(DKG_NUMBER_PARTICIPANTS):
-            random_pos = random_no % len(all_addresses)
-            dkg_group.append(all_addresses.pop(random_pos))            
-            random_no = compress_random_no_to_int(hashlib.sha256(str(random_no)).hexdigest(), 16)      
+            pos = random_no % (count - len(positions))
+            for taken in sorted(positions):
+                if taken <= pos:
+                    pos += 1
+            positions.append(pos)
+            random_no = compress_random_no_to_int(hashlib.sha256(str(random_no)).hexdigest(), 16)
+        dkg_group = self.chain.get_current_addresses_at(positions)
         databaseLog.debug("Selected addresses for this group: %s", [addr.encode('hex') for addr in dkg_group])
         return dkg_group
     
     def extract_first_ip_from_address(self, address):
-        ipset = self.get_own_ips(address)
-        for ip in ipset:
-            return ip
+        return self.chain.state.get_balance(address).own_ips.first()
         
         
         
@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Prunes the state tries of a chain database, keeping the states of the last
+keep_blocks blocks, and reports its size before and after.
+
+The death rows due are released at once. With --sweep every stored trie node
+that the kept states do not use is deleted as well, which also reclaims the
+nodes written before pruning was enabled. Sweeping is refused while pruning is
+disabled in the config (PRUNE_KEEP_BLOCKS is 0), as the node expects to keep
+every state, unless --force is given. The lowest kept block is recorded in the
+database so that queries of older states report them as pruned. keep_blocks
+defaults to PRUNE_KEEP_BLOCKS, or 128 when it is 0. The node must not be running.
+
+Usage: python compact_db.py [chain_db_dir] [keep_blocks] [--sweep [--force]]
+"""
+
+import os
+import sys
+import rlp
+from db import open_db
+from block import Block
+from config import default_config
+from pruning import Pruner, kept_floor
+from migrate_balances import head_state_root
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def head_number(db):
+    block_rlp = db.get(db.get('head_hash'))
+    if block_rlp == 'GENESIS':
+        return 0
+    return rlp.decode(block_rlp, Block).header.number
+
+
+def kept_roots(db, head, keep_blocks):
+    roots = set()
+    for number in range(max(0, head - keep_blocks), head + 1):
+        roots.add(head_state_root(db, db.get(b'block:%d' % number)))
+    return roots
+
+
+def run(path, keep_blocks, sweep=False, force=False):
+    if sweep and not default_config['PRUNE_KEEP_BLOCKS'] and not force:
+        print "Pruning is disabled (PRUNE_KEEP_BLOCKS is 0) and the node keeps every state, " \
+              "not sweeping the states before the last %d blocks without --force" % keep_blocks
+        return 1
+    before = dir_size(path)
+    db = open_db(path)
+    if 'head_hash' not in db:
+        print "No head found in %s, nothing to compact" % path
+        return 1
+    head = head_number(db)
+    pruner = Pruner(db, keep_blocks)
+    print "Head block: %d, keeping the states of blocks %d to %d" % (head, max(0, head - keep_blocks), head)
+    print "Nodes waiting in death rows: %d" % pruner.pending()
+    result = pruner.compact(head, kept_roots(db, head, keep_blocks) if sweep else None)
+    print "Released %(released)d nodes, %(deleted)d deleted, %(swept)d swept" % result
+    print "Lowest kept block: %d" % kept_floor(db)
+    after = dir_size(path)
+    print "Database size: %d bytes before, %d bytes after (%.1f%%)" % (before, after, 100.0 * after / max(before, 1))
+    return 0
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a not in ('--sweep', '--force')]
+    sys.exit(run(args[0] if args else './chain',
+                 int(args[1]) if len(args) > 1 else default_config['PRUNE_KEEP_BLOCKS'] or 128,
+                 '--sweep' in sys.argv[1:], '--force' in sys.argv[1:]))
@@ -27,6 +27,21 @@ default_config = dict(
     NETWORK_ID=1,
     ACCOUNT_INITIAL_NONCE=0,
     PREV_HEADER_DEPTH=256,
+    # Entries of the LRU caches of Chain for historical queries
+    POSTSTATE_CACHE_SIZE=128,
+    # Decoded accounts held at most by the cached post-states, and intervals by their
+    # ownership indexes
+    POSTSTATE_CACHE_ACCOUNTS=200000,
+    PREV_HEADERS_CACHE_SIZE=64,
+    # Number of past block states kept by pruning (0 keeps every state), and maximum
+    # number of trie nodes released per added block
+    PRUNE_KEEP_BLOCKS=0,
+    PRUNE_BATCH_SIZE=20000,
+    # Entries of the LRU of decoded blocks of Chain. With SHARED_BLOCKS, Chain returns
+    # the cached blocks themselves (immutable, shared by all callers) instead of
+    # copies whose fields can be changed
+    BLOCK_CACHE_SIZE=256,
+    SHARED_BLOCKS=False,
     
     
 )
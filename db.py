@@ -1,18 +1,84 @@
+import os
+import sys
+import json
+import time
+import zlib
+import Queue
+import atexit
+import signal
+import threading
 import utils
 import leveldb
+import sqlite3
+import ConfigParser
 from rlp.utils import str_to_bytes
 import logging
+from lru import LRUCache
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
 
-compress = decompress = lambda x: x
 databases = {}
 
 databaseLog = logging.getLogger('Database')
 
+# Databases with a background writer, their committed batches are written at exit.
+# Writes not committed yet belong to an unfinished block and are dropped
+writers = set()
+
+
+def _sync_writers():
+    for db in list(writers):
+        try:
+            db.drain()
+        except Exception:
+            databaseLog.exception('Pending database writes lost at exit')
+
+
+atexit.register(_sync_writers)
+
+
+# SIGTERM (pkill, see stop.sh) kills Python 2 without running the atexit handlers.
+# It is turned into SystemExit, like SIGINT into KeyboardInterrupt, so that the
+# stack unwinds and the committed batches are written by _sync_writers
+def _exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _handle_sigterm():
+    if isinstance(threading.current_thread(), threading._MainThread) and \
+            signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+
 
 class BaseDB(object):
     pass
 
 
+def _merge_prefix(stored, pending, prefix):
+    # Yields the sorted (key, value) pairs of stored starting with prefix, overridden by the
+    # sorted pending writes (None meaning deleted)
+    stored = iter(stored)
+    pending = iter(pending)
+    s = next(stored, None)
+    p = next(pending, None)
+    while True:
+        if s is not None and not s[0].startswith(prefix):
+            s = None
+        if s is None and p is None:
+            return
+        if p is None or (s is not None and s[0] < p[0]):
+            yield s
+            s = next(stored, None)
+            continue
+        if s is not None and s[0] == p[0]:
+            s = next(stored, None)
+        if p[1] is not None:
+            yield p
+        p = next(pending, None)
+
+
 class _EphemDB(BaseDB):
 
     def __init__(self):
@@ -31,6 +97,11 @@ class _EphemDB(BaseDB):
     def commit(self):
         pass
 
+    # Yields the (key, value) pairs whose key starts with prefix, in key order
+    def iter_prefix(self, prefix):
+        for key in sorted(k for k in self.db if k.startswith(prefix)):
+            yield key, self.db[key]
+
     def _has_key(self, key):
         return key in self.db
 
@@ -105,6 +176,22 @@ class OverlayDB(BaseDB):
     def commit(self):
         pass
 
+    def iter_prefix(self, prefix):
+        pending = sorted((k, v) for k, v in self.overlay.items() if k.startswith(prefix))
+        return _merge_prefix(self.db.iter_prefix(prefix), pending, prefix)
+
+    # Writes the overlay into the underlying database
+    def flush(self):
+        for key, value in self.overlay.items():
+            if value is None:
+                try:
+                    self.db.delete(key)
+                except KeyError:
+                    pass
+            else:
+                self.db.put(key, value)
+        self.overlay = {}
+
     def _has_key(self, key):
         if key in self.overlay:
             return self.overlay[key] is not None
@@ -132,40 +219,67 @@ def sub1(b):
     return utils.zpad(utils.encode_int(v - 1), 4)
 
 
+# Values are stored behind a 4 byte refcount. Puts and deletes only add up a signed
+# delta per key in memory, which commit folds into one read-modify-write of the key
+# in db (deleting it once the count drops to zero). Reads see the pending deltas
 class RefcountDB(BaseDB):
 
     def __init__(self, db):
         self.db = db
         self.kv = None
+        self.deltas = {}
+        # Values put since the last commit
+        self.values = {}
+
+    # Returns the stored (refcount, value) of key, (0, None) if missing
+    def _stored(self, key):
+        try:
+            existing = self.db.get(key)
+        except KeyError:
+            return 0, None
+        return utils.big_endian_to_int(existing[:4]), existing[4:]
 
     def get(self, key):
-        return self.db.get(key)[4:]
+        delta = self.deltas.get(key)
+        if delta is None:
+            return self.db.get(key)[4:]
+        if delta > 0 and key in self.values:
+            return self.values[key]
+        count, value = self._stored(key)
+        if count + delta <= 0:
+            raise KeyError(key)
+        return value
 
     def get_refcount(self, key):
-        try:
-            return utils.big_endian_to_int(self.db.get(key)[:4])
-        except KeyError:
-            return 0
+        count, value = self._stored(key)
+        return max(count + self.deltas.get(key, 0), 0)
 
     def put(self, key, value):
-        try:
-            existing = self.db.get(key)
-            assert existing[4:] == value
-            self.db.put(key, add1(existing[:4]) + value)
-        except KeyError:
-            self.db.put(key, b'\x00\x00\x00\x01' + value)
+        assert self.values.setdefault(key, value) == value
+        self.deltas[key] = self.deltas.get(key, 0) + 1
 
     def delete(self, key):
-        existing = self.db.get(key)
-        if existing[:4] == b'\x00\x00\x00\x01':
-            self.db.delete(key)
-        else:
-            self.db.put(key, sub1(existing[:4]) + existing[4:])
+        self.deltas[key] = self.deltas.get(key, 0) - 1
 
     def commit(self):
-        pass
+        for key, delta in self.deltas.items():
+            if delta == 0:
+                continue
+            count, value = self._stored(key)
+            if value is None:
+                if delta < 0:
+                    continue
+                value = self.values[key]
+            if count + delta <= 0:
+                self.db.delete(key)
+            else:
+                self.db.put(key, utils.zpad(utils.encode_int(count + delta), 4) + value)
+        self.deltas = {}
+        self.values = {}
 
     def _has_key(self, key):
+        if key in self.deltas:
+            return self.get_refcount(key) > 0
         return key in self.db
 
     def __contains__(self, key):
@@ -177,59 +291,251 @@ class RefcountDB(BaseDB):
     def __hash__(self):
         return utils.big_endian_to_int(str_to_bytes(self.__repr__()))
 
-class LevelDB(BaseDB):
-    """
-    filename                                    the database directory
-    block_cache_size  (default: 8 * (2 << 20))  maximum allowed size for the block cache in bytes
-    write_buffer_size (default  2 * (2 << 20))
-    block_size        (default: 4096)           unit of transfer for the block cache in bytes
-    max_open_files:   (default: 1000)
-    create_if_missing (default: True)           if True, creates a new database if none exists
-    error_if_exists   (default: False)          if True, raises and error if the database exists
-    paranoid_checks   (default: False)          if True, raises an error as soon as an internal
-                                                corruption is detected
-    """
-    max_open_files = 32000
-    block_cache_size = 8 * 1024**2
-    write_buffer_size = 4 * 1024**2
+# Storage policy of a kind of record: whether values are compressed and the budget
+# in bytes of their read cache. Namespaces are told apart by key prefix, and the
+# 32 byte keys (hashes) by their value: refcounted trie nodes and preimages start
+# with a zero byte, block bodies are rlp
+class Namespace(object):
+
+    def __init__(self, name, prefixes=(), compress=False, cache_size=1024**2):
+        self.name = name
+        self.prefixes = prefixes
+        self.compress = compress
+        self.cache_size = cache_size
+
+
+NAMESPACES = [
+    Namespace('trie', cache_size=16 * 1024**2),
+    Namespace('block', compress=True, cache_size=4 * 1024**2),
+    Namespace('block_number', (b'block:',)),
+    Namespace('txindex', (b'txindex:',)),
+    Namespace('child', (b'child:',)),
+    Namespace('changed', (b'changed:',)),
+    Namespace('state_root', (b'state:',)),
+    Namespace('address', (b'address:',), compress=True, cache_size=4 * 1024**2),
+    Namespace('address_count', (b'address_count:', b'address_index:')),
+    Namespace('pruning', (b'deathrow:', b'prune:')),
+    Namespace('genesis', (b'GENESIS_STATE', b'GENESIS_RLP'), compress=True),
+    Namespace('patricia', (b'patricia',), compress=True),
+    Namespace('other'),
+]
+NAMESPACE_PREFIXES = [(prefix, ns) for ns in NAMESPACES for prefix in ns.prefixes]
+# Compressed values start with this byte, which none of the raw values of the
+# namespaces with compression can start with (rlp, json or refcounted values)
+COMPRESSED = b'\xff'
+# Smaller values are never compressed
+COMPRESS_MIN_SIZE = 64
+
+
+def key_namespace(key):
+    for prefix, ns in NAMESPACE_PREFIXES:
+        if key.startswith(prefix):
+            return ns
+    return None if len(key) == 32 else NAMESPACES[-1]
+
+
+def namespace_of(key, value):
+    ns = key_namespace(key)
+    if ns is None:
+        return NAMESPACES[0] if value[:1] == b'\x00' else NAMESPACES[1]
+    return ns
+
+
+# Base of the on-disk backends. Writes and deletes are kept in memory until commit,
+# which hands them to the backend as one batch, compressed as their namespace says,
+# and values read from disk go to the bounded read cache of their namespace. A
+# backend provides _get_stored (raising KeyError), _write (a batch of (key, value)
+# pairs, None deleting the key), _iter_stored (the sorted stored pairs from a key
+# on) and _sync (flushing the written batches to disk), and the handle of the store
+# as self.db
+#
+# With start_writer, commit only queues the batch and a background thread writes
+# the batches in commit order. Reads look into the batches not written yet, and
+# sync is the barrier waiting until every committed batch is on disk
+class PersistentDB(BaseDB):
 
     def __init__(self, dbfile):
+        # Writes and deletes (None) since the last commit, the only keys commit writes
         self.uncommitted = dict()
+        self.read_caches = dict((ns.name, LRUCache(ns.cache_size, weigh=lambda k, v: len(k) + len(v)))
+                                for ns in NAMESPACES)
         self.dbfile = dbfile
-        self.db = leveldb.LevelDB(dbfile, max_open_files=self.max_open_files)
-        self.commit_counter = 0
-
-    def reopen(self):
-        del self.db
-        self.db = leveldb.LevelDB(self.dbfile)
+        # Committed batches not written yet, oldest first
+        self.in_flight = []
+        self.writer = None
+        self.write_queue = None
+        self.write_error = None
 
     def get(self, key):
         if key in self.uncommitted:
             if self.uncommitted[key] is None:
                 raise KeyError("key not in db")
             return self.uncommitted[key]
-        o = decompress(self.db.Get(key))
-        self.uncommitted[key] = o
+        if self.in_flight:
+            # The writer only removes batches once written, the copy is atomic
+            for batch in self.in_flight[::-1]:
+                if key in batch:
+                    if batch[key] is None:
+                        raise KeyError("key not in db")
+                    return batch[key]
+        ns = key_namespace(key)
+        if ns is not None:
+            cache = self.read_caches[ns.name]
+            o = cache.get(key)
+            if o is None:
+                o = self._decode(ns, self._get_stored(key))
+                cache.put(key, o)
+            return o
+        # A hash, its namespace is only known once the value is read
+        for name in ('trie', 'block'):
+            if key in self.read_caches[name]:
+                return self.read_caches[name].get(key)
+        o = self._decode(ns, self._get_stored(key))
+        cache = self.read_caches[namespace_of(key, o).name]
+        cache.misses += 1
+        cache.put(key, o)
         return o
 
     def put(self, key, value):
         self.uncommitted[key] = value
+        self._evict(key)
 
     def commit(self):
-        batch = leveldb.WriteBatch()
-        for k, v in self.uncommitted.items():
-            if v is None:
-                batch.Delete(k)
-            else:
-                batch.Put(k, compress(v))
-        self.db.Write(batch, sync=False)
-        self.uncommitted.clear()
-        # self.commit_counter += 1
-        # if self.commit_counter % 100 == 0:
-        #     self.reopen()
+        if self.write_error is not None:
+            raise self.write_error
+        if not self.uncommitted:
+            return
+        if self.writer is None:
+            self._write(self._encode_batch(self.uncommitted))
+            self.uncommitted.clear()
+            return
+        batch = self.uncommitted
+        self.uncommitted = dict()
+        self.in_flight.append(batch)
+        # Blocks while the queue is full
+        self.write_queue.put(batch)
+
+    def _encode_batch(self, batch):
+        return [(k, v if v is None else self._encode(k, v)) for k, v in batch.items()]
+
+    # Starts the background thread writing the committed batches, with at most
+    # queue_size of them waiting. Committed batches are written at exit
+    def start_writer(self, queue_size=4):
+        assert self.writer is None
+        self.write_queue = Queue.Queue(queue_size)
+        self.writer = threading.Thread(target=self._write_behind, name='db-writer')
+        self.writer.daemon = True
+        self.writer.start()
+        writers.add(self)
+        _handle_sigterm()
+
+    # Waits for the committed batches and stops the background thread, commits are
+    # written directly again
+    def stop_writer(self):
+        try:
+            self.sync()
+        finally:
+            self.write_queue.put(None)
+            self.writer.join()
+            self.writer = None
+            writers.discard(self)
+
+    def _write_behind(self):
+        while True:
+            batch = self.write_queue.get()
+            if batch is None:
+                self.write_queue.task_done()
+                return
+            try:
+                # After a failure the batches stay in flight, reads still see them
+                if self.write_error is None:
+                    self._write(self._encode_batch(batch))
+                    self.in_flight.pop(0)
+            except Exception as e:
+                databaseLog.exception('Write-behind commit failed')
+                self.write_error = e
+            finally:
+                self.write_queue.task_done()
+
+    # Durability barrier: commits the pending writes and returns once every committed
+    # batch is written and flushed to disk
+    def sync(self):
+        self.commit()
+        self.drain()
+
+    # Returns once every committed batch is written and flushed to disk, without
+    # committing the pending writes
+    def drain(self):
+        if self.writer is not None:
+            self.write_queue.join()
+            if self.write_error is not None:
+                raise self.write_error
+        self._sync()
+
+    def _sync(self):
+        pass
 
     def delete(self, key):
         self.uncommitted[key] = None
+        self._evict(key)
+
+    def _evict(self, key):
+        ns = key_namespace(key)
+        if ns is None:
+            self.read_caches['trie'].pop(key)
+            self.read_caches['block'].pop(key)
+        else:
+            self.read_caches[ns.name].pop(key)
+
+    def _encode(self, key, value):
+        if len(value) >= COMPRESS_MIN_SIZE and namespace_of(key, value).compress:
+            compressed = COMPRESSED + zlib.compress(value)
+            if len(compressed) < len(value):
+                return compressed
+        return value
+
+    # ns is the namespace of the key, None for the hashes
+    def _decode(self, ns, stored):
+        if stored[:1] == COMPRESSED and (ns is None or ns.compress):
+            return zlib.decompress(stored[1:])
+        return stored
+
+    # Read cache stats of every namespace, by name
+    def namespace_stats(self):
+        return dict((name, cache.stats()) for name, cache in self.read_caches.items())
+
+    # Totals of the read caches of all the namespaces
+    def cache_stats(self):
+        total = {'size': 0, 'max_size': 0, 'hits': 0, 'misses': 0}
+        for stats in self.namespace_stats().values():
+            for k in total:
+                total[k] += stats[k]
+        return total
+
+    def iter_prefix(self, prefix):
+        pending = {}
+        for batch in self.in_flight[:] + [self.uncommitted]:
+            pending.update((k, v) for k, v in batch.items() if k.startswith(prefix))
+        pending = sorted(pending.items())
+        stored = ((k, self._decode(key_namespace(k), v)) for k, v in self._iter_stored(prefix))
+        return _merge_prefix(stored, pending, prefix)
+
+    # Yields the (key, value) pairs of the namespace, in key order. The hashes of the
+    # trie and block namespaces are mixed in the key space, so those scan everything
+    def iter_namespace(self, name):
+        ns = [n for n in NAMESPACES if n.name == name][0]
+        if name in ('trie', 'block', 'other'):
+            for k, v in self.iter_prefix(b''):
+                if namespace_of(k, v) is ns:
+                    yield k, v
+            return
+        for prefix in sorted(ns.prefixes):
+            for item in self.iter_prefix(prefix):
+                yield item
+
+    # Reclaims the space of deleted keys where the backend needs it
+    def compact(self):
+        pass
 
     def _has_key(self, key):
         try:
@@ -264,4 +570,318 @@ class LevelDB(BaseDB):
 
     def put_temporarily(self, key, value):
         self.inc_refcount(key, value)
-        self.dec_refcount(key)
\ No newline at end of file
+        self.dec_refcount(key)
+
+
+class LevelDB(PersistentDB):
+    """
+    filename                                    the database directory
+    block_cache_size  (default: 8 * (2 << 20))  maximum allowed size for the block cache in bytes
+    write_buffer_size (default  2 * (2 << 20))
+    block_size        (default: 4096)           unit of transfer for the block cache in bytes
+    max_open_files:   (default: 1000)
+    create_if_missing (default: True)           if True, creates a new database if none exists
+    error_if_exists   (default: False)          if True, raises and error if the database exists
+    paranoid_checks   (default: False)          if True, raises an error as soon as an internal
+                                                corruption is detected
+    """
+    max_open_files = 32000
+    block_cache_size = 8 * 1024**2
+    write_buffer_size = 4 * 1024**2
+
+    def __init__(self, dbfile):
+        super(LevelDB, self).__init__(dbfile)
+        self.db = leveldb.LevelDB(dbfile, max_open_files=self.max_open_files)
+        self.commit_counter = 0
+
+    def reopen(self):
+        self.sync()
+        del self.db
+        self.db = leveldb.LevelDB(self.dbfile)
+
+    def _get_stored(self, key):
+        return self.db.Get(key)
+
+    def _write(self, items):
+        batch = leveldb.WriteBatch()
+        for k, v in items:
+            if v is None:
+                batch.Delete(k)
+            else:
+                batch.Put(k, v)
+        self.db.Write(batch, sync=False)
+
+    def _sync(self):
+        self.db.Write(leveldb.WriteBatch(), sync=True)
+
+    def _iter_stored(self, prefix):
+        return self.db.RangeIter(key_from=prefix)
+
+    # Compacts the whole key range, reclaiming the space of deleted keys
+    def compact(self):
+        self.sync()
+        self.db.CompactRange()
+
+
+# Memory mapped, any number of processes can read the database while one writes it.
+# Opened with readonly, it never takes the writer lock
+class LMDBDB(PersistentDB):
+    # Largest size the database can grow to, only reserves address space
+    map_size = 1024**4
+    max_readers = 512
+
+    def __init__(self, dbfile, readonly=False):
+        if lmdb is None:
+            raise Exception("The lmdb backend needs the lmdb package (pip install lmdb)")
+        super(LMDBDB, self).__init__(dbfile)
+        # Like the LevelDB writes, commits are not synced to disk
+        self.db = lmdb.open(dbfile, map_size=self.map_size, max_readers=self.max_readers,
+                            readonly=readonly, sync=False, metasync=False)
+
+    def _get_stored(self, key):
+        with self.db.begin() as txn:
+            o = txn.get(key)
+        if o is None:
+            raise KeyError("key not in db")
+        return o
+
+    def _write(self, items):
+        with self.db.begin(write=True) as txn:
+            for k, v in items:
+                if v is None:
+                    txn.delete(k)
+                else:
+                    txn.put(k, v)
+
+    def _iter_stored(self, prefix):
+        with self.db.begin() as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                for item in cursor:
+                    yield item
+
+    def _sync(self):
+        self.db.sync(True)
+
+
+# Single file database under the dbfile directory. In WAL mode readers in other
+# processes do not block the writer. sqlite3 connections can only be used by the
+# thread that opened them, so every thread (the writer one) gets its own
+class SQLiteDB(PersistentDB):
+
+    def __init__(self, dbfile):
+        super(SQLiteDB, self).__init__(dbfile)
+        if not os.path.isdir(dbfile):
+            os.makedirs(dbfile)
+        self.connections = threading.local()
+        self.db = self._connection()
+        self.db.execute('CREATE TABLE IF NOT EXISTS kv (k BLOB PRIMARY KEY, v BLOB NOT NULL) WITHOUT ROWID')
+        self.db.commit()
+
+    def _connection(self):
+        db = getattr(self.connections, 'db', None)
+        if db is None:
+            db = self.connections.db = sqlite3.connect(os.path.join(self.dbfile, 'chain.sqlite'))
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _get_stored(self, key):
+        row = self._connection().execute('SELECT v FROM kv WHERE k = ?', (sqlite3.Binary(key),)).fetchone()
+        if row is None:
+            raise KeyError("key not in db")
+        return str(row[0])
+
+    def _write(self, items):
+        items = list(items)
+        db = self._connection()
+        with db:
+            db.executemany('DELETE FROM kv WHERE k = ?', [(sqlite3.Binary(k),) for k, v in items if v is None])
+            db.executemany('INSERT OR REPLACE INTO kv VALUES (?, ?)',
+                           [(sqlite3.Binary(k), sqlite3.Binary(v)) for k, v in items if v is not None])
+
+    def _iter_stored(self, prefix):
+        # Blobs compare with memcmp, the same order as the other backends
+        query = 'SELECT k, v FROM kv WHERE k >= ? ORDER BY k'
+        for k, v in self._connection().execute(query, (sqlite3.Binary(prefix),)):
+            yield str(k), str(v)
+
+    # With synchronous=NORMAL the WAL is only synced when checkpointed
+    def _sync(self):
+        self._connection().execute('PRAGMA wal_checkpoint(FULL)')
+
+    def compact(self):
+        self.sync()
+        self._connection().execute('VACUUM')
+
+
+BACKENDS = {'leveldb': LevelDB, 'lmdb': LMDBDB, 'sqlite': SQLiteDB}
+
+# Call site of a database access, by module of the first caller outside of db.py
+CALL_SITES = {
+    'state': 'State', 'account': 'State', 'trie': 'Trie', 'securetrie': 'Trie', 'proof': 'Trie',
+    'chain': 'Chain', 'chain_service': 'Chain', 'pruning': 'Pruning', 'genesis_helpers': 'Genesis',
+}
+# Latency histogram bucket i counts the accesses under 2**i microseconds
+LATENCY_BUCKETS = 24
+
+
+def _call_site():
+    f = sys._getframe(2)
+    while f is not None:
+        site = CALL_SITES.get(f.f_globals.get('__name__'))
+        if site is not None:
+            return site
+        f = f.f_back
+    return 'other'
+
+
+# Counters of database accesses by (layer, call site, namespace, operation): count,
+# bytes of keys and values, seconds and latency histogram. Hashes are counted in the
+# 'hash' namespace, the call site tells trie nodes from block bodies. With dump_file,
+# dump appends the changes since the previous dump as a line of json
+class DBStats(object):
+
+    def __init__(self, dump_file=None):
+        self.counters = {}
+        self.dump_file = dump_file
+        self.dumped = {}
+
+    def record(self, layer, site, namespace, op, size, elapsed):
+        key = (layer, site, namespace, op)
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = [0, 0, 0.0, [0] * LATENCY_BUCKETS]
+        counter[0] += 1
+        counter[1] += size
+        counter[2] += elapsed
+        counter[3][min(int(elapsed * 1e6).bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+    # Nested dicts layer -> call site -> namespace -> operation -> counters, the
+    # histogram as {bound in microseconds: count}
+    def snapshot(self, since=None):
+        since = since or {}
+        o = {}
+        for key, (count, size, elapsed, histogram) in self.counters.items():
+            previous = since.get(key, (0, 0, 0.0, [0] * LATENCY_BUCKETS))
+            if count == previous[0]:
+                continue
+            layer, site, namespace, op = key
+            o.setdefault(layer, {}).setdefault(site, {}).setdefault(namespace, {})[op] = {
+                'count': count - previous[0],
+                'bytes': size - previous[1],
+                'ms': 1000 * (elapsed - previous[2]),
+                'latency_us': dict((2 ** i, n - m) for i, (n, m) in enumerate(zip(histogram, previous[3])) if n > m),
+            }
+        return o
+
+    def reset(self):
+        self.counters = {}
+        self.dumped = {}
+
+    def dump(self, number):
+        if self.dump_file is None:
+            return
+        with open(self.dump_file, 'a') as f:
+            f.write(json.dumps({'block': number, 'stats': self.snapshot(self.dumped)}, sort_keys=True) + '\n')
+        self.dumped = dict((k, (v[0], v[1], v[2], v[3][:])) for k, v in self.counters.items())
+
+
+# Counts the accesses to db in stats under the name of its layer. It can wrap any
+# database (a backend, RefcountDB, OverlayDB...), other attributes are db's
+class InstrumentedDB(BaseDB):
+
+    def __init__(self, db, stats, layer):
+        self.db = db
+        self.stats = stats
+        self.layer = layer
+
+    def _record(self, key, op, size, start):
+        ns = key_namespace(key)
+        self.stats.record(self.layer, _call_site(), 'hash' if ns is None else ns.name, op, size, time.time() - start)
+
+    def get(self, key):
+        start = time.time()
+        try:
+            value = self.db.get(key)
+        except KeyError:
+            self._record(key, 'get_missing', len(key), start)
+            raise
+        self._record(key, 'get', len(key) + len(value), start)
+        return value
+
+    def put(self, key, value):
+        start = time.time()
+        self.db.put(key, value)
+        self._record(key, 'put', len(key) + len(value), start)
+
+    def delete(self, key):
+        start = time.time()
+        self.db.delete(key)
+        self._record(key, 'delete', len(key), start)
+
+    def commit(self):
+        start = time.time()
+        self.db.commit()
+        self.stats.record(self.layer, _call_site(), '-', 'commit', 0, time.time() - start)
+
+    # Counts the time spent reading the items, not the time of the caller
+    def iter_prefix(self, prefix):
+        items = self.db.iter_prefix(prefix)
+        while True:
+            start = time.time()
+            try:
+                k, v = next(items)
+            except StopIteration:
+                return
+            self._record(k, 'iter', len(k) + len(v), start)
+            yield k, v
+
+    def _has_key(self, key):
+        start = time.time()
+        o = key in self.db
+        self._record(key, 'has', len(key), start)
+        return o
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def __eq__(self, other):
+        if isinstance(other, InstrumentedDB):
+            other = other.db
+        return self.db == other
+
+    def __hash__(self):
+        return self.db.__hash__()
+
+
+# Wraps db, a layer of the given name built on base, when base is instrumented
+def instrument_layer(db, base, layer):
+    if isinstance(base, InstrumentedDB):
+        return InstrumentedDB(db, base.stats, layer)
+    return db
+
+
+# Opens the database directory with the backend named in the [Database] section
+# of chain_config.cfg, LevelDB when there is none. With write_behind, commits are
+# written in the background if the section sets write_behind_batches, and with
+# instrument, accesses are counted if it sets a stats_file (see DBStats)
+def open_db(path, config_file='chain_config.cfg', write_behind=False, instrument=False):
+    config_data = ConfigParser.RawConfigParser()
+    config_data.read(config_file)
+    backend = 'leveldb'
+    if config_data.has_option('Database', 'backend'):
+        backend = config_data.get('Database', 'backend')
+    if backend not in BACKENDS:
+        raise Exception("Unknown database backend %s, expected one of %s" % (backend, ', '.join(sorted(BACKENDS))))
+    db = BACKENDS[backend](path)
+    if write_behind and config_data.has_option('Database', 'write_behind_batches'):
+        queue_size = config_data.getint('Database', 'write_behind_batches')
+        if queue_size > 0:
+            db.start_writer(queue_size)
+    if instrument and config_data.has_option('Database', 'stats_file') and config_data.get('Database', 'stats_file'):
+        db = InstrumentedDB(db, DBStats(config_data.get('Database', 'stats_file')), backend)
+    return db
@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Reports the size of every namespace of a chain database (see db.NAMESPACES):
+number of records, bytes stored and bytes once decompressed.
+
+It then reads the last blocks the way the node queries them (block by
+number, body, transaction index, changed accounts in the post-state and in
+the address index) and reports the read cache hit rate of each namespace.
+The node must not be running with the leveldb backend, which is locked.
+
+Usage: python db_report.py [chain_db_dir] [blocks]
+"""
+
+import sys
+import rlp
+from db import open_db, key_namespace, namespace_of, NAMESPACES
+from config import Env
+from state import State, ADDRESS_INDEX_PREFIX
+from block import Block
+from migrate_balances import head_state_root
+
+
+def sizes(db):
+    totals = dict((ns.name, [0, 0, 0]) for ns in NAMESPACES)
+    for k, stored in db._iter_stored(b''):
+        value = db._decode(key_namespace(k), stored)
+        entry = totals[namespace_of(k, value).name]
+        entry[0] += 1
+        entry[1] += len(k) + len(stored)
+        entry[2] += len(k) + len(value)
+    return totals
+
+
+def replay_reads(db, blocks):
+    env = Env(db)
+    head = db.get('head_hash')
+    head_block = db.get(head)
+    if head_block == 'GENESIS':
+        return 0
+    number = rlp.decode(head_block, Block).header.number
+    for n in range(max(1, number - blocks + 1), number + 1):
+        blockhash = db.get(b'block:%d' % n)
+        block = rlp.decode(db.get(blockhash), Block)
+        for tx in block.transactions:
+            db.get(b'txindex:' + tx.hash)
+        changed = db.get(b'changed:' + blockhash)
+        state = State(root=head_state_root(db, blockhash), env=env)
+        for i in range(0, len(changed), 20):
+            addr = changed[i:i + 20]
+            state.get_nonce(addr)
+            if ADDRESS_INDEX_PREFIX + addr in db:
+                db.get(ADDRESS_INDEX_PREFIX + addr)
+    return number - max(1, number - blocks + 1) + 1
+
+
+def run(path, blocks=100):
+    db = open_db(path)
+    if 'head_hash' not in db:
+        print "No head found in %s" % path
+        return 1
+    print "%-14s %10s %14s %14s %7s" % ("namespace", "records", "stored bytes", "raw bytes", "ratio")
+    totals = sizes(db)
+    for ns in NAMESPACES:
+        count, stored, raw = totals[ns.name]
+        if count:
+            print "%-14s %10d %14d %14d %6.1f%%" % (ns.name, count, stored, raw, 100.0 * stored / raw)
+    stored = sum(t[1] for t in totals.values())
+    raw = sum(t[2] for t in totals.values())
+    print "%-14s %10d %14d %14d %6.1f%%" % ("total", sum(t[0] for t in totals.values()), stored, raw,
+                                            100.0 * stored / max(raw, 1))
+
+    for cache in db.read_caches.values():
+        cache.clear()
+        cache.hits = cache.misses = 0
+    print
+    print "Read cache hit rates over the reads of the last %d blocks" % replay_reads(db, blocks)
+    print "%-14s %10s %10s %8s %14s" % ("namespace", "hits", "misses", "rate", "cached bytes")
+    stats = db.namespace_stats()
+    for ns in NAMESPACES:
+        s = stats[ns.name]
+        if s['hits'] or s['misses']:
+            print "%-14s %10d %10d %7.1f%% %14d" % (ns.name, s['hits'], s['misses'],
+                                                     100.0 * s['hits'] / (s['hits'] + s['misses']), s['size'])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1] if len(sys.argv) > 1 else './chain', int(sys.argv[2]) if len(sys.argv) > 2 else 100))
@@ -67,7 +67,11 @@ def mk_basic_state(alloc, header=None, env=None, executing_on_head=False):
         addr = normalize_address(addr)
         assert len(addr) == 20
         if 'balance' in data:
-            state.set_balance(addr, parse_as_int(data['balance']))
+            # A Balance, or its own ips as in the alloc of the genesis declaration
+            balance = data['balance']
+            if not isinstance(balance, Balance):
+                balance = Balance(balance['own_ips'])
+            state.set_balance(addr, balance)
         if 'nonce' in data:
             state.set_nonce(addr, parse_as_int(data['nonce']))
 
@@ -34,6 +34,8 @@ sudo pip install netaddr
 sudo pip install ipaddr
 sudo pip install ipaddress
 sudo pip install leveldb
+# Only needed with backend: lmdb in chain_config.cfg
+sudo pip install lmdb==0.99
 sudo pip install bitcoin
 sudo pip install twisted
 sudo pip install pytricia
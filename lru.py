@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+
+# Dictionary bounded to size entries, dropping the least recently used one. With
+# weigh, a function of (key, value), size bounds the total weight of the entries
+# instead (a budget in bytes for instance), and max_entries their number if given.
+# The weight of an entry is taken when it is put, a value that grows in the cache
+# is put again to update it
+class LRUCache(object):
+
+    def __init__(self, size, weigh=None, max_entries=None):
+        assert size > 0
+        self.size = size
+        self.weigh = weigh
+        self.max_entries = max_entries
+        self.weight = 0
+        self.weights = {}
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.weigh is None:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+            return
+        self.pop(key)
+        weight = self.weigh(key, value)
+        if weight > self.size:
+            return
+        self.data[key] = value
+        self.weights[key] = weight
+        self.weight += weight
+        while self.weight > self.size or self.max_entries is not None and len(self.data) > self.max_entries:
+            old_key, _ = self.data.popitem(last=False)
+            self.weight -= self.weights.pop(old_key)
+
+    def pop(self, key, default=None):
+        if self.weigh is not None and key in self.data:
+            self.weight -= self.weights.pop(key)
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+        self.weights.clear()
+        self.weight = 0
+
+    # size is the total weight for a weighed cache
+    def stats(self):
+        size = len(self.data) if self.weigh is None else self.weight
+        return {'size': size, 'max_size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
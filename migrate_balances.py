@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Prepares an existing chain database for the binary balance codec of balance.py.
+
+State roots are consensus data, so the stored states are not rewritten: legacy
+hex pickled balances stay readable and every node re-encodes a balance with the
+binary codec when a block changes it. The script converts the balances of the
+genesis snapshot, removes the state roots that earlier versions of it stored
+under 'state:<head hash>' in place of the header root, and reports how many
+balances of the head state still use the legacy encoding.
+
+Usage: python migrate_balances.py [chain_db_dir]
+"""
+
+import sys
+import json
+import rlp
+from rlp.utils import encode_hex
+from db import open_db
+from config import Env
+from state import State
+from block import Block
+from balance import decode_balance, encode_balance, is_legacy_balance
+from trie import BLANK_ROOT
+
+
+# Returns the post-state root of the block, the root stored by initialize_genesis_keys
+# for the genesis block
+def head_state_root(db, head_hash):
+    block_rlp = db.get(head_hash)
+    if block_rlp == 'GENESIS':
+        return db.get(b'state:' + head_hash)
+    return rlp.decode(block_rlp, Block).header.state_root
+
+
+def migrate_genesis_snapshot(db):
+    snapshot = json.loads(db.get('GENESIS_STATE'))
+    converted = 0
+    for addr, data in snapshot.get('alloc', {}).items():
+        if 'balance' in data and data['balance'][:2] != '0x':
+            data['balance'] = '0x' + encode_hex(encode_balance(decode_balance(data['balance'])))
+            converted += 1
+    if converted:
+        db.put('GENESIS_STATE', json.dumps(snapshot))
+    return converted
+
+
+# Deletes the root stored under 'state:<head hash>' by earlier versions of this script.
+# Returns False when the state under the header root is not in the database anymore
+def remove_root_override(db, head_hash):
+    if db.get(head_hash) == 'GENESIS' or b'state:' + head_hash not in db:
+        return True
+    root = head_state_root(db, head_hash)
+    if root != BLANK_ROOT and root not in db:
+        return False
+    db.delete(b'state:' + head_hash)
+    return True
+
+
+def count_legacy_balances(env, root):
+    state = State(root=root, env=env)
+    legacy = 0
+    total = 0
+    for addr, rlpdata in state.trie.iter_branch():
+        total += 1
+        if is_legacy_balance(rlp.decode(rlpdata)[1]):
+            legacy += 1
+    return legacy, total
+
+
+def run(path):
+    db = open_db(path)
+    env = Env(db)
+    if 'head_hash' not in db:
+        print "No head found in %s, nothing to migrate" % path
+        return 1
+    head_hash = db.get('head_hash')
+
+    print "Converting genesis snapshot..."
+    print "%d genesis balances converted" % migrate_genesis_snapshot(db)
+
+    if not remove_root_override(db, head_hash):
+        print "The state under the header root of the head block %s is missing, resync the node" % \
+            encode_hex(head_hash)
+        return 1
+    db.commit()
+    legacy, total = count_legacy_balances(env, head_state_root(db, head_hash))
+    print "%d of %d balances of the head state use the legacy encoding, converted when changed" % (legacy, total)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1] if len(sys.argv) > 1 else './chain'))
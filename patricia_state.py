@@ -2,6 +2,11 @@ import radix
 import pickle
 import os
 
+# The tree is pickled under this key of the chain database, in the batch of the
+# block that changed it, so that it can not get ahead of the stored head. Older
+# nodes kept it in this file, which is still read when the key is missing
+PATRICIA_KEY = b'patricia'
+PATRICIA_FILE = "./Patricia/patricia.p"
 
 
 class PatriciaState():
@@ -18,17 +23,24 @@ class PatriciaState():
         rnode = self.patricia.search_best(key)
         return rnode.data["address"]
 
-    def to_db(self):
+    # Like get_value, but None when no prefix holds key
+    def find_value(self, key):
+        rnode = self.patricia.search_best(key)
+        return None if rnode is None else rnode.data["address"]
+
+    # Puts the tree in db, written with the next commit
+    def to_db(self, db):
         for node in self.patricia.nodes():
             self.dic[node.prefix] = self.get_value(node.prefix)
-        if not os.path.exists((os.path.dirname("./Patricia/patricia.p"))):
-            os.makedirs(os.path.dirname("./Patricia/patricia.p"))
-        pickle.dump(self.dic, open("./Patricia/patricia.p", "wb"))
+        db.put(PATRICIA_KEY, pickle.dumps(self.dic, pickle.HIGHEST_PROTOCOL))
 
-    def from_db(self):
+    def from_db(self, db):
         try:
-            self.dic = pickle.load(open("./Patricia/patricia.p", "rb"))
-        except:
-            pass
+            self.dic = pickle.loads(db.get(PATRICIA_KEY))
+        except KeyError:
+            try:
+                self.dic = pickle.load(open(PATRICIA_FILE, "rb"))
+            except:
+                pass
         for key in self.dic:
             self.set_value(key,self.dic[key])
@@ -0,0 +1,412 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from netaddr import IPNetwork, IPAddress, IPRange, IPSet
+
+WIDTH = {4: 32, 6: 128}
+VERSIONS = (4, 6)
+
+# Below this number of intervals an operand is applied interval by interval
+# instead of sweeping over both sets
+_SWEEP_THRESHOLD = 32
+
+
+def _seq(version, items=()):
+    # IPv4 bounds fit in 4 byte unsigned ints, IPv6 ones need python longs
+    if version == 4:
+        return array('I', items)
+    return list(items)
+
+
+def _intervals(ips):
+    # Yields (version, first, last) for any IP network like object or iterable of them
+    if isinstance(ips, PrefixSet):
+        for version in VERSIONS:
+            for first, last in zip(ips._starts[version], ips._ends[version]):
+                yield version, first, last
+    elif isinstance(ips, (IPNetwork, IPRange)):
+        yield ips.version, ips.first, ips.last
+    elif isinstance(ips, IPAddress):
+        yield ips.version, int(ips), int(ips)
+    elif isinstance(ips, IPSet):
+        for cidr in ips.iter_cidrs():
+            yield cidr.version, cidr.first, cidr.last
+    elif isinstance(ips, basestring):
+        ipnet = IPNetwork(ips)
+        yield ipnet.version, ipnet.first, ipnet.last
+    else:
+        for item in ips:
+            for interval in _intervals(item):
+                yield interval
+
+
+def _coalesce(version, intervals):
+    # intervals must be sorted by start
+    starts = []
+    ends = []
+    for first, last in intervals:
+        if ends and first <= ends[-1] + 1:
+            if last > ends[-1]:
+                ends[-1] = last
+        else:
+            starts.append(first)
+            ends.append(last)
+    return _seq(version, starts), _seq(version, ends)
+
+
+def _union(version, s1, e1, s2, e2):
+    def merged():
+        i = j = 0
+        while i < len(s1) or j < len(s2):
+            if j >= len(s2) or (i < len(s1) and s1[i] <= s2[j]):
+                yield s1[i], e1[i]
+                i += 1
+            else:
+                yield s2[j], e2[j]
+                j += 1
+    return _coalesce(version, merged())
+
+
+def _intersection(version, s1, e1, s2, e2):
+    starts = []
+    ends = []
+    i = j = 0
+    while i < len(s1) and j < len(s2):
+        first = max(s1[i], s2[j])
+        last = min(e1[i], e2[j])
+        if first <= last:
+            starts.append(first)
+            ends.append(last)
+        if e1[i] < e2[j]:
+            i += 1
+        else:
+            j += 1
+    return _seq(version, starts), _seq(version, ends)
+
+
+def _difference(version, s1, e1, s2, e2):
+    starts = []
+    ends = []
+    j = 0
+    for i in range(len(s1)):
+        first, last = s1[i], e1[i]
+        while j < len(s2) and e2[j] < first:
+            j += 1
+        k = j
+        while k < len(s2) and s2[k] <= last and first <= last:
+            if s2[k] > first:
+                starts.append(first)
+                ends.append(s2[k] - 1)
+            first = e2[k] + 1
+            k += 1
+        if first <= last:
+            starts.append(first)
+            ends.append(last)
+    return _seq(version, starts), _seq(version, ends)
+
+
+def interval_to_cidrs(first, last, width):
+    # Yields the (network, prefixlen) pairs covering [first, last] from lowest to highest
+    while first <= last:
+        size = first & -first if first else 1 << width
+        while size > last - first + 1:
+            size >>= 1
+        yield first, width - size.bit_length() + 1
+        first += size
+
+
+class PrefixSet(object):
+    """
+    Set of IP addresses kept as sorted, disjoint and non adjacent [first, last]
+    integer intervals per IP version. Containment is a binary search and whole
+    set operations are linear sweeps. Iterating yields the CIDRs of the set.
+    """
+    __slots__ = ('_starts', '_ends')
+
+    def __init__(self, iterable=None):
+        self._starts = {4: _seq(4), 6: _seq(6)}
+        self._ends = {4: _seq(4), 6: _seq(6)}
+        if iterable is not None:
+            self.add(iterable)
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        # Builds a set from (version, first, last) triples in any order
+        by_version = {4: [], 6: []}
+        for version, first, last in intervals:
+            by_version[version].append((first, last))
+        o = cls()
+        for version in VERSIONS:
+            if by_version[version]:
+                by_version[version].sort()
+                o._starts[version], o._ends[version] = _coalesce(version, by_version[version])
+        return o
+
+    def _add_interval(self, version, first, last):
+        starts, ends = self._starts[version], self._ends[version]
+        # Intervals overlapping or adjacent to [first, last] are in [i, j)
+        i = bisect_left(ends, first - 1)
+        j = bisect_right(starts, last + 1)
+        if i < j:
+            first = min(first, starts[i])
+            last = max(last, ends[j - 1])
+        starts[i:j] = _seq(version, [first])
+        ends[i:j] = _seq(version, [last])
+
+    def _remove_interval(self, version, first, last):
+        starts, ends = self._starts[version], self._ends[version]
+        # Intervals overlapping [first, last] are in [i, j)
+        i = bisect_left(ends, first)
+        j = bisect_right(starts, last)
+        if i >= j:
+            return
+        new_starts = []
+        new_ends = []
+        if starts[i] < first:
+            new_starts.append(starts[i])
+            new_ends.append(first - 1)
+        if ends[j - 1] > last:
+            new_starts.append(last + 1)
+            new_ends.append(ends[j - 1])
+        starts[i:j] = _seq(version, new_starts)
+        ends[i:j] = _seq(version, new_ends)
+
+    def _intersect_interval(self, other, version, first, last):
+        # Appends other & [first, last], intervals must be given in increasing order
+        starts, ends = other._starts[version], other._ends[version]
+        i = bisect_left(ends, first)
+        j = bisect_right(starts, last)
+        for k in range(i, j):
+            self._starts[version].append(max(first, starts[k]))
+            self._ends[version].append(min(last, ends[k]))
+
+    def _contains_interval(self, version, first, last):
+        i = bisect_right(self._starts[version], first) - 1
+        return i >= 0 and self._ends[version][i] >= last
+
+    def _as_prefix_set(self, ips):
+        if isinstance(ips, PrefixSet):
+            return ips
+        return PrefixSet.from_intervals(_intervals(ips))
+
+    def add(self, ips):
+        other = self._as_prefix_set(ips)
+        for version in VERSIONS:
+            if len(other._starts[version]) <= _SWEEP_THRESHOLD:
+                for first, last in zip(other._starts[version], other._ends[version]):
+                    self._add_interval(version, first, last)
+            else:
+                self._starts[version], self._ends[version] = _union(
+                    version, self._starts[version], self._ends[version],
+                    other._starts[version], other._ends[version])
+
+    update = add
+
+    def remove(self, ips):
+        other = self._as_prefix_set(ips)
+        for version in VERSIONS:
+            if len(other._starts[version]) <= _SWEEP_THRESHOLD:
+                for first, last in zip(other._starts[version], other._ends[version]):
+                    self._remove_interval(version, first, last)
+            else:
+                self._starts[version], self._ends[version] = _difference(
+                    version, self._starts[version], self._ends[version],
+                    other._starts[version], other._ends[version])
+
+    def copy(self):
+        o = PrefixSet()
+        for version in VERSIONS:
+            o._starts[version] = self._starts[version][:]
+            o._ends[version] = self._ends[version][:]
+        return o
+
+    def union(self, ips):
+        o = self.copy()
+        o.add(ips)
+        return o
+
+    def difference(self, ips):
+        o = self.copy()
+        o.remove(ips)
+        return o
+
+    def intersection(self, ips):
+        other = self._as_prefix_set(ips)
+        o = PrefixSet()
+        for version in VERSIONS:
+            if len(other._starts[version]) <= _SWEEP_THRESHOLD:
+                for first, last in zip(other._starts[version], other._ends[version]):
+                    o._intersect_interval(self, version, first, last)
+                continue
+            o._starts[version], o._ends[version] = _intersection(
+                version, self._starts[version], self._ends[version],
+                other._starts[version], other._ends[version])
+        return o
+
+    __or__ = union
+    __sub__ = difference
+    __and__ = intersection
+
+    def isdisjoint(self, ips):
+        for version, first, last in _intervals(ips):
+            i = bisect_left(self._ends[version], first)
+            if i < len(self._starts[version]) and self._starts[version][i] <= last:
+                return False
+        return True
+
+    def __contains__(self, ips):
+        for version, first, last in _intervals(ips):
+            if not self._contains_interval(version, first, last):
+                return False
+        return True
+
+    def first(self):
+        # Lowest address of the set, IPv4 before IPv6
+        for version in VERSIONS:
+            if self._starts[version]:
+                return IPAddress(self._starts[version][0], version)
+        return None
+
+    @property
+    def size(self):
+        return sum(last - first + 1 for version, first, last in _intervals(self))
+
+    def __len__(self):
+        # Number of addresses, like IPSet. Use the truth value to test for emptiness,
+        # IPv6 sets easily hold more addresses than len() can return
+        return self.size
+
+    def __nonzero__(self):
+        return bool(self._starts[4]) or bool(self._starts[6])
+
+    def interval_count(self):
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def iter_intervals(self):
+        return _intervals(self)
+
+    def cidr_tuples(self):
+        # (version, network, prefixlen) of the CIDRs of the set, sorted by version and address
+        for version in VERSIONS:
+            width = WIDTH[version]
+            for first, last in zip(self._starts[version], self._ends[version]):
+                for network, prefixlen in interval_to_cidrs(first, last, width):
+                    yield version, network, prefixlen
+
+    def iter_cidrs(self):
+        return [IPNetwork((network, prefixlen), version=version)
+                for version, network, prefixlen in self.cidr_tuples()]
+
+    def __iter__(self):
+        for version, network, prefixlen in self.cidr_tuples():
+            yield IPNetwork((network, prefixlen), version=version)
+
+    def __eq__(self, other):
+        if not isinstance(other, PrefixSet):
+            return NotImplemented
+        return all(self._starts[v] == other._starts[v] and self._ends[v] == other._ends[v]
+                   for v in VERSIONS)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return [(list(self._starts[v]), list(self._ends[v])) for v in VERSIONS]
+
+    def __setstate__(self, state):
+        self._starts = {}
+        self._ends = {}
+        for version, (starts, ends) in zip(VERSIONS, state):
+            self._starts[version] = _seq(version, starts)
+            self._ends[version] = _seq(version, ends)
+
+    def __repr__(self):
+        return 'PrefixSet(%r)' % [str(cidr) for cidr in self]
+
+
+class PrefixMap(object):
+    """
+    Maps disjoint address intervals to values. Looking up the values overlapping
+    a prefix is a binary search plus the number of matches.
+    """
+    __slots__ = ('_starts', '_ends', '_values')
+
+    def __init__(self):
+        self._starts = {4: _seq(4), 6: _seq(6)}
+        self._ends = {4: _seq(4), 6: _seq(6)}
+        self._values = {4: [], 6: []}
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        # Builds a map from (version, first, last, value) in any order, None if any two overlap
+        by_version = {4: [], 6: []}
+        for version, first, last, value in intervals:
+            by_version[version].append((first, last, value))
+        o = cls()
+        for version in VERSIONS:
+            items = sorted(by_version[version])
+            for k in range(1, len(items)):
+                if items[k][0] <= items[k - 1][1]:
+                    return None
+            o._starts[version] = _seq(version, [item[0] for item in items])
+            o._ends[version] = _seq(version, [item[1] for item in items])
+            o._values[version] = [item[2] for item in items]
+        return o
+
+    def overlapping(self, ips):
+        # Yields (version, first, last, value) for the parts of ips that are mapped
+        for version, first, last in _intervals(ips):
+            starts, ends, values = self._starts[version], self._ends[version], self._values[version]
+            for k in range(bisect_left(ends, first), bisect_right(starts, last)):
+                yield version, max(first, starts[k]), min(last, ends[k]), values[k]
+
+    def set(self, ips, value):
+        for version, first, last in list(_intervals(ips)):
+            self._replace(version, first, last, value, None)
+
+    def remove(self, ips, value=None):
+        # Unmaps ips, or only the parts of it mapped to value if given
+        for version, first, last in list(_intervals(ips)):
+            self._replace(version, first, last, None, value)
+
+    def _replace(self, version, first, last, new_value, old_value):
+        starts, ends, values = self._starts[version], self._ends[version], self._values[version]
+        i = bisect_left(ends, first)
+        j = bisect_right(starts, last)
+        pieces = []
+        for k in range(i, j):
+            if old_value is not None and values[k] != old_value:
+                pieces.append((starts[k], ends[k], values[k]))
+                continue
+            if starts[k] < first:
+                pieces.append((starts[k], first - 1, values[k]))
+            if ends[k] > last:
+                pieces.append((last + 1, ends[k], values[k]))
+        if new_value is not None:
+            pieces.append((first, last, new_value))
+            pieces.sort()
+            # Join with the neighbours mapped to the same value
+            if i > 0 and ends[i - 1] + 1 == pieces[0][0] and values[i - 1] == pieces[0][2]:
+                i -= 1
+                pieces[0] = (starts[i], pieces[0][1], pieces[0][2])
+            if j < len(starts) and pieces[-1][1] + 1 == starts[j] and values[j] == pieces[-1][2]:
+                pieces[-1] = (pieces[-1][0], ends[j], pieces[-1][2])
+                j += 1
+        starts[i:j] = _seq(version, [p[0] for p in pieces])
+        ends[i:j] = _seq(version, [p[1] for p in pieces])
+        values[i:j] = [p[2] for p in pieces]
+
+    def copy(self):
+        o = PrefixMap()
+        for version in VERSIONS:
+            o._starts[version] = self._starts[version][:]
+            o._ends[version] = self._ends[version][:]
+            o._values[version] = self._values[version][:]
+        return o
+
+    def __len__(self):
+        return len(self._starts[4]) + len(self._starts[6])
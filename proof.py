@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Verification of the Merkle proofs made by Trie.get_proof, for clients that do not
+hold the chain database (e.g. map resolvers checking an answer).
+
+A proof is the list of rlp encoded trie nodes on the path to a key, root first.
+Checking it only needs the root hash from a trusted block header: state_root for
+accounts and balances, tx_root for transactions.
+"""
+
+import rlp
+from rlp.utils import encode_hex
+from utils import sha3
+from balance import decode_balance
+from transactions import Transaction
+
+BLANK_ROOT = sha3(rlp.encode(b''))
+
+
+class InvalidProof(Exception):
+    pass
+
+
+def _nibbles(key):
+    return [int(c, 16) for c in encode_hex(key)]
+
+
+# Nibbles of a packed node path, and whether it ends in a leaf
+def _unpack_path(packed):
+    if not isinstance(packed, bytes) or not packed:
+        raise InvalidProof("Invalid node path")
+    nibbles = _nibbles(packed)
+    flags = nibbles[0]
+    if flags > 3 or not flags & 1 and nibbles[1] != 0:
+        raise InvalidProof("Invalid node path")
+    return nibbles[1:] if flags & 1 else nibbles[2:], bool(flags & 2)
+
+
+# A value found in the trie, which must be a string
+def _value(value):
+    if not isinstance(value, bytes):
+        raise InvalidProof("Invalid value")
+    return value
+
+
+# Returns the value of key in the trie with root hash root, b'' if the proof shows the
+# key is not in it. Raises InvalidProof if the proof does not match the root
+def verify_proof(root, key, proof):
+    if root == BLANK_ROOT:
+        return b''
+    nodes = dict((sha3(node), node) for node in proof)
+    key = _nibbles(key)
+    ref = root
+    while True:
+        if isinstance(ref, list):
+            node = ref
+        elif ref == b'':
+            return b''
+        elif ref in nodes:
+            try:
+                node = rlp.decode(nodes[ref])
+            except Exception:
+                raise InvalidProof("Undecodable node %s" % encode_hex(ref))
+        else:
+            raise InvalidProof("Missing node %s" % encode_hex(ref))
+        if not isinstance(node, list):
+            raise InvalidProof("Invalid node")
+        if len(node) == 17:
+            if not key:
+                return _value(node[16])
+            ref = node[key[0]]
+            key = key[1:]
+        elif len(node) == 2:
+            path, leaf = _unpack_path(node[0])
+            if leaf:
+                return _value(node[1]) if key == path else b''
+            if key[:len(path)] != path:
+                return b''
+            ref = node[1]
+            key = key[len(path):]
+        else:
+            raise InvalidProof("Invalid node")
+
+
+# Returns the rlp of the account at address, b'' if it does not exist
+def verify_account_proof(state_root, address, proof):
+    return verify_proof(state_root, sha3(address), proof)
+
+
+# Returns the Balance of address, None if the account does not exist
+def verify_balance_proof(state_root, address, proof):
+    rlpdata = verify_account_proof(state_root, address, proof)
+    if not rlpdata:
+        return None
+    nonce, balance = rlp.decode(rlpdata)
+    return decode_balance(balance)
+
+
+# Returns the transaction at index of the block with tx_root, None if there is none
+def verify_transaction_proof(tx_root, index, proof):
+    rlpdata = verify_proof(tx_root, rlp.encode(index), proof)
+    if not rlpdata:
+        return None
+    return rlp.decode(rlpdata, Transaction)
@@ -0,0 +1,204 @@
+import logging
+from utils import sha3
+from db import RefcountDB
+from trie import Trie, BLANK_NODE, BLANK_ROOT, NODE_TYPE_BLANK, NODE_TYPE_BRANCH, NODE_TYPE_LEAF, \
+    NODE_TYPE_EXTENSION, unpack_to_nibbles, without_terminator
+
+databaseLog = logging.getLogger('Database')
+
+# Nodes removed from the head state by block N are listed under 'deathrow:N' and
+# released (refcount decremented, deleted at zero) once block N + keep_blocks is added,
+# so the states of the last keep_blocks blocks stay readable
+DEATHROW_PREFIX = b'deathrow:'
+# Lowest block number whose death row has not been fully released yet
+PRUNE_NEXT_KEY = b'prune:next'
+# Lowest block number whose state is still complete, absent before any release
+PRUNE_FLOOR_KEY = b'prune:floor'
+
+
+# Returns the lowest block number whose state has not been pruned
+def kept_floor(db):
+    try:
+        return int(db.get(PRUNE_FLOOR_KEY))
+    except KeyError:
+        return 0
+
+
+# Hashes of the stored nodes of the trie under old_root that are not part of the trie
+# under new_root at the same key path. A stored node holds one reference for each key
+# path it is written at (see Trie.commit), so the tries are walked side by side by path,
+# subtrees with the same hash at the same path are skipped and a node is listed once for
+# every path it leaves
+def removed_nodes(db, old_root, new_root):
+    if old_root == new_root or old_root == BLANK_ROOT:
+        return []
+    trie = Trie(RefcountDB(db))
+    removed = []
+    _diff(trie, old_root, None if new_root == BLANK_ROOT else (new_root, 0), removed)
+    return removed
+
+
+def _diff(trie, old_ref, new_pos, removed):
+    if new_pos is not None and new_pos[1] == 0 and new_pos[0] == old_ref:
+        return
+    # Inline nodes are not stored and can not hold stored ones
+    if isinstance(old_ref, list) or old_ref == BLANK_NODE:
+        return
+    removed.append(old_ref)
+    node = trie._decode_to_node(old_ref)
+    node_type = trie._get_node_type(node)
+    if node_type == NODE_TYPE_BRANCH:
+        for i in range(16):
+            if node[i] != BLANK_NODE and not isinstance(node[i], list):
+                _diff(trie, node[i], _descend(trie, new_pos, chr(i)), removed)
+    elif node_type == NODE_TYPE_EXTENSION:
+        key = without_terminator(unpack_to_nibbles(node[0]))
+        _diff(trie, node[1], _descend(trie, new_pos, key), removed)
+
+
+# Moves a position of the new trie down path. A position is (ref, skip), the node under
+# ref with the first skip nibbles of its key already consumed, or None past the trie
+def _descend(trie, pos, path):
+    if pos is None:
+        return None
+    ref, skip = pos
+    i = 0
+    while i < len(path):
+        node = trie._decode_to_node(ref)
+        node_type = trie._get_node_type(node)
+        if node_type == NODE_TYPE_BLANK:
+            return None
+        if node_type == NODE_TYPE_BRANCH:
+            ref, skip = node[ord(path[i])], 0
+            i += 1
+            continue
+        key = without_terminator(unpack_to_nibbles(node[0]))
+        n = min(len(key) - skip, len(path) - i)
+        if key[skip:skip + n] != path[i:i + n]:
+            return None
+        skip += n
+        i += n
+        if skip == len(key):
+            if node_type == NODE_TYPE_LEAF:
+                return None
+            ref, skip = node[1], 0
+    return ref, skip
+
+
+class Pruner(object):
+
+    def __init__(self, db, keep_blocks, batch_size=None):
+        assert keep_blocks > 0
+        self.db = db
+        self.refcount_db = RefcountDB(db)
+        self.keep_blocks = keep_blocks
+        self.batch_size = batch_size
+
+    # Records the nodes dropped from the head state by block number, then releases at
+    # most batch_size of the ones that left the kept window. Writes go to db, to be
+    # committed together with the block
+    def on_block(self, number, old_root, new_root):
+        removed = removed_nodes(self.db, old_root, new_root)
+        if removed:
+            self.db.put(DEATHROW_PREFIX + str(number), b''.join(removed))
+        if PRUNE_NEXT_KEY not in self.db:
+            self.db.put(PRUNE_NEXT_KEY, str(number))
+        released, deleted = self.prune(number, self.batch_size)
+        if released:
+            databaseLog.debug('Pruned state nodes: %d released, %d deleted', released, deleted)
+        return len(removed)
+
+    # Releases the death rows that are due with head at block number, limit nodes at
+    # most (all of them with None). Returns the numbers of released and deleted nodes
+    def prune(self, number, limit=None):
+        try:
+            epoch = int(self.db.get(PRUNE_NEXT_KEY))
+        except KeyError:
+            return 0, 0
+        released = deleted = 0
+        partial = False
+        while epoch <= number - self.keep_blocks and (limit is None or released < limit):
+            key = DEATHROW_PREFIX + str(epoch)
+            try:
+                hashes = self.db.get(key)
+            except KeyError:
+                hashes = b''
+            count = len(hashes) // 32
+            if limit is not None:
+                count = min(count, limit - released)
+            for i in range(count):
+                deleted += self._release(hashes[i * 32:(i + 1) * 32])
+            released += count
+            if count * 32 < len(hashes):
+                self.db.put(key, hashes[count * 32:])
+                partial = True
+                break
+            if hashes:
+                self.db.delete(key)
+            epoch += 1
+        self.db.put(PRUNE_NEXT_KEY, str(epoch))
+        # Releasing the death row of block N breaks the state of block N - 1
+        if released:
+            self._raise_floor(epoch if partial else epoch - 1)
+        self.refcount_db.commit()
+        return released, deleted
+
+    def _raise_floor(self, number):
+        if number > kept_floor(self.db):
+            self.db.put(PRUNE_FLOOR_KEY, str(number))
+
+    # Returns 1 when the node is deleted
+    def _release(self, h):
+        count = self.refcount_db.get_refcount(h)
+        if count == 0:
+            # Already removed by sweep
+            return 0
+        self.refcount_db.delete(h)
+        return 1 if count == 1 else 0
+
+    # Number of nodes waiting in death rows
+    def pending(self):
+        return sum(len(v) // 32 for k, v in self.db.iter_prefix(DEATHROW_PREFIX))
+
+    # Maintenance pass: releases every due death row at once, optionally sweeps the
+    # stored nodes not reachable from roots, commits and compacts the database
+    def compact(self, number, roots=None):
+        released, deleted = self.prune(number)
+        swept = 0
+        if roots is not None:
+            swept = self.sweep(roots)
+            self._raise_floor(number - self.keep_blocks)
+        self.db.commit()
+        if hasattr(self.db, 'compact'):
+            self.db.compact()
+        return {'released': released, 'deleted': deleted, 'swept': swept}
+
+    # Deletes the stored trie nodes that are not reachable from any of roots, whatever
+    # their refcount. This reclaims the nodes written before pruning was enabled, or
+    # by blocks outside of the head chain. roots must cover the whole kept window
+    def sweep(self, roots):
+        reachable = set()
+        trie = Trie(self.refcount_db)
+        for root in roots:
+            if root != BLANK_ROOT:
+                self._mark(trie, root, reachable)
+        swept = []
+        for k, v in self.db.iter_prefix(b''):
+            # Preimages are content addressed too, but shorter than any hashed node
+            if len(k) == 32 and len(v) >= 36 and k not in reachable and sha3(v[4:]) == k:
+                swept.append(k)
+        for k in swept:
+            self.db.delete(k)
+        return len(swept)
+
+    def _mark(self, trie, ref, reachable):
+        if isinstance(ref, list) or ref == BLANK_NODE or ref in reachable:
+            return
+        reachable.add(ref)
+        node = trie._decode_to_node(ref)
+        node_type = trie._get_node_type(node)
+        if node_type == NODE_TYPE_BRANCH:
+            for i in range(16):
+                self._mark(trie, node[i], reachable)
+        elif node_type == NODE_TYPE_EXTENSION:
+            self._mark(trie, node[1], reachable)
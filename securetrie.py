@@ -1,4 +1,18 @@
 import utils
+from trie import TrieCursor, BLANK_NODE
+from lru import LRUCache
+
+HASHED_KEY_CACHE_SIZE = 20000
+# Hashed keys by key, shared by all the secure tries
+hashed_keys = LRUCache(HASHED_KEY_CACHE_SIZE)
+
+
+def hash_key(k):
+    h = hashed_keys.get(k)
+    if h is None:
+        h = utils.sha3(k)
+        hashed_keys.put(k, h)
+    return h
 
 
 class SecureTrie(object):
@@ -6,30 +20,61 @@ class SecureTrie(object):
     def __init__(self, t):
         self.trie = t
         self.db = t.db
+        # Hashed keys whose preimage is known to be in db
+        self.preimages = LRUCache(HASHED_KEY_CACHE_SIZE)
 
     def update(self, k, v):
-        h = utils.sha3(k)
-        bytes = utils.str_to_bytes(k)
-        self.db.put(h, bytes)
-        self.trie.update(h, v)
+        self.trie.update(self._store_preimage(k), v)
+
+    # The preimage of a hashed key is written once per database, the first time the
+    # key is inserted. Keys found in preimages need no read nor write
+    def _store_preimage(self, k):
+        h = hash_key(k)
+        if self.preimages.get(h) is None:
+            if h not in self.db:
+                self.db.put(h, utils.str_to_bytes(k))
+            self.preimages.put(h, True)
+        return h
 
     def get(self, k):
-        return self.trie.get(utils.sha3(k))
+        return self.trie.get(hash_key(k))
+
+    def get_proof(self, k):
+        return self.trie.get_proof(hash_key(k))
 
+    # Preimages written on every update by older versions are released down to their
+    # last reference, older states holding the key may still be iterated
     def delete(self, k):
-        self.trie.delete(utils.sha3(k))
+        h = hash_key(k)
+        get_refcount = getattr(self.db, 'get_refcount', None)
+        if get_refcount is None:
+            self.trie.delete(h)
+            return
+        if self.trie.get(h) == BLANK_NODE:
+            return
+        self.trie.delete(h)
+        if get_refcount(h) > 1:
+            self.db.delete(h)
+
+    def build(self, items):
+        self.trie.build((self._store_preimage(k), v) for k, v in items)
 
     def to_dict(self):
-        o = {}
-        for h, v in list(self.trie.to_dict().items()):
-            k = self.db.get(h)
-            o[k] = v
-        return o
+        return dict(self.iter_items())
+
+    # Bounds are hashed keys, items come in hashed key order
+    def iter_items(self, start=None, end=None, prefix=None):
+        for h, v in self.trie.iter_items(start, end, prefix):
+            yield self.db.get(h), v
 
     def iter_branch(self):
-        for h, v in self.trie.iter_branch():
-            k = self.db.get(h)
-            yield (k, v)
+        return self.iter_items()
+
+    def cursor(self, start=None, end=None, prefix=None):
+        return TrieCursor(self.trie, start, end, prefix, preimages=self.db)
+
+    def commit(self):
+        self.trie.commit()
 
     def root_hash_valid(self):
         return self.trie.root_hash_valid()
@@ -50,11 +95,3 @@ class SecureTrie(object):
     def deletes(self, value):
         self.trie.deletes = value
 
-    def process_epoch(self, epoch):
-        self.trie.process_epoch(epoch)
-
-    def commit_death_row(self, epoch):
-        self.trie.commit_death_row(epoch)
-
-    def revert_epoch(self, epoch):
-        self.trie.revert_epoch(epoch)
\ No newline at end of file
@@ -5,9 +5,11 @@ import trie
 from trie import Trie
 from securetrie import SecureTrie
 from config import default_config, Env
-from db import RefcountDB, OverlayDB
+from db import RefcountDB, OverlayDB, instrument_layer
 import copy
+import struct
 from account import Account
+from balance import encode_balance, decode_balance
 from trie import BLANK_ROOT
 from block import FakeHeader
 from rlp.utils import encode_hex
@@ -15,6 +17,15 @@ import logging
 
 databaseLog = logging.getLogger('Database')
 
+# Flat index of the head state: 'address:<addr>' holds the rlp of every account of the
+# head trie, ADDRESS_INDEX_ROOT the state root the index is in sync with
+ADDRESS_INDEX_PREFIX = b'address:'
+ADDRESS_INDEX_ROOT = b'address_index:root'
+# Number of indexed addresses under every prefix of the first ADDRESS_COUNT_DEPTH bits,
+# used to find the i-th address in order without scanning the index
+ADDRESS_COUNT_PREFIX = b'address_count:'
+ADDRESS_COUNT_DEPTH = 16
+
 STATE_DEFAULTS = {
     "txindex": 0,
     "block_number": 0,
@@ -27,7 +38,7 @@ STATE_DEFAULTS = {
 class State():
     def __init__(self, root=b'', env=Env(), executing_on_head=False, **kwargs):
         self.env = env
-        self.trie = SecureTrie(Trie(RefcountDB(self.db), root))
+        self.trie = SecureTrie(Trie(instrument_layer(RefcountDB(self.db), self.db, 'refcount'), root, deferred=True))
         self.txindex = STATE_DEFAULTS['txindex']
         self.block_number = STATE_DEFAULTS['block_number']
         self.block_coinbase = STATE_DEFAULTS['block_coinbase']
@@ -35,8 +46,17 @@ class State():
         self.prev_headers = STATE_DEFAULTS['prev_headers']
         self.journal = []
         self.cache = {}
+        # Decoded balances, shared with callers. Entries in dirty_balances are
+        # encoded back into their account on commit
+        self.balances = {}
+        self.dirty_balances = set()
         self.changed = {}
         self.executing_on_head = executing_on_head
+        # State this one was cloned from and its root at the time, see clone()
+        self.parent = None
+        self.parent_root = None
+        # Last known value of ADDRESS_INDEX_ROOT, loaded on first use
+        self.address_index_root = None
 
     @property
     def db(self):
@@ -59,11 +79,11 @@ class State():
     def get_and_cache_account(self, address):
         if address in self.cache:
             return self.cache[address]
-        if self.executing_on_head and False:
+        if self.executing_on_head and self.address_index_valid():
             try:
-                rlpdata = self.db.get(b'address:' + address)
+                rlpdata = self.db.get(ADDRESS_INDEX_PREFIX + address)
             except KeyError:
-                rlpdata = b''
+                rlpdata = trie.BLANK_NODE
         else:
             rlpdata = self.trie.get(address)
         if rlpdata != trie.BLANK_NODE:
@@ -76,10 +96,22 @@ class State():
         o._cached_rlp = None
         return o
 
-    def get_balance(self, address):
-        balance = self.get_and_cache_account(
-            utils.normalize_address(address)).balance
-        return utils.bin_to_object(balance)
+    # The returned Balance is shared and must not be modified unless writable is set,
+    # in which case a private copy is returned that can be passed to set_balance
+    def get_balance(self, address, writable=False):
+        address = utils.normalize_address(address)
+        if address in self.balances:
+            balance = self.balances[address]
+        elif self.parent is not None and address in self.parent.balances:
+            # Clean in the parent (dirty ones are copied by clone), so it matches our trie
+            balance = self.parent.balances[address]
+            self.balances[address] = balance
+        else:
+            balance = decode_balance(self.get_and_cache_account(address).balance)
+            self.balances[address] = balance
+        if writable:
+            return balance.copy()
+        return balance
 
     def get_nonce(self, address):
         return self.get_and_cache_account(utils.normalize_address(address)).nonce
@@ -90,12 +122,31 @@ class State():
         self.journal.append(lambda: setattr(acct, param, preval))
         setattr(acct, param, val)
 
+    # The state takes ownership of balance, it is encoded on commit
     def set_balance(self, address, balance):
-        balance = utils.object_to_bin(balance)
-        acct = self.get_and_cache_account(utils.normalize_address(address))
-        self.set_and_journal(acct, 'balance', balance)
+        address = utils.normalize_address(address)
+        acct = self.get_and_cache_account(address)
+        prebal = self.balances.get(address)
+        predirty = address in self.dirty_balances
+        self.journal.append(lambda: self._restore_balance(address, prebal, predirty))
+        self.balances[address] = balance
+        self.dirty_balances.add(address)
         self.set_and_journal(acct, 'touched', True)
 
+    def _restore_balance(self, address, balance, dirty):
+        if balance is None:
+            self.balances.pop(address, None)
+        else:
+            self.balances[address] = balance
+        if not dirty:
+            self.dirty_balances.discard(address)
+
+    # Encodes the modified balances into their accounts
+    def flush_balances(self):
+        for addr in self.dirty_balances:
+            acct = self.get_and_cache_account(addr)
+            self.set_and_journal(acct, 'balance', encode_balance(self.balances[addr]))
+
     def set_code(self, address, value):
         # assert is_string(value)
         acct = self.get_and_cache_account(utils.normalize_address(address))
@@ -140,29 +191,123 @@ class State():
         return False
 
     def account_to_dict(self, address):
+        self.flush_balances()
         return self.get_and_cache_account(utils.normalize_address(address)).to_dict()
 
     def commit(self, allow_empties=False):
+        self.flush_balances()
+        # The remaining decoded balances match the committed state and stay cached
+        self.dirty_balances = set()
+        index_valid = self.executing_on_head and self.address_index_valid()
         for addr, acct in self.cache.items():
             if acct.touched or acct.deleted:
                 acct.commit()
                 self.changed[addr] = True
                 if self.account_exists(addr) or allow_empties:
-                    rlp.encode(acct)
-                    self.trie.update(addr, rlp.encode(acct))
-                    if self.executing_on_head:
-                        self.db.put(b'address:' + addr, rlp.encode(acct))
+                    rlpdata = rlp.encode(acct)
+                    self.trie.update(addr, rlpdata)
                 else:
+                    rlpdata = trie.BLANK_NODE
                     self.trie.delete(addr)
-                    if self.executing_on_head:
-                        try:
-                            self.db.delete(b'address:' + addr)
-                        except KeyError:
-                            pass
+                if self.executing_on_head:
+                    self._write_address_index(addr, rlpdata)
+        self.trie.commit()
+        # Folds the refcount changes of the written nodes into the database
+        self.trie.db.commit()
+        if index_valid:
+            self._set_address_index_root(self.trie.root_hash)
         self.trie.deletes = []
         self.cache = {}
         self.journal = []
 
+    def address_index_valid(self):
+        if self.address_index_root is None:
+            try:
+                self.address_index_root = self.db.get(ADDRESS_INDEX_ROOT)
+            except KeyError:
+                self.address_index_root = b''
+        return self.address_index_root == self.trie.root_hash
+
+    def _set_address_index_root(self, root):
+        if root != self.address_index_root:
+            self.db.put(ADDRESS_INDEX_ROOT, root)
+            self.address_index_root = root
+
+    def _write_address_index(self, addr, rlpdata):
+        key = ADDRESS_INDEX_PREFIX + addr
+        indexed = key in self.db
+        if rlpdata != trie.BLANK_NODE:
+            self.db.put(key, rlpdata)
+            if not indexed:
+                self._count_address(addr, 1)
+        elif indexed:
+            self.db.delete(key)
+            self._count_address(addr, -1)
+
+    def _address_count(self, depth, bits):
+        try:
+            return struct.unpack('>Q', self.db.get(ADDRESS_COUNT_PREFIX + struct.pack('>BH', depth, bits)))[0]
+        except KeyError:
+            return 0
+
+    # Counts per (depth, prefix bits) of the count tree for the given addresses
+    @staticmethod
+    def _address_counts(addrs):
+        counts = {}
+        for addr in addrs:
+            top = struct.unpack('>H', addr[:2])[0]
+            for depth in range(ADDRESS_COUNT_DEPTH + 1):
+                key = (depth, top >> (ADDRESS_COUNT_DEPTH - depth))
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def _count_address(self, addr, delta):
+        top = struct.unpack('>H', addr[:2])[0]
+        for depth in range(ADDRESS_COUNT_DEPTH + 1):
+            bits = top >> (ADDRESS_COUNT_DEPTH - depth)
+            key = ADDRESS_COUNT_PREFIX + struct.pack('>BH', depth, bits)
+            count = self._address_count(depth, bits) + delta
+            if count:
+                self.db.put(key, struct.pack('>Q', count))
+            else:
+                self.db.delete(key)
+
+    # Rewrites the address index from the trie, returns the number of accounts
+    def rebuild_address_index(self):
+        for prefix in (ADDRESS_INDEX_PREFIX, ADDRESS_COUNT_PREFIX):
+            for key, _ in list(self.db.iter_prefix(prefix)):
+                self.db.delete(key)
+        addrs = []
+        for addr, rlpdata in self.trie.iter_branch():
+            self.db.put(ADDRESS_INDEX_PREFIX + addr, rlpdata)
+            addrs.append(addr)
+        counts = self._address_counts(addrs)
+        for (depth, bits), count in counts.items():
+            self.db.put(ADDRESS_COUNT_PREFIX + struct.pack('>BH', depth, bits), struct.pack('>Q', count))
+        self._set_address_index_root(self.trie.root_hash)
+        return counts.get((0, 0), 0)
+
+    # Compares the address index with the trie. Returns the addresses missing from the
+    # index, the ones whose entry differs, the ones not in the trie and whether the
+    # address counts are right
+    def verify_address_index(self):
+        accounts = self.trie.to_dict()
+        missing = set(accounts.keys())
+        mismatched = []
+        extra = []
+        for key, rlpdata in self.db.iter_prefix(ADDRESS_INDEX_PREFIX):
+            addr = key[len(ADDRESS_INDEX_PREFIX):]
+            if addr not in accounts:
+                extra.append(addr)
+                continue
+            missing.discard(addr)
+            if accounts[addr] != rlpdata:
+                mismatched.append(addr)
+        stored = {}
+        for key, value in self.db.iter_prefix(ADDRESS_COUNT_PREFIX):
+            stored[struct.unpack('>BH', key[len(ADDRESS_COUNT_PREFIX):])] = struct.unpack('>Q', value)[0]
+        return sorted(missing), mismatched, extra, stored == self._address_counts(accounts)
+
     def load_state(env, alloc):
         db = env.db
         state = SecureTrie(Trie(db, BLANK_ROOT))
@@ -219,11 +364,21 @@ class State():
                                         for h in headers] for n, headers in v.items()}
         return snapshot
 
+    # Yields (hex address, account dict) for every account, uncommitted changes
+    # included, streaming the trie instead of loading every account in the cache
+    def iter_accounts(self):
+        self.flush_balances()
+        for addr, rlpdata in self.trie.iter_branch():
+            acct = self.cache.get(addr)
+            if acct is None:
+                acct = rlp.decode(rlpdata, Account, env=self.env, address=addr)
+            yield encode_hex(addr), acct.to_dict()
+        for addr, acct in self.cache.items():
+            if self.trie.get(addr) == trie.BLANK_NODE:
+                yield encode_hex(addr), acct.to_dict()
+
     def to_dict(self):
-        for addr in self.trie.to_dict().keys():
-            self.get_and_cache_account(addr)
-        return {encode_hex(addr): acct.to_dict()
-                for addr, acct in self.cache.items()}
+        return dict(self.iter_accounts())
 
     # Creates a state from a snapshot
     @classmethod
@@ -235,45 +390,11 @@ class State():
                     addr = decode_hex(addr)
                 assert len(addr) == 20
                 if 'balance' in data:
-                    state.set_balance(addr, parse_as_int(data['balance']))
-                if 'nonce' in data:
-                    state.set_nonce(addr, parse_as_int(data['nonce']))
-        elif "state_root" in snapshot_data:
-            state.trie.root_hash = parse_as_bin(snapshot_data["state_root"])
-        else:
-            raise Exception(
-                "Must specify either alloc or state root parameter")
-        for k, default in STATE_DEFAULTS.items():
-            default = copy.copy(default)
-            v = snapshot_data[k] if k in snapshot_data else None
-            if is_numeric(default):
-                setattr(state, k, parse_as_int(v)
-                if k in snapshot_data else default)
-            elif is_string(default):
-                setattr(state, k, parse_as_bin(v)
-                if k in snapshot_data else default)
-            elif k == 'prev_headers':
-                if k in snapshot_data:
-                    headers = [dict_to_prev_header(h) for h in v]
-                else:
-                    headers = default
-                setattr(state, k, headers)
-        if executing_on_head:
-            state.executing_on_head = True
-        state.commit()
-        state.changed = {}
-        return state
-
-    @classmethod
-    def from_snapshot(cls, snapshot_data, env, executing_on_head=False):
-        state = State(env=env)
-        if "alloc" in snapshot_data:
-            for addr, data in snapshot_data["alloc"].items():
-                if len(addr) == 40:
-                    addr = decode_hex(addr)
-                assert len(addr) == 20
-                if 'balance' in data:
-                    state.set_balance(addr, utils.bin_to_object(data['balance']))
+                    balance = data['balance']
+                    # Snapshots written before the binary codec hold the hex pickle as is
+                    if balance[:2] == '0x':
+                        balance = parse_as_bin(balance)
+                    state.set_balance(addr, decode_balance(balance))
                 if 'nonce' in data:
                     state.set_nonce(addr, parse_as_int(data['nonce']))
         elif "state_root" in snapshot_data:
@@ -316,29 +437,106 @@ class State():
                 databaseLog.exception(e)
         if h != self.trie.root_hash:
             assert L == 0
+            index_valid = self.executing_on_head and self.address_index_valid()
             self.trie.root_hash = h
+            if self.executing_on_head:
+                # Undo the index entries of the reverted commits
+                for addr in self.changed:
+                    self._write_address_index(addr, self.trie.get(addr))
+                if index_valid:
+                    self._set_address_index_root(h)
             self.cache = {}
+            self.balances = {}
+            self.dirty_balances = set()
         for k in STATE_DEFAULTS:
             setattr(self, k, copy.copy(auxvars[k]))
 
+    # Speculative child state. Reads fall through to this state's cache and database,
+    # writes stay in an OverlayDB, so the child can be modified and thrown away at the
+    # cost of the accounts it touches. It is only valid while this state is unchanged
     def clone(self):
-        snapshot = self.to_snapshot(root_only=True, no_prevblocks=True)
-        env2 = Env(OverlayDB(self.env.db), self.env.config)
-        s = State.from_snapshot(snapshot, env2)
+        env2 = Env(instrument_layer(OverlayDB(self.env.db), self.env.db, 'overlay'), self.env.config)
+        s = State(root=self.trie.root_hash, env=env2)
         for param in STATE_DEFAULTS:
             setattr(s, param, getattr(self, param))
-        s.prev_headers = self.prev_headers
-        for acct in self.cache.values():
-            assert not acct.touched
-        s.journal = copy.copy(self.journal)
-        s.cache = {}
+        s.parent = self
+        s.parent_root = self.trie.root_hash
+        # Uncommitted changes of this state are carried over
+        for addr, acct in self.cache.items():
+            if acct.touched or acct.deleted:
+                s.cache[addr] = acct.copy(env2)
+        for addr in self.dirty_balances:
+            s.balances[addr] = self.balances[addr]
+            s.dirty_balances.add(addr)
         return s
 
+    # Whether child, a clone of this state, can be adopted with adopt()
+    def can_adopt(self, child):
+        return child.parent is self and child.parent_root == self.trie.root_hash and not child.journal and \
+            not any(acct.touched or acct.deleted for acct in self.cache.values())
+
+    # Takes over the committed changes of child
+    def adopt(self, child):
+        assert self.can_adopt(child)
+        child.env.db.flush()
+        index_valid = self.executing_on_head and self.address_index_valid()
+        self.trie.root_hash = child.trie.root_hash
+        self.cache = {}
+        self.journal = []
+        for addr in child.changed:
+            self.changed[addr] = True
+            if addr in child.balances:
+                self.balances[addr] = child.balances[addr]
+            else:
+                self.balances.pop(addr, None)
+            if self.executing_on_head:
+                self._write_address_index(addr, self.trie.get(addr))
+        if index_valid:
+            self._set_address_index_root(self.trie.root_hash)
+        for k in STATE_DEFAULTS:
+            setattr(self, k, getattr(child, k))
+
+    # Yields the address of every account, in address order when the address index
+    # can be used and in trie order otherwise
+    def iter_addresses(self):
+        if self.executing_on_head and self.address_index_valid():
+            for key, _ in self.db.iter_prefix(ADDRESS_INDEX_PREFIX):
+                yield key[len(ADDRESS_INDEX_PREFIX):]
+        else:
+            for addr, _ in self.trie.iter_branch():
+                yield addr
+
     def list_all_addresses(self):
-        all_addresses = []
-        for addr in self.trie.to_dict().keys():
-            all_addresses.append(addr)
-        return all_addresses    
+        return list(self.iter_addresses())
+
+    def address_count(self):
+        if self.executing_on_head and self.address_index_valid():
+            return self._address_count(0, 0)
+        return sum(1 for _ in self.trie.iter_branch())
+
+    # Returns the addresses at the given positions of the sorted list of all addresses
+    def addresses_at(self, positions):
+        if not (self.executing_on_head and self.address_index_valid()):
+            addrs = sorted(self.iter_addresses())
+            return [addrs[i] for i in positions]
+        return [self._address_at(i) for i in positions]
+
+    def _address_at(self, i):
+        if not 0 <= i < self._address_count(0, 0):
+            raise IndexError(i)
+        # Walk down the count tree, then scan the few addresses of the leaf prefix
+        bits = 0
+        for depth in range(1, ADDRESS_COUNT_DEPTH + 1):
+            bits <<= 1
+            count = self._address_count(depth, bits)
+            if i >= count:
+                i -= count
+                bits |= 1
+        for key, _ in self.db.iter_prefix(ADDRESS_INDEX_PREFIX + struct.pack('>H', bits)):
+            if i == 0:
+                return key[len(ADDRESS_INDEX_PREFIX):]
+            i -= 1
+        raise IndexError(i)
             
                     
 def prev_header_to_dict(h):
@@ -3,10 +3,9 @@ from rlp.sedes import big_endian_int, BigEndianInt, binary, raw
 
 from utils import (address, normalize_address, sha3, normalize_key, ecsign,
                    privtoaddr, ecrecover_to_pub, int_to_bytes,
-                   encode_hex, bytes_to_int, encode_int8)
+                   encode_hex, bytes_to_int, encode_int8, bin_to_prefix)
 from own_exceptions import InvalidTransaction
 from ipaddr import IPv4Network, IPv6Network, IPv4Address, IPv6Address, Bytes
-from netaddr import IPNetwork
 
 secpk1n = 115792089237316195423570985008687907852837564279074904382605163141518161494337
 null_address = b'\xff' * 20
@@ -254,12 +253,8 @@ class Transaction(rlp.Serializable):
     @property
     def ip_network(self):
         if self.afi == 1:
-            ip = IPv4Address(Bytes(self.value[:4]))
-            ipnet = IPv4Network(str(ip) + '/' + str(bytes_to_int(self.value[4])))
-        else:
-            ip = IPv6Address(Bytes(self.value[:16]))
-            ipnet = IPv6Network(str(ip) + '/' + str(bytes_to_int(self.value[16])))
-        return IPNetwork(str(ipnet))
+            return bin_to_prefix(self.value[:5])
+        return bin_to_prefix(self.value[:17])
 
     def to_dict(self):
         d = {}
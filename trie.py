@@ -1,6 +1,11 @@
+import itertools
+import string
+import binascii
 import utils
 import rlp
-from rlp.utils import ascii_chr, str_to_bytes
+from rlp.utils import str_to_bytes
+from db import BaseDB
+from lru import LRUCache
 
 (
     NODE_TYPE_BLANK,
@@ -11,10 +16,15 @@ from rlp.utils import ascii_chr, str_to_bytes
 
 BLANK_NODE = b''
 BLANK_ROOT = utils.sha3rlp(b'')
-bin_to_nibbles_cache = {}
 
 
 NIBBLE_TERMINATOR = 16
+# Nibble paths are strings holding one nibble (0 to 15, or the terminator) per
+# character. They are immutable and compare like the lists of nibbles would
+TERMINATOR = chr(NIBBLE_TERMINATOR)
+NIBBLES = b''.join(chr(i) for i in range(16))
+HEX_TO_NIBBLE = string.maketrans(b'0123456789abcdef', NIBBLES)
+NIBBLE_TO_HEX = string.maketrans(NIBBLES, b'0123456789abcdef')
 
 def is_key_value_type(node_type):
     return node_type in [NODE_TYPE_LEAF,NODE_TYPE_EXTENSION]
@@ -36,40 +46,28 @@ def length_prefix(length, offset):
         length_string = utils.int_to_big_endian(length)
     return chr(offset + 56 - 1 + len(length_string)) + length_string
 
-hti = {}
-for i, c in enumerate(b'0123456789abcdef'):
-    hti[c] = i
-for i, c in enumerate('0123456789abcdef'):
-    hti[c] = i
-
-
 def bin_to_nibbles(s):
-    return [hti[c] for c in utils.encode_hex(s)]
+    return binascii.hexlify(s).translate(HEX_TO_NIBBLE)
 
 
 def nibbles_to_bin(nibbles):
-    if any(x > 15 or x < 0 for x in nibbles):
+    if nibbles.translate(None, NIBBLES):
         raise Exception("nibbles can only be [0,..15]")
 
     if len(nibbles) % 2:
         raise Exception("nibbles must be of even numbers")
 
-    res = b''
-    for i in range(0, len(nibbles), 2):
-        res += ascii_chr(16 * nibbles[i] + nibbles[i + 1])
-    return res
+    return binascii.unhexlify(nibbles.translate(NIBBLE_TO_HEX))
 
 def with_terminator(nibbles):
-    nibbles = nibbles[:]
-    if not nibbles or nibbles[-1] != NIBBLE_TERMINATOR:
-        nibbles.append(NIBBLE_TERMINATOR)
-    return nibbles
+    if nibbles[-1:] == TERMINATOR:
+        return nibbles
+    return nibbles + TERMINATOR
 
 
 def without_terminator(nibbles):
-    nibbles = nibbles[:]
-    if nibbles and nibbles[-1] == NIBBLE_TERMINATOR:
-        del nibbles[-1]
+    if nibbles[-1:] == TERMINATOR:
+        return nibbles[:-1]
     return nibbles
 
 
@@ -81,67 +79,220 @@ def adapt_terminator(nibbles, has_terminator):
 
 
 def pack_nibbles(nibbles):
-    if nibbles[-1:] == [NIBBLE_TERMINATOR]:
+    if nibbles[-1:] == TERMINATOR:
         flags = 2
         nibbles = nibbles[:-1]
     else:
         flags = 0
-    oddlen = len(nibbles) % 2
-    flags |= oddlen
-    if oddlen:
-        nibbles = [flags] + nibbles
+    if len(nibbles) % 2:
+        nibbles = chr(flags | 1) + nibbles
     else:
-        nibbles = [flags, 0] + nibbles
-    o = b''
-    for i in range(0, len(nibbles), 2):
-        o += ascii_chr(16 * nibbles[i] + nibbles[i + 1])
-    return o
+        nibbles = chr(flags) + b'\x00' + nibbles
+    return binascii.unhexlify(nibbles.translate(NIBBLE_TO_HEX))
 
 
 def unpack_to_nibbles(bindata):
     o = bin_to_nibbles(bindata)
-    flags = o[0]
+    flags = ord(o[0])
     if flags & 2:
-        o.append(NIBBLE_TERMINATOR)
+        o += TERMINATOR
     if flags & 1 == 1:
-        o = o[1:]
-    else:
-        o = o[2:]
-    return o
+        return o[1:]
+    return o[2:]
 
 
 def starts_with(full, part):
-    if len(full) < len(part):
-        return False
-    return full[:len(part)] == part
+    return full.startswith(part)
+
+
+# Returns the root hash of the trie holding the (key, value) pairs of items, which must
+# come sorted by key, building every node once instead of inserting the pairs one by
+# one. When db is given the hashed nodes are written to it. The root is the same as
+# the one of a Trie updated with the same pairs (later values win for repeated keys)
+def build_root(items, db=None):
+    keys = []
+    values = []
+    for key, value in items:
+        nibbles = bin_to_nibbles(utils.to_string(key))
+        if keys and nibbles == keys[-1]:
+            values[-1] = utils.to_string(value)
+            continue
+        if keys and nibbles < keys[-1]:
+            raise Exception("Items must be sorted by key")
+        keys.append(nibbles)
+        values.append(utils.to_string(value))
+    if not keys:
+        return BLANK_ROOT
+
+    def encode(node):
+        rlpnode = encode_optimized(node)
+        if len(rlpnode) < 32:
+            return node
+        hashkey = utils.sha3(rlpnode)
+        if db is not None:
+            db.put(hashkey, str_to_bytes(rlpnode))
+        return hashkey
+
+    # Node for keys[lo:hi], which share their first depth nibbles
+    def build(lo, hi, depth):
+        first = keys[lo]
+        if hi - lo == 1:
+            return [pack_nibbles(with_terminator(first[depth:])), values[lo]]
+        # Keys are sorted, so the first and last ones give the common prefix of all
+        last = keys[hi - 1]
+        prefix = depth
+        end = min(len(first), len(last))
+        while prefix < end and first[prefix] == last[prefix]:
+            prefix += 1
+        if prefix > depth:
+            return [pack_nibbles(first[depth:prefix]), encode(build(lo, hi, prefix))]
+        node = [BLANK_NODE] * 17
+        if len(first) == depth:
+            node[16] = values[lo]
+            lo += 1
+        while lo < hi:
+            nibble = keys[lo][depth]
+            end = lo + 1
+            while end < hi and keys[end][depth] == nibble:
+                end += 1
+            node[ord(nibble)] = encode(build(lo, end, depth + 1))
+            lo = end
+        return node
+
+    rlpnode = encode_optimized(build(0, len(keys), 0))
+    root_hash = utils.sha3(rlpnode)
+    if db is not None:
+        db.put(root_hash, str_to_bytes(rlpnode))
+    return root_hash
+
+
+# Maximum number of decoded nodes kept per database, 0 disables the cache
+NODE_CACHE_SIZE = 20000
+
+
+# Returns the LRU of decoded nodes by hash shared by all the tries on the database
+# under db (looking through RefcountDB, OverlayDB... wrappers). Nodes are content
+# addressed, so entries never need to be invalidated
+def get_node_cache(db):
+    while isinstance(getattr(db, 'db', None), BaseDB):
+        db = db.db
+    cache = getattr(db, 'node_cache', None)
+    if cache is None and NODE_CACHE_SIZE:
+        cache = db.node_cache = LRUCache(NODE_CACHE_SIZE)
+    return cache
 
 
 class Trie(object):
-    def __init__(self, db, root_hash=BLANK_ROOT):
+    # With deferred set, updates and deletes keep the changed nodes in memory, as lists
+    # in place of their hashes, and only the nodes still in the trie are hashed and
+    # written when the root hash is needed (see commit). Deleted nodes are not tracked
+    # in deletes in this mode
+    def __init__(self, db, root_hash=BLANK_ROOT, deferred=False):
         self.db = db  # Pass in a database object directly
+        self.node_cache = get_node_cache(db)
+        self.deferred = deferred
+        self.dirty = False
         self.set_root_hash(root_hash)
         self.deletes = []
 
     @property
     def root_hash(self):
+        if self.dirty:
+            self.commit()
         return self._root_hash
 
     def get_root_hash(self):
-        return self._root_hash
+        return self.root_hash
 
     def _update_root_hash(self):
+        if self.deferred:
+            self.dirty = True
+            return
         val = encode_optimized(self.root_node)
         key = utils.sha3(val)
         self.db.put(key, str_to_bytes(val))
         self._root_hash = key
 
+    # Hashes and writes the nodes changed since the last commit in deferred mode. A node
+    # with the hash of the committed node at the same key path is already stored and
+    # counted for that path, so it is not written again
+    def commit(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        old_root = self._root_hash
+        self.root_node = self._commit_node(self.root_node, None if old_root == BLANK_ROOT else old_root)
+        val = encode_optimized(self.root_node)
+        key = utils.sha3(val)
+        if key != old_root:
+            self.db.put(key, str_to_bytes(val))
+        self._root_hash = key
+
+    # Returns node with its in memory children replaced by their encoding. old_ref is
+    # the reference of the committed node at the same key path, or None
+    def _commit_node(self, node, old_ref):
+        if node == BLANK_NODE:
+            return node
+        if len(node) == 17:
+            children = range(16)
+        elif isinstance(node[1], list):
+            children = [1]
+        else:
+            return node
+        new_node = None
+        for i in children:
+            if isinstance(node[i], list):
+                path = chr(i) if len(node) == 17 else without_terminator(unpack_to_nibbles(node[0]))
+                old_child = self._ref_at(old_ref, path)
+                child = self._commit_node(node[i], old_child)
+                rlpnode = encode_optimized(child)
+                if len(rlpnode) < 32:
+                    encoded = child
+                else:
+                    encoded = utils.sha3(rlpnode)
+                    if encoded != old_child:
+                        self.db.put(encoded, str_to_bytes(rlpnode))
+                if encoded is not node[i]:
+                    if new_node is None:
+                        new_node = node[:]
+                    new_node[i] = encoded
+        return node if new_node is None else new_node
+
+    # Reference of the committed node at path below the node under ref, or None when
+    # no node starts at that path
+    def _ref_at(self, ref, path):
+        while path:
+            if ref is None or ref == BLANK_NODE:
+                return None
+            node = self._decode_to_node(ref)
+            node_type = self._get_node_type(node)
+            if node_type == NODE_TYPE_BRANCH:
+                ref, path = node[ord(path[0])], path[1:]
+            elif node_type == NODE_TYPE_EXTENSION:
+                key = without_terminator(unpack_to_nibbles(node[0]))
+                if path[:len(key)] != key:
+                    return None
+                ref, path = node[1], path[len(key):]
+            else:
+                return None
+        return ref
+
     @root_hash.setter
     def root_hash(self, value):
         self.set_root_hash(value)
 
+    def is_empty(self):
+        return self.root_node == BLANK_NODE
+
+    # Fills the empty trie with the (key, value) pairs of items using build_root
+    def build(self, items):
+        assert self.is_empty()
+        self.set_root_hash(build_root(sorted(items), self.db))
+
     def set_root_hash(self, root_hash):
         assert utils.is_string(root_hash)
         assert len(root_hash) in [0, 32]
+        self.dirty = False
         if root_hash == BLANK_ROOT:
             self.root_node = BLANK_NODE
             self._root_hash = BLANK_ROOT
@@ -154,6 +305,7 @@ class Trie(object):
         self._delete_node_storage(self.root_node)
         self.root_node = BLANK_NODE
         self._root_hash = BLANK_ROOT
+        self.dirty = False
 
     def _delete_child_storage(self, node):
         node_type = self._get_node_type(node)
@@ -166,6 +318,8 @@ class Trie(object):
     def _encode_node(self, node, put_in_db=True):
         if node == BLANK_NODE:
             return BLANK_NODE
+        if self.deferred:
+            return node
         rlpnode = encode_optimized(node)
         if len(rlpnode) < 32:
             return node
@@ -180,6 +334,13 @@ class Trie(object):
             return BLANK_NODE
         if isinstance(encoded, list):
             return encoded
+        # Decoded nodes are shared through the cache, they must not be modified
+        if self.node_cache is not None:
+            o = self.node_cache.get(encoded)
+            if o is None:
+                o = rlp.decode(self.db.get(encoded))
+                self.node_cache.put(encoded, o)
+            return o
         o = rlp.decode(self.db.get(encoded))
         return o
 
@@ -188,9 +349,8 @@ class Trie(object):
             return NODE_TYPE_BLANK
 
         if len(node) == 2:
-            nibbles = unpack_to_nibbles(node[0])
-            has_terminator = (nibbles and nibbles[-1] == NIBBLE_TERMINATOR)
-            return NODE_TYPE_LEAF if has_terminator \
+            # Terminator flag of the packed key
+            return NODE_TYPE_LEAF if ord(node[0][0]) & 0x20 \
                 else NODE_TYPE_EXTENSION
         if len(node) == 17:
             return NODE_TYPE_BRANCH
@@ -204,7 +364,7 @@ class Trie(object):
         if node_type == NODE_TYPE_BRANCH:
             if not key:
                 return node[-1]
-            sub_node = self._decode_to_node(node[key[0]])
+            sub_node = self._decode_to_node(node[ord(key[0])])
             return self._get(sub_node, key[1:])
 
         curr_key = without_terminator(unpack_to_nibbles(node[0]))
@@ -225,13 +385,14 @@ class Trie(object):
             return [pack_nibbles(with_terminator(key)), value]
 
         elif node_type == NODE_TYPE_BRANCH:
+            node = node[:]
             if not key:
                 node[-1] = value
             else:
                 new_node = self._update_and_delete_storage(
-                    self._decode_to_node(node[key[0]]),
+                    self._decode_to_node(node[ord(key[0])]),
                     key[1:], value)
-                node[key[0]] = self._encode_node(new_node)
+                node[ord(key[0])] = self._encode_node(new_node)
             return node
 
         elif is_key_value_type(node_type):
@@ -259,39 +420,39 @@ class Trie(object):
         remain_key = key[prefix_length:]
         remain_curr_key = curr_key[prefix_length:]
 
-        if remain_key == [] == remain_curr_key:
+        if not remain_key and not remain_curr_key:
             if not is_inner:
                 return [node[0], value]
             new_node = self._update_and_delete_storage(
                 self._decode_to_node(node[1]), remain_key, value)
 
-        elif remain_curr_key == []:
+        elif not remain_curr_key:
             if is_inner:
                 new_node = self._update_and_delete_storage(
                     self._decode_to_node(node[1]), remain_key, value)
             else:
                 new_node = [BLANK_NODE] * 17
                 new_node[-1] = node[1]
-                new_node[remain_key[0]] = self._encode_node([
+                new_node[ord(remain_key[0])] = self._encode_node([
                     pack_nibbles(with_terminator(remain_key[1:])),
                     value
                 ])
         else:
             new_node = [BLANK_NODE] * 17
             if len(remain_curr_key) == 1 and is_inner:
-                new_node[remain_curr_key[0]] = node[1]
+                new_node[ord(remain_curr_key[0])] = node[1]
             else:
-                new_node[remain_curr_key[0]] = self._encode_node([
+                new_node[ord(remain_curr_key[0])] = self._encode_node([
                     pack_nibbles(
                         adapt_terminator(remain_curr_key[1:], not is_inner)
                     ),
                     node[1]
                 ])
 
-            if remain_key == []:
+            if not remain_key:
                 new_node[-1] = value
             else:
-                new_node[remain_key[0]] = self._encode_node([
+                new_node[ord(remain_key[0])] = self._encode_node([
                     pack_nibbles(with_terminator(remain_key[1:])), value
                 ])
 
@@ -301,13 +462,13 @@ class Trie(object):
         else:
             return new_node
 
-    def _getany(self, node, reverse=False, path=[]):
+    def _getany(self, node, reverse=False, path=b''):
         node_type = self._get_node_type(node)
         if node_type == NODE_TYPE_BLANK:
             return None
         if node_type == NODE_TYPE_BRANCH:
             if node[16] and not reverse:
-                return [16]
+                return TERMINATOR
             scan_range = list(range(16))
             if reverse:
                 scan_range.reverse()
@@ -316,11 +477,11 @@ class Trie(object):
                     self._decode_to_node(
                         node[i]),
                     reverse=reverse,
-                    path=path + [i])
+                    path=path + chr(i))
                 if o is not None:
-                    return [i] + o
+                    return chr(i) + o
             if node[16] and reverse:
-                return [16]
+                return TERMINATOR
             return None
         curr_key = without_terminator(unpack_to_nibbles(node[0]))
         if node_type == NODE_TYPE_LEAF:
@@ -339,15 +500,16 @@ class Trie(object):
         elif not key:
             return BLANK_NODE, node
         elif node_type == NODE_TYPE_BRANCH:
-            b1 = node[:key[0]]
+            k0 = ord(key[0])
+            b1 = node[:k0]
             b1 += [''] * (17 - len(b1))
-            b2 = node[key[0] + 1:]
+            b2 = node[k0 + 1:]
             b2 = [''] * (17 - len(b2)) + b2
             b1[16], b2[16] = b2[16], b1[16]
-            sub = self._decode_to_node(node[key[0]])
+            sub = self._decode_to_node(node[k0])
             sub1, sub2 = self._split(sub, key[1:])
-            b1[key[0]] = self._encode_node(sub1) if sub1 else ''
-            b2[key[0]] = self._encode_node(sub2) if sub2 else ''
+            b1[k0] = self._encode_node(sub1) if sub1 else ''
+            b2[k0] = self._encode_node(sub2) if sub2 else ''
             return self._normalize_branch_node(b1) if len([x for x in b1 if x]) else BLANK_NODE, \
                    self._normalize_branch_node(b2) if len(
                        [x for x in b2 if x]) else BLANK_NODE
@@ -434,10 +596,10 @@ class Trie(object):
             if node_type != NODE_TYPE_BRANCH:
                 new_node = [BLANK_NODE] * 17
                 curr_key = unpack_to_nibbles(node[0][0])
-                new_node[curr_key[0]] = self._encode_node([
+                new_node[ord(curr_key[0])] = self._encode_node([
                     pack_nibbles(curr_key[1:]),
                     node[0][1]
-                ]) if curr_key[0] < 16 and curr_key[1:] else node[0][1]
+                ]) if curr_key[0] != TERMINATOR and curr_key[1:] else node[0][1]
                 node[0] = new_node
         node1, node2 = nodes[0][0], nodes[1][0]
         assert len([i for i in range(17) if node1[i] and node2[i]]) <= 1
@@ -455,7 +617,7 @@ class Trie(object):
         t.root_node = t._merge(trie1.root_node, trie2.root_node)
         return t
 
-    def _iter(self, node, key, reverse=False, path=[]):
+    def _iter(self, node, key, reverse=False, path=b''):
         node_type = self._get_node_type(node)
 
         if node_type == NODE_TYPE_BLANK:
@@ -463,21 +625,21 @@ class Trie(object):
 
         elif node_type == NODE_TYPE_BRANCH:
             if len(key):
-                sub_node = self._decode_to_node(node[key[0]])
-                o = self._iter(sub_node, key[1:], reverse, path + [key[0]])
+                sub_node = self._decode_to_node(node[ord(key[0])])
+                o = self._iter(sub_node, key[1:], reverse, path + key[0])
                 if o is not None:
-                    return [key[0]] + o
+                    return key[0] + o
             if reverse:
-                scan_range = reversed(list(range(key[0] if len(key) else 0)))
+                scan_range = reversed(list(range(ord(key[0]) if len(key) else 0)))
             else:
-                scan_range = list(range(key[0] + 1 if len(key) else 0, 16))
+                scan_range = list(range(ord(key[0]) + 1 if len(key) else 0, 16))
             for i in scan_range:
                 sub_node = self._decode_to_node(node[i])
-                o = self._getany(sub_node, reverse, path + [i])
+                o = self._getany(sub_node, reverse, path + chr(i))
                 if o is not None:
-                    return [i] + o
+                    return chr(i) + o
             if reverse and key and node[16]:
-                return [16]
+                return TERMINATOR
             return None
 
         descend_key = without_terminator(unpack_to_nibbles(node[0]))
@@ -511,7 +673,7 @@ class Trie(object):
         return nibbles_to_bin(without_terminator(o)) if o else None
 
     def _delete_node_storage(self, node):
-        if node == BLANK_NODE:
+        if node == BLANK_NODE or self.deferred:
             return
         encoded = self._encode_node(node, put_in_db=False)
 
@@ -541,17 +703,17 @@ class Trie(object):
         not_blank_index = [i for i, item in enumerate(node) if item][0]
 
         if not_blank_index == 16:
-            return [pack_nibbles(with_terminator([])), node[16]]
+            return [pack_nibbles(TERMINATOR), node[16]]
 
         sub_node = self._decode_to_node(node[not_blank_index])
         sub_node_type = self._get_node_type(sub_node)
 
         if is_key_value_type(sub_node_type):
-            new_key = [not_blank_index] + \
+            new_key = chr(not_blank_index) + \
                       unpack_to_nibbles(sub_node[0])
             return [pack_nibbles(new_key), sub_node[1]]
         if sub_node_type == NODE_TYPE_BRANCH:
-            return [pack_nibbles([not_blank_index]),
+            return [pack_nibbles(chr(not_blank_index)),
                     self._encode_node(sub_node)]
         assert False
 
@@ -563,19 +725,21 @@ class Trie(object):
         return new_node
 
     def _delete_branch_node(self, node, key):
+        node = node[:]
         if not key:
             node[-1] = BLANK_NODE
             return self._normalize_branch_node(node)
 
+        k0 = ord(key[0])
         encoded_new_sub_node = self._encode_node(
             self._delete_and_delete_storage(
-                self._decode_to_node(node[key[0]]), key[1:])
+                self._decode_to_node(node[k0]), key[1:])
         )
 
-        if encoded_new_sub_node == node[key[0]]:
+        if encoded_new_sub_node == node[k0]:
             return node
 
-        node[key[0]] = encoded_new_sub_node
+        node[k0] = encoded_new_sub_node
         if encoded_new_sub_node == BLANK_NODE:
             return self._normalize_branch_node(node)
 
@@ -642,97 +806,79 @@ class Trie(object):
             sizes = sizes + [1 if node[-1] else 0]
             return sum(sizes)
 
-    def _iter_branch(self, node):
+    # Yields the (nibbles, value) pairs under node, whose path is path, in key order.
+    # Subtrees whose keys all sort before the start nibbles are skipped
+    def _iter_node(self, node, path, start):
         if node == BLANK_NODE:
-            raise StopIteration
-
+            return
+        if start is not None and path < start[:len(path)]:
+            return
         node_type = self._get_node_type(node)
-
-        if is_key_value_type(node_type):
-            nibbles = without_terminator(unpack_to_nibbles(node[0]))
-            key = b'+'.join([utils.to_string(x) for x in nibbles])
-            if node_type == NODE_TYPE_EXTENSION:
-                sub_tree = self._iter_branch(self._decode_to_node(node[1]))
-            else:
-                sub_tree = [(utils.to_string(NIBBLE_TERMINATOR), node[1])]
-
-            for sub_key, sub_value in sub_tree:
-                full_key = (key + b'+' + sub_key).strip(b'+')
-                yield (full_key, sub_value)
-
-        elif node_type == NODE_TYPE_BRANCH:
-            for i in range(16):
-                sub_tree = self._iter_branch(self._decode_to_node(node[i]))
-                for sub_key, sub_value in sub_tree:
-                    full_key = (
-                        str_to_bytes(
-                            str(i)) +
-                        b'+' +
-                        sub_key).strip(b'+')
-                    yield (full_key, sub_value)
+        if node_type == NODE_TYPE_BRANCH:
             if node[16]:
-                yield (utils.to_string(NIBBLE_TERMINATOR), node[-1])
-
-    def iter_branch(self):
-        for key_str, value in self._iter_branch(self.root_node):
-            if key_str:
-                nibbles = [int(x) for x in key_str.split(b'+')]
+                yield path, node[16]
+            for i in range(16):
+                if node[i] != BLANK_NODE:
+                    for item in self._iter_node(self._decode_to_node(node[i]), path + chr(i), start):
+                        yield item
+        else:
+            nibbles = path + without_terminator(unpack_to_nibbles(node[0]))
+            if node_type == NODE_TYPE_LEAF:
+                yield nibbles, node[1]
             else:
-                nibbles = []
-            key = nibbles_to_bin(without_terminator(nibbles))
+                for item in self._iter_node(self._decode_to_node(node[1]), nibbles, start):
+                    yield item
+
+    # Yields the (key, value) pairs in key order, walking the trie depth first. Only keys
+    # with start <= key < end that begin with prefix are returned, and the subtrees
+    # before start are not visited. See TrieCursor to resume an iteration later
+    def iter_items(self, start=None, end=None, prefix=None):
+        if prefix is not None and (start is None or start < prefix):
+            start = prefix
+        start_nibbles = bin_to_nibbles(start) if start is not None else None
+        for nibbles, value in self._iter_node(self.root_node, b'', start_nibbles):
+            key = nibbles_to_bin(nibbles)
+            if start is not None and key < start:
+                continue
+            if (prefix is not None and not key.startswith(prefix)) or (end is not None and key >= end):
+                return
             yield key, value
 
-    def _to_dict(self, node):
-        if node == BLANK_NODE:
-            return {}
-
-        node_type = self._get_node_type(node)
-
-        if is_key_value_type(node_type):
-            nibbles = without_terminator(unpack_to_nibbles(node[0]))
-            key = b'+'.join([utils.to_string(x) for x in nibbles])
-            if node_type == NODE_TYPE_EXTENSION:
-                sub_dict = self._to_dict(self._decode_to_node(node[1]))
-            else:
-                sub_dict = {utils.to_string(NIBBLE_TERMINATOR): node[1]}
-            res = {}
-            for sub_key, sub_value in sub_dict.items():
-                full_key = (key + b'+' + sub_key).strip(b'+')
-                res[full_key] = sub_value
-            return res
-
-        elif node_type == NODE_TYPE_BRANCH:
-            res = {}
-            for i in range(16):
-                sub_dict = self._to_dict(self._decode_to_node(node[i]))
-
-                for sub_key, sub_value in sub_dict.items():
-                    full_key = (
-                        str_to_bytes(
-                            str(i)) +
-                        b'+' +
-                        sub_key).strip(b'+')
-                    res[full_key] = sub_value
-
-            if node[16]:
-                res[utils.to_string(NIBBLE_TERMINATOR)] = node[-1]
-            return res
+    def iter_branch(self):
+        return self.iter_items()
 
     def to_dict(self):
-        d = self._to_dict(self.root_node)
-        res = {}
-        for key_str, value in d.items():
-            if key_str:
-                nibbles = [int(x) for x in key_str.split(b'+')]
-            else:
-                nibbles = []
-            key = nibbles_to_bin(without_terminator(nibbles))
-            res[key] = value
-        return res
+        return dict(self.iter_items())
 
     def get(self, key):
         return self._get(self.root_node, bin_to_nibbles(utils.to_string(key)))
 
+    # Returns the rlp of the hashed nodes on the path to key, root first, which prove
+    # the value of key (or its absence) against the root hash. See proof.py
+    def get_proof(self, key):
+        if self.dirty:
+            self.commit()
+        node = self.root_node
+        proof = [encode_optimized(node)]
+        key = bin_to_nibbles(utils.to_string(key))
+        while node != BLANK_NODE:
+            node_type = self._get_node_type(node)
+            if node_type == NODE_TYPE_BRANCH:
+                if not key:
+                    break
+                encoded = node[ord(key[0])]
+                key = key[1:]
+            else:
+                curr_key = without_terminator(unpack_to_nibbles(node[0]))
+                if node_type == NODE_TYPE_LEAF or not starts_with(key, curr_key):
+                    break
+                encoded = node[1]
+                key = key[len(curr_key):]
+            node = self._decode_to_node(encoded)
+            if node != BLANK_NODE and not isinstance(encoded, list):
+                proof.append(encode_optimized(node))
+        return proof
+
     def __len__(self):
         return self._get_size(self.root_node)
 
@@ -746,7 +892,7 @@ class Trie(object):
         return self.delete(key)
 
     def __iter__(self):
-        return iter(self.to_dict())
+        return (key for key, _ in self.iter_items())
 
     def __contains__(self, key):
         return self.get(key) != BLANK_NODE
@@ -767,3 +913,30 @@ class Trie(object):
         if self.root_hash == BLANK_ROOT:
             return True
         return self.root_hash in self.db
+
+
+# Iterates over the items of a trie keeping the position reached, so that iteration
+# can go on later from there, or on another Trie object for the same root. With
+# preimages (a db), keys are hashes and the stored preimages are returned instead
+class TrieCursor(object):
+
+    def __init__(self, trie, start=None, end=None, prefix=None, preimages=None):
+        self.trie = trie
+        self.position = start
+        self.end = end
+        self.prefix = prefix
+        self.preimages = preimages
+        self.done = False
+
+    def __iter__(self):
+        for key, value in self.trie.iter_items(self.position, self.end, self.prefix):
+            # Smallest key after the current one
+            self.position = key + b'\x00'
+            if self.preimages is not None:
+                key = self.preimages.get(key)
+            yield key, value
+        self.done = True
+
+    # Returns up to n more items, an empty list once the iteration is done
+    def next_batch(self, n):
+        return list(itertools.islice(iter(self), n))
@@ -161,6 +161,38 @@ def ipaddr_to_netaddr(afi,ipaddr):
     elif afi == 2:
         ip = IPv6Address(Bytes(ipaddr))
     return IPNetwork(str(ip))
+
+# Same layout as Transaction.value: packed network address + 1 byte prefix length
+def pack_prefix(version, network, prefixlen):
+    if version == 4:
+        return struct.pack('>IB', network, prefixlen)
+    return struct.pack('>QQB', network >> 64, network & 0xffffffffffffffff, prefixlen)
+
+def unpack_prefix(b):
+    if len(b) == 5:
+        network, prefixlen = struct.unpack('>IB', b)
+        return 4, network, prefixlen
+    elif len(b) == 17:
+        high, low, prefixlen = struct.unpack('>QQB', b)
+        return 6, (high << 64) | low, prefixlen
+    raise ValueError("Invalid packed prefix length: %d" % len(b))
+
+# (version, first, last) of a packed prefix, host bits are ignored
+def unpack_interval(b):
+    version, network, prefixlen = unpack_prefix(b)
+    width = 32 if version == 4 else 128
+    if prefixlen > width:
+        raise ValueError("Invalid prefix length: %d" % prefixlen)
+    hostmask = (1 << (width - prefixlen)) - 1
+    first = network & ~hostmask
+    return version, first, first | hostmask
+
+def prefix_to_bin(ipnet):
+    return pack_prefix(ipnet.version, ipnet.first, ipnet.prefixlen)
+
+def bin_to_prefix(b):
+    version, network, prefixlen = unpack_prefix(b)
+    return IPNetwork((network, prefixlen), version=version)
     
 def compress_random_no_to_int(input_string, output_int_lenght):
     input_str = remove_0x_head(input_string)
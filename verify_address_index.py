@@ -0,0 +1,68 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Checks the flat address index of a chain database ('address:<addr>' entries)
+against the head state trie.
+
+Every account of the head trie must have an index entry holding the same rlp,
+there must be no entries for other addresses, the 'address_count:' totals must
+match and the 'address_index:root' marker must match the head state root. With
+--repair the index entries, totals and marker are rebuilt from the trie when the
+check fails. The trie itself is only read.
+
+Usage: python verify_address_index.py [chain_db_dir] [--repair]
+"""
+
+import sys
+from rlp.utils import encode_hex
+from db import open_db
+from config import Env
+from state import State
+from migrate_balances import head_state_root
+
+
+# Opens the head state at the root of the head block, the root stored for the genesis
+# block, without writing any trie node. Not flagged as head state, so that loading it
+# does not touch the index
+def head_state(db, env):
+    return State(root=head_state_root(db, db.get('head_hash')), env=env)
+
+
+def run(path, repair=False):
+    db = open_db(path)
+    if 'head_hash' not in db:
+        print "No head found in %s, nothing to verify" % path
+        return 1
+    return verify(db, repair)
+
+
+# A repair writes only the 'address:' and 'address_count:' entries and the
+# 'address_index:root' marker
+def verify(db, repair=False):
+    state = head_state(db, Env(db))
+    print "Head state root: %s" % encode_hex(state.trie.root_hash)
+    state.address_index_valid()
+    print "Index marker:    %s" % encode_hex(state.address_index_root)
+
+    missing, mismatched, extra, counts_ok = state.verify_address_index()
+    for name, addrs in (("Missing", missing), ("Mismatched", mismatched), ("Extra", extra)):
+        print "%s entries: %d" % (name, len(addrs))
+        for addr in addrs[:10]:
+            print "    %s" % encode_hex(addr)
+    print "Address counts: %s" % ("OK" if counts_ok else "WRONG")
+    ok = not (missing or mismatched or extra) and counts_ok and state.address_index_valid()
+    if ok:
+        print "Address index OK"
+        return 0
+    if not repair:
+        print "Address index INCONSISTENT, run with --repair to rebuild it"
+        return 1
+    print "Rebuilding address index..."
+    print "%d accounts indexed" % state.rebuild_address_index()
+    db.commit()
+    return 0
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a != '--repair']
+    sys.exit(run(args[0] if args else './chain', '--repair' in sys.argv[1:]))